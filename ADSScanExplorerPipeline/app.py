@@ -1,10 +1,70 @@
+import os
+from multiprocessing.util import register_after_fork
 from adsputils import ADSCelery
+from celery.signals import celeryd_init
+from sqlalchemy import create_engine
+from sqlalchemy.engine import Engine
+from sqlalchemy.engine.url import make_url
 from .models import *
+from .metrics import TimedQueuePool
 
 class ADSScanExplorerPipeline(ADSCelery):
+
+    def __init__(self, *args, **kwargs):
+        ADSCelery.__init__(self, *args, **kwargs)
+        #The engine of adsputils has no pool settings, it's replaced before any connection is opened
+        if self._engine is not None:
+            self._set_pool_engine()
+            celeryd_init.connect(self.size_pool_to_worker, weak=False)
+
+    def _set_pool_engine(self, worker_concurrency: int = None):
+        self._engine = create_pool_engine(self._config, worker_concurrency)
+        self._session.configure(bind=self._engine)
+        register_after_fork(self._engine, self._engine.dispose)
+
+    def size_pool_to_worker(self, sender=None, instance=None, conf=None, options=None, **kwargs):
+        """
+        Sizes the pool of a worker running its tasks in threads to its concurrency when SQLALCHEMY_POOL_SIZE
+        isn't set, since each task holds a connection while waiting on S3, Open Search or the service
+        """
+        options = options or {}
+        if self._config.get('SQLALCHEMY_POOL_SIZE') is None and is_threaded_pool(options.get('pool_cls')):
+            self._engine.dispose()
+            self._set_pool_engine(options.get('concurrency') or os.cpu_count())
+
     def attempt_recovery(self, task, args=None, kwargs=None, einfo=None, retval=None):
         """
         If task fails after 3 attempts...
         """
         #task.apply_async(args=args, kwargs=kwargs)
         pass
+
+def is_threaded_pool(pool_cls) -> bool:
+    """
+    Checks if the celery pool runs the tasks of the worker concurrently in one process
+    """
+    if pool_cls is None:
+        return False
+    name = pool_cls if isinstance(pool_cls, str) else pool_cls.__module__.rsplit('.', 1)[-1]
+    return name in ('thread', 'threads', 'eventlet', 'gevent')
+
+def create_pool_engine(config: dict, worker_concurrency: int = None) -> Engine:
+    """
+    Creates the engine of the worker process with the pool configured by the SQLALCHEMY_POOL_* settings.
+    Without SQLALCHEMY_POOL_SIZE the pool holds the concurrency of a threaded worker or 4 connections otherwise.
+    SQLite keeps its own single connection pools so only pre ping and recycle apply there
+    """
+    url = config.get('SQLALCHEMY_URL', 'sqlite:///')
+    options = {
+        'echo': config.get('SQLALCHEMY_ECHO', False),
+        'pool_pre_ping': config.get('SQLALCHEMY_POOL_PRE_PING', True),
+        'pool_recycle': config.get('SQLALCHEMY_POOL_RECYCLE', -1),
+    }
+    if make_url(url).get_backend_name() != 'sqlite':
+        options.update({
+            'poolclass': TimedQueuePool,
+            'pool_size': config.get('SQLALCHEMY_POOL_SIZE') or worker_concurrency or 4,
+            'max_overflow': config.get('SQLALCHEMY_MAX_OVERFLOW', 2),
+            'pool_timeout': config.get('SQLALCHEMY_POOL_TIMEOUT', 30),
+        })
+    return create_engine(url, **options)
@@ -1,16 +1,32 @@
 import re
 import os
+import csv
+import io
 import html
+import json
+from datetime import datetime
+from enum import Enum
 from hashlib import md5
-from typing import Iterable
-from ADSScanExplorerPipeline.models import JournalVolume, Page, Article, PageColor, VolumeStatus, PageType
+import struct
+import time
+import zlib
+from typing import Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Set, Tuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
+from ADSScanExplorerPipeline.models import JournalVolume, Page, Article, PageRecord, ArticleRecord, PageColor, VolumeStatus, PageType, VolumeStageCheckpoint, SEPARATOR_PAGE_TYPES, page_article_association_table
 from ADSScanExplorerPipeline.exceptions import MissingImageFileException
+from ADSScanExplorerPipeline.metrics import record
 import opensearchpy
+import opensearchpy.helpers
+from sqlalchemy import Table, and_, bindparam, case, or_, select
 from sqlalchemy.orm import Session
 from PIL import Image
 from PIL.TiffTags import TAGS
 from adsputils import setup_logging, load_config
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config as BotocoreConfig
+import urllib3
 
 # ============================= INITIALIZATION ==================================== #
 # - Use app logger:
@@ -23,178 +39,678 @@ logger = setup_logging(__name__, proj_home=proj_home,
                         level=config.get('LOGGING_LEVEL', 'INFO'),
                         attach_stdout=config.get('LOG_STDOUT', False))
 
+PAGE_COLUMNS = ['created', 'updated', 'id', 'name', 'label', 'format', 'color_type', 'page_type', 'width', 'height', 'journal_volume_id', 'volume_running_page_num']
+ARTICLE_COLUMNS = ['created', 'updated', 'bibcode', 'journal_volume_id', 'start_page_number']
+PAGE_ARTICLE_COLUMNS = ['page_id', 'article_id']
+
+TIFF_TAG_IMAGE_WIDTH = 256
+TIFF_TAG_IMAGE_LENGTH = 257
+TIFF_TAG_BITS_PER_SAMPLE = 258
+TIFF_TYPE_SHORT = 3
+TIFF_TYPE_LONG = 4
+# Upper bound on the IFD entries read in one pread, scans normally have less than 20 tags
+TIFF_MAX_IFD_ENTRIES = 64
+
+# Page name separator of the page type column in .top.map files
+TOP_MAP_TYPE_SEPARATORS = {"1": ".", "C": ",", "B": ":", "I": "I", "P": "P", "M": "M"}
+
+class TopRow(NamedTuple):
+    """Page row of a .top or .top.map file"""
+    name: str
+    page_type: PageType
+    label: Optional[str]
+    running_page_num: int
+
+#Stages that checkpoint their completed files or pages
+CHECKPOINT_STAGE_IMAGES = 'upload-images'
+CHECKPOINT_STAGE_OCR = 'index-ocr'
+
 
 # =============================== FUNCTIONS ======================================= #
-def parse_top_file(file_path: str, journal_volume: JournalVolume, session: Session) -> Iterable[Page]:
+def parse_top_file(file_path: str, journal_volume: JournalVolume, session: Session, page_index: Dict[str, PageRecord] = None) -> Iterable[PageRecord]:
     """
-    Loops through the volumes .top file and yields a Page object for each row
+    Loops through the volumes .top file and yields a page record for each row
+    Pages are looked up and added to the page index, which is loaded from the db unless given
+    """
+    if page_index is None:
+        page_index = get_page_index(journal_volume.id, session)
+    for row in parse_top_rows(file_path):
+        page = page_index.get(row.name)
+        if not page:
+            page = PageRecord(row.name, journal_volume.id, row.page_type)
+            page_index[row.name] = page
+        page.volume_running_page_num = row.running_page_num
+        if row.label:
+            page.label = row.label
+        yield page
+
+def parse_top_rows(file_path: str) -> List[TopRow]:
+    """
+    Reads the page rows of a .top file, or of the .top.map file next to it if there is one, in one pass.
+    Rows without a valid page name are skipped and the label is only set if the row has one
     """
     topmap_filepath = file_path + ".map"
-    is_map_file = False
+    split_row = split_top_row
     if os.path.exists(topmap_filepath):
         file_path = topmap_filepath
-        is_map_file = True
-    running_page_num = 0
+        split_row = split_top_map_row
+    rows = []
     with open(file_path) as file:
         for line in file:
-            if is_map_file:
-                page_name, label = split_top_map_row(line)
-            else:
-                page_name, label = split_top_row(line)
-            if check_page_name_is_valid(page_name):
-                running_page_num += 1
-                page = Page.get_or_create(page_name, journal_volume.id, session)
-                page.volume_running_page_num = running_page_num
-                if label:
-                    page.label = label
-                yield page
+            page_name, label = split_row(line)
+            page_type = SEPARATOR_PAGE_TYPES.get(page_name[7]) if len(page_name) == 11 else None
+            if page_type:
+                rows.append(TopRow(page_name, page_type, label, len(rows) + 1))
+    return rows
 
 def check_page_name_is_valid(page_name: str):
-    if len(page_name) == 11:
-        try:
-            PageType.page_type_from_separator(page_name[7])
-            return True
-        except:
-            return False
-    return False
+    return len(page_name) == 11 and page_name[7] in SEPARATOR_PAGE_TYPES
 
 def split_top_map_row(line: str):
     """ Function to solit the lines in a.top.map file.
         These are tab separated and have the page type indication on the 3rd column instead of in the image name. 
         The image name is therefore adjusted to kepp in sync with the rest of the code
     """
-    line_split = re.split(r"\s+", line)
+    line_split = line.split()
+    #Leading whitespace gives an empty page name like splitting on \s+ does
+    if not line_split or line[0].isspace():
+        line_split.insert(0, "")
     name = line_split[0]
-    label = None
-    if len(line_split) > 1:
-        if not line_split[1].isspace() and len(line_split[1]) > 0:
-            label = line_split[1]
+    label = line_split[1] if len(line_split) > 1 else None
     if len(line_split) > 2:
-        type_index = 7
-        type = line_split[2]
-        if type == "1":
-            name = name[:type_index] + "." + name[type_index + 1:]
-        elif type == "C":
-            name = name[:type_index] + "," + name[type_index + 1:]
-        elif type == "B":
-            name = name[:type_index] + ":" + name[type_index + 1:]
-        elif type == "I":
-            name = name[:type_index] + "I" + name[type_index + 1:]
-        elif type == "P":
-            name = name[:type_index] + "P" + name[type_index + 1:]
-        elif type == "M":
-            name = name[:type_index] + "M" + name[type_index + 1:]
+        separator = TOP_MAP_TYPE_SEPARATORS.get(line_split[2])
+        if separator:
+            name = name[:7] + separator + name[8:]
     return name, label
 
 def split_top_row(line: str):
     name = line[0:11]
-    label = None
-    page_label = line[11:].strip()
-    if not page_label.isspace() and len(page_label) > 0:
-        label = page_label
+    label = line[11:].strip() or None
     return name, label
 
 
-def parse_dat_file(file_path: str, journal_volume: JournalVolume, session: Session):
+def parse_dat_file(file_path: str, journal_volume: JournalVolume, session: Session, page_index: Dict[str, PageRecord] = None, article_index: Dict[str, ArticleRecord] = None):
     """
-    Loops through the volumes .dat file and yields a Article object for each row
-    Each article gets linked with all pages associated to that article
+    Loops through the volumes .dat file and yields an article record for each row
+    Each article gets linked with all pages associated to that article.
+    Pages and articles are resolved against an in-memory index of the volume loaded
+    with a single query each instead of one query per page reference, unless the indexes are given
     """
+    if page_index is None:
+        page_index = get_page_index(journal_volume.id, session)
+    if article_index is None:
+        article_index = get_article_index(journal_volume.id, session)
     with open(file_path) as file:
         line_num = 0
         for line in file:
             line_num += 1
             line_split = re.split(r"[\s+|]", line.strip())
             article_name = line_split[0]
-            article = Article.get_or_create(article_name, journal_volume.id, session)
-            article.pages = []
-            first = True
+            article = article_index.get(article_name)
+            if not article:
+                article = ArticleRecord(article_name, journal_volume.id)
+                article_index[article_name] = article
+            pages = []
             for page_name in line_split[3:]:
                 if not check_page_name_is_valid(page_name):
                     continue
-                page = Page.get_from_name_and_journal(page_name, journal_volume.id, session)
+                page = page_index.get(page_name)
                 if not page:
                     raise Exception("Page: " + page_name + " in .dat but not .top")
-                if first:
+                if not pages:
                     article.start_page_number = page.volume_running_page_num
-                    first = False
-                if page not in article.pages:
-                    article.pages.append(page)
+                if page not in pages:
+                    pages.append(page)
+            article.pages = pages
             yield article
 
-def check_all_image_files_exists(image_path: str, journal_volume: JournalVolume, session: Session):
+def get_page_index(journal_volume_id: str, session: Session) -> Dict[str, Page]:
+    """
+    Loads all pages of the volume in one query and indexes them by page name
+    """
+    return {page.name: page for page in Page.get_all_from_volume(journal_volume_id, session)}
+
+def get_article_index(journal_volume_id: str, session: Session) -> Dict[str, Article]:
+    """
+    Loads all articles of the volume in one query and indexes them by bibcode
+    """
+    return {article.bibcode: article for article in Article.get_all_from_volume(journal_volume_id, session)}
+
+def check_all_image_files_exists(image_path: str, journal_volume: JournalVolume, session: Session, pages: Iterable[PageRecord] = None):
     """
     Makes sure that all pages that have been found in the top file exists in the iamge folder as well
     """
     image_list = os.listdir(image_path)
-    for page in Page.get_all_from_volume(journal_volume.id, session):
+    if pages is None:
+        pages = Page.get_all_from_volume(journal_volume.id, session)
+    for page in pages:
         if page.name not in image_list:
             raise MissingImageFileException("Missing image file %s", page.name)
 
 
-def parse_image_files(image_path: str, journal_volume: JournalVolume, session: Session):
+def parse_image_files(image_path: str, journal_volume: JournalVolume, session: Session, page_index: Dict[str, PageRecord] = None):
     """
     Loops through the volumes image files and parse out width and height from the TIFF header
     Some pages have multiple images a Black-and-White without file ending and a .tif which can
     be either grayscale or color based on the number of channels.
+    The headers are read concurrently by IMAGE_PARSE_WORKERS threads while the pages are
+    looked up and updated on the calling thread only.
     """
+    if page_index is None:
+        page_index = get_page_index(journal_volume.id, session)
+    image_files = []
     for filename in sorted(os.listdir(image_path)):
         try:
             if filename.endswith(".png") or filename.endswith(".jpg"):
                 continue
             base_filename = filename.replace(".tif", "")
-            page = Page.get_from_name_and_journal(base_filename, journal_volume.id, session)
+            page = page_index.get(base_filename)
             if not page:
                 #Image file not in lists 
                 #TODO possibly log this somewhere
                 continue
+            image_files.append((filename, page))
+        except Exception as e:
+            raise Exception("Failed to parse image file: " + os.path.join(image_path, filename) + " due to: " + str(e))
 
-            with Image.open(os.path.join(image_path, filename)) as img:
-                meta_dict = {TAGS[key] : img.tag[key] for key in img.tag_v2}
-                width = meta_dict["ImageWidth"][0]
-                height = meta_dict["ImageLength"][0]
-
-                if filename.endswith(".tif"):
-                    n_samples = len(meta_dict["BitsPerSample"])
-                    #The tiff images are either color if having 3 channels or grayscale if only 1 channel
-                    if n_samples > 1:
-                        color = PageColor.Color
-                    else:
-                        color = PageColor.Grayscale
-                    page.color_type = color
-                    page.width = width
-                    page.height = height
+    headers = read_tiff_headers([os.path.join(image_path, filename) for filename, _ in image_files])
+    for filename, page in image_files:
+        try:
+            width, height, n_samples = next(headers)
+            if filename.endswith(".tif"):
+                #The tiff images are either color if having 3 channels or grayscale if only 1 channel
+                if n_samples > 1:
+                    color = PageColor.Color
                 else:
-                    page.width = width
-                    page.height = height
-            yield page
+                    color = PageColor.Grayscale
+                page.color_type = color
+            page.width = width
+            page.height = height
         except Exception as e:
             raise Exception("Failed to parse image file: " + os.path.join(image_path, filename) + " due to: " + str(e))
+        record(items=1)
+        yield page
 
-def upload_image_files(image_path: str, vol: JournalVolume, session: Session):
+def load_volume(top_file_path: str, dat_file_path: str, image_path: str, vol: JournalVolume, session: Session) -> Tuple[int, int]:
     """
-    Uploads all image files which have been associated with a page in the volume to a s3 bucket defined in config
+    Replaces the pages and articles of the volume by parsing the list and image files in memory
+    and writing the page, article and page2article rows in bulk within the session transaction.
+    Returns the number of pages and articles written
     """
-    s3_bucket = boto3.resource("s3",\
-        aws_access_key_id=config.get("S3_BUCKET_ACCESS_KEY", ""),\
-        aws_secret_access_key=config.get("S3_BUCKET_SECRET_KEY", ""))\
-            .Bucket(config.get('S3_BUCKET', ""))
+    page_rows, article_rows, page_article_rows = parse_volume_rows(top_file_path, dat_file_path, image_path, vol, session)
+
+    now = datetime.utcnow()
+    Page.delete_all_from_volume(vol.id, session)
+    Article.delete_all_from_volume(vol.id, session)
+    bulk_insert(session, Page.__table__, PAGE_COLUMNS, [(now, now) + row for row in page_rows.values()])
+    bulk_insert(session, Article.__table__, ARTICLE_COLUMNS, [(now, now) + row for row in article_rows.values()])
+    bulk_insert(session, page_article_association_table, PAGE_ARTICLE_COLUMNS, page_article_rows)
+    return len(page_rows), len(article_rows)
+
+def update_volume(top_file_path: str, dat_file_path: str, image_path: str, vol: JournalVolume, session: Session) -> Dict[str, Tuple[int, int, int]]:
+    """
+    Updates the pages and articles of the volume by comparing the parsed list and image files with the
+    stored rows and only writing the rows that were added, changed or removed within the session transaction.
+    Returns the number of inserted, updated and deleted rows per table
+    """
+    page_rows, article_rows, page_article_rows = parse_volume_rows(top_file_path, dat_file_path, image_path, vol, session)
+
+    page_table = Page.__table__
+    article_table = Article.__table__
+    link_table = page_article_association_table
+    stored_page_rows = select_volume_rows(session, page_table, PAGE_COLUMNS[2:], page_table.c.journal_volume_id == vol.id)
+    stored_article_rows = select_volume_rows(session, article_table, ARTICLE_COLUMNS[2:], article_table.c.journal_volume_id == vol.id)
+    stored_page_article_rows = set(tuple(row) for row in session.execute(select([link_table.c.page_id, link_table.c.article_id])
+        .select_from(link_table.join(page_table, page_table.c.id == link_table.c.page_id))
+        .where(page_table.c.journal_volume_id == vol.id)))
+
+    new_pages, changed_pages, removed_pages = diff_rows(page_rows, stored_page_rows)
+    new_articles, changed_articles, removed_articles = diff_rows(article_rows, stored_article_rows)
+    new_page_article_rows = set(page_article_rows)
+    new_links = sorted(new_page_article_rows - stored_page_article_rows)
+    removed_links = sorted(stored_page_article_rows - new_page_article_rows)
+
+    #Links are removed before and added after their pages and articles to keep the foreign keys valid
+    now = datetime.utcnow()
+    if removed_links:
+        session.execute(link_table.delete().where(and_(link_table.c.page_id == bindparam('_page_id'), link_table.c.article_id == bindparam('_article_id'))),
+            [{'_page_id': page_id, '_article_id': article_id} for page_id, article_id in removed_links])
+    if removed_pages:
+        session.execute(page_table.delete().where(page_table.c.id.in_(removed_pages)))
+    if removed_articles:
+        session.execute(article_table.delete().where(article_table.c.bibcode.in_(removed_articles)))
+    #The running page numbers are unique within the volume, so the renumbered pages are first moved
+    #to negative numbers to not collide with the numbers still taken by the pages updated after them
+    renumbered_pages = [row[0] for row in changed_pages if row[-1] != stored_page_rows[row[0]][-1]]
+    if renumbered_pages:
+        session.execute(page_table.update().where(page_table.c.id.in_(renumbered_pages))
+            .values(volume_running_page_num=-page_table.c.volume_running_page_num))
+    bulk_update(session, page_table, PAGE_COLUMNS[2:], [row + (now,) for row in changed_pages])
+    bulk_update(session, article_table, ARTICLE_COLUMNS[2:], [row + (now,) for row in changed_articles])
+    bulk_insert(session, page_table, PAGE_COLUMNS, [(now, now) + row for row in new_pages])
+    bulk_insert(session, article_table, ARTICLE_COLUMNS, [(now, now) + row for row in new_articles])
+    bulk_insert(session, link_table, PAGE_ARTICLE_COLUMNS, new_links)
+    return {
+        'page': (len(new_pages), len(changed_pages), len(removed_pages)),
+        'article': (len(new_articles), len(changed_articles), len(removed_articles)),
+        'page2article': (len(new_links), 0, len(removed_links)),
+    }
+
+def parse_volume_rows(top_file_path: str, dat_file_path: str, image_path: str, vol: JournalVolume, session: Session) -> Tuple[Dict[str, tuple], Dict[str, tuple], List[tuple]]:
+    """
+    Parses the list and image files of the volume in memory without touching the stored rows.
+    Returns the page and article rows keyed by their id, without the timestamps, and the page2article rows
+    """
+    page_index, article_index = parse_volume_records(top_file_path, dat_file_path, image_path, vol, session)
+    page_rows = {page.id: page.to_row() for page in page_index.values()}
+    article_rows = {article.bibcode: article.to_row() for article in article_index.values()}
+    page_article_rows = [(page.id, article.bibcode) for article in article_index.values() for page in article.pages]
+    return page_rows, article_rows, page_article_rows
+
+def parse_volume_records(top_file_path: str, dat_file_path: str, image_path: str, vol: JournalVolume, session: Session) -> Tuple[Dict[str, PageRecord], Dict[str, ArticleRecord]]:
+    """
+    Parses the list and image files of the volume into page and article records, keyed by page name and bibcode.
+    No ORM objects are created, the records are turned into rows or objects when they are stored
+    """
+    page_index = {}
+    for page in parse_top_file(top_file_path, vol, session, page_index):
+        page_index[page.name] = page
+    article_index = {}
+    if os.path.exists(dat_file_path):
+        for article in parse_dat_file(dat_file_path, vol, session, page_index, article_index):
+            article_index[article.bibcode] = article
+    check_all_image_files_exists(image_path, vol, session, page_index.values())
+    #Sets the dimensions and color of the pages in the index
+    list(parse_image_files(image_path, vol, session, page_index))
+    return page_index, article_index
+
+def select_volume_rows(session: Session, table: Table, columns: List[str], criterion) -> Dict[str, tuple]:
+    """
+    Loads the stored rows of the volume keyed by the first column, with enums given by name as in the parsed rows
+    """
+    rows = {}
+    for row in session.execute(select([table.c[column] for column in columns]).where(criterion)):
+        row = tuple(value.name if isinstance(value, Enum) else value for value in row)
+        rows[row[0]] = row
+    return rows
+
+def diff_rows(new_rows: Dict[str, tuple], stored_rows: Dict[str, tuple]) -> Tuple[List[tuple], List[tuple], List[str]]:
+    """
+    Compares the parsed rows with the stored rows by key and returns the rows to insert,
+    the rows to update and the keys to delete
+    """
+    inserts = [row for key, row in new_rows.items() if key not in stored_rows]
+    updates = [row for key, row in new_rows.items() if key in stored_rows and stored_rows[key] != row]
+    deletes = [key for key in stored_rows if key not in new_rows]
+    return inserts, updates, deletes
+
+def bulk_insert(session: Session, table: Table, columns: List[str], rows: List[tuple]):
+    """
+    Inserts the rows with COPY on postgres and a single executemany on other databases
+    """
+    if not rows:
+        return
+    if session.get_bind().dialect.name == "postgresql":
+        buffer = io.StringIO()
+        #NULL is written as \N to keep it apart from empty strings
+        csv.writer(buffer).writerows([["\\N" if value is None else value for value in row] for row in rows])
+        buffer.seek(0)
+        cursor = session.connection().connection.cursor()
+        cursor.copy_expert("COPY %s (%s) FROM STDIN WITH (FORMAT csv, NULL '\\N')" % (table.name, ", ".join(columns)), buffer)
+    else:
+        session.execute(table.insert(), [dict(zip(columns, row)) for row in rows])
+
+def bulk_update(session: Session, table: Table, columns: List[str], rows: List[tuple]):
+    """
+    Updates the rows by the first column with a single executemany, the last value of each row is the updated timestamp
+    """
+    if not rows:
+        return
+    key = table.c[columns[0]]
+    session.execute(table.update().where(key == bindparam('_key')),
+        [dict(zip(columns[1:] + ['updated'], row[1:]), _key=row[0]) for row in rows])
+
+def read_tiff_headers(file_paths: List[str]) -> Iterator[Tuple[int, int, int]]:
+    """
+    Yields the TIFF header of each file in the same order as file_paths.
+    Reading is spread over IMAGE_PARSE_WORKERS threads since it's bound by file system latency,
+    an error reading a file is raised when its position is reached
+    """
+    workers = config.get('IMAGE_PARSE_WORKERS', 1)
+    if workers <= 1 or len(file_paths) <= 1:
+        yield from map(read_tiff_header, file_paths)
+        return
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        yield from executor.map(read_tiff_header, file_paths)
+
+def read_tiff_header(file_path: str) -> Tuple[int, int, int]:
+    """
+    Reads width, height and number of samples per pixel from the first IFD of a TIFF file.
+    Only the 8 byte header and the IFD entries are read, no image data is decoded.
+    Falls back to PIL for files it can't handle e.g. BigTIFF or missing dimension tags
+    """
+    fd = os.open(file_path, os.O_RDONLY)
+    try:
+        header = os.pread(fd, 8, 0)
+        if len(header) < 8 or header[0:2] not in (b"II", b"MM"):
+            return read_tiff_header_with_pil(file_path)
+        byte_order = "<" if header[0:2] == b"II" else ">"
+        magic, ifd_offset = struct.unpack(byte_order + "HI", header[2:8])
+        if magic != 42:
+            return read_tiff_header_with_pil(file_path)
+        ifd = os.pread(fd, 2 + TIFF_MAX_IFD_ENTRIES * 12, ifd_offset)
+    finally:
+        os.close(fd)
+
+    if len(ifd) < 2:
+        return read_tiff_header_with_pil(file_path)
+    n_entries = struct.unpack(byte_order + "H", ifd[0:2])[0]
+    if n_entries > TIFF_MAX_IFD_ENTRIES or len(ifd) < 2 + n_entries * 12:
+        return read_tiff_header_with_pil(file_path)
+
+    width = height = None
+    #BitsPerSample defaults to a single sample when the tag is left out
+    n_samples = 1
+    for entry_offset in range(2, 2 + n_entries * 12, 12):
+        tag, field_type, count = struct.unpack(byte_order + "HHI", ifd[entry_offset:entry_offset + 8])
+        if tag == TIFF_TAG_BITS_PER_SAMPLE:
+            n_samples = count
+        elif tag in (TIFF_TAG_IMAGE_WIDTH, TIFF_TAG_IMAGE_LENGTH):
+            if field_type == TIFF_TYPE_SHORT:
+                value = struct.unpack(byte_order + "H", ifd[entry_offset + 8:entry_offset + 10])[0]
+            elif field_type == TIFF_TYPE_LONG:
+                value = struct.unpack(byte_order + "I", ifd[entry_offset + 8:entry_offset + 12])[0]
+            else:
+                return read_tiff_header_with_pil(file_path)
+            if tag == TIFF_TAG_IMAGE_WIDTH:
+                width = value
+            else:
+                height = value
+
+    if width is None or height is None:
+        return read_tiff_header_with_pil(file_path)
+    return width, height, n_samples
+
+def read_tiff_header_with_pil(file_path: str) -> Tuple[int, int, int]:
+    """
+    Reads width, height and number of samples per pixel from the TIFF tags through PIL
+    """
+    with Image.open(file_path) as img:
+        meta_dict = {TAGS[key] : img.tag[key] for key in img.tag_v2}
+        return meta_dict["ImageWidth"][0], meta_dict["ImageLength"][0], len(meta_dict.get("BitsPerSample", (1,)))
+
+def upload_image_files(image_path: str, vol: JournalVolume, session: Session) -> Tuple[int, int]:
+    """
+    Uploads all image files which have been associated with a page in the volume to a s3 bucket defined in config.
+    The volume prefix in the bucket is listed once and files already uploaded with the same size and ETag are skipped.
+    The files are uploaded concurrently by S3_UPLOAD_WORKERS threads sharing one s3 client,
+    large files are split into multipart uploads. Completed files are checkpointed so a run that
+    was interrupted continues with the remaining files. Raises if any of the files failed to upload,
+    otherwise returns the number of uploaded and skipped files
+    """
+    s3_client = get_s3_client()
+    bucket = config.get('S3_BUCKET', "")
+    transfer_config = TransferConfig(multipart_threshold=config.get('S3_MULTIPART_THRESHOLD', 64 * 1024 * 1024),
+        multipart_chunksize=config.get('S3_MULTIPART_CHUNKSIZE', 16 * 1024 * 1024),
+        max_concurrency=config.get('S3_MULTIPART_CONCURRENCY', 4))
+    #TODO deal with 200dpi
+    s3_prefix = os.path.join("bitmaps", vol.type, vol.journal.replace(".","_"), vol.volume, "600") + "/"
+    s3_objects = list_s3_objects(s3_client, bucket, s3_prefix)
+    completed = VolumeStageCheckpoint.get_completed(vol.id, CHECKPOINT_STAGE_IMAGES, session)
+    page_names = Page.get_names_from_volume(vol.id, session)
+    uploads = []
+    resumed = 0
     for filename in os.listdir(image_path):
         if filename.endswith(".png") or filename.endswith(".jpg"):
             continue
         base_filename = filename.replace(".tif", "")
-        page = Page.get_from_name_and_journal(base_filename, vol.id, session)
-        if not page:
+        if base_filename not in page_names:
             #Image file not in lists 
             continue
+        if filename in completed:
+            resumed += 1
+            continue
         file_path = os.path.join(image_path, filename)
-        #TODO deal with 200dpi
-        s3_file_path = os.path.join("bitmaps", vol.type, vol.journal.replace(".","_"), vol.volume, "600", filename)
-        s3_bucket.upload_file(file_path, s3_file_path)
+        s3_file_path = s3_prefix + filename
+        uploads.append((file_path, s3_file_path))
+    if resumed:
+        logger.info("Resuming image upload for volume %s, %d files already uploaded", vol.id, resumed)
+
+    errors = []
+    uploaded = 0
+    checkpoint = []
+    with ThreadPoolExecutor(max_workers=config.get('S3_UPLOAD_WORKERS', 16)) as executor:
+        futures = {executor.submit(upload_image_file, s3_client, bucket, file_path, s3_file_path, s3_objects.get(s3_file_path), transfer_config): file_path
+            for file_path, s3_file_path in uploads}
+        for future in as_completed(futures):
+            if future.exception():
+                errors.append(futures[future] + ": " + str(future.exception()))
+                continue
+            if future.result():
+                uploaded += 1
+                record(items=1, bytes=os.path.getsize(futures[future]))
+            checkpoint.append(os.path.basename(futures[future]))
+            if len(checkpoint) >= config.get('STAGE_CHECKPOINT_INTERVAL', 100):
+                save_stage_checkpoint(vol.id, CHECKPOINT_STAGE_IMAGES, checkpoint, session)
+                checkpoint = []
+    if errors:
+        save_stage_checkpoint(vol.id, CHECKPOINT_STAGE_IMAGES, checkpoint, session)
+        raise Exception("Failed to upload %d of %d image files: %s" % (len(errors), len(uploads), ", ".join(sorted(errors))))
+    VolumeStageCheckpoint.clear(vol.id, session, CHECKPOINT_STAGE_IMAGES)
+    return uploaded, len(uploads) - uploaded + resumed
+
+def upload_image_file(s3_client, bucket: str, file_path: str, s3_file_path: str, s3_object: Optional[Tuple[int, str]], transfer_config: TransferConfig) -> bool:
+    """
+    Uploads the file unless the existing s3 object has the same size and ETag. Returns if the file was uploaded
+    """
+    if s3_object:
+        size, etag = s3_object
+        if size == os.path.getsize(file_path) and s3_etag_matches(file_path, etag, transfer_config):
+            return False
+    s3_client.upload_file(file_path, bucket, s3_file_path, Config=transfer_config)
+    return True
+
+def list_s3_objects(s3_client, bucket: str, prefix: str) -> Dict[str, Tuple[int, str]]:
+    """
+    Lists all objects under the prefix and returns their size and ETag by key
+    """
+    s3_objects = {}
+    for response in s3_client.get_paginator("list_objects_v2").paginate(Bucket=bucket, Prefix=prefix):
+        for obj in response.get("Contents", []):
+            s3_objects[obj["Key"]] = (obj["Size"], obj["ETag"].strip('"'))
+    return s3_objects
 
-def index_ocr_files(ocr_path: str, vol: JournalVolume, session: Session):
+def s3_etag_matches(file_path: str, etag: str, transfer_config: TransferConfig) -> bool:
+    """
+    Checks if the file has the ETag of an s3 object. The part size of a multipart object is not stored,
+    only the number of parts, so the ETag is calculated with each part size giving that number of parts out of
+    the configured chunk size, the boto3 default one the earlier uploads used and the size split evenly in whole MiB
+    """
+    if "-" not in etag:
+        return etag == calculate_s3_etag(file_path)
+    n_parts = etag.split("-")[1]
+    if not n_parts.isdigit() or int(n_parts) == 0:
+        return False
+    n_parts = int(n_parts)
+    size = os.path.getsize(file_path)
+    mib = 1024 * 1024
+    part_sizes = [transfer_config.multipart_chunksize, TransferConfig().multipart_chunksize, -(-size // n_parts // mib) * mib]
+    for part_size in sorted(set(part_sizes), key=part_sizes.index):
+        if part_size > 0 and -(-size // part_size) == n_parts and etag == calculate_s3_etag(file_path, part_size):
+            return True
+    return False
+
+def calculate_s3_etag(file_path: str, part_size: Optional[int] = None) -> str:
+    """
+    Calculates the ETag s3 gives a file uploaded in a single part, which is the md5 of the file,
+    or in parts of part_size, which is the md5 of the concatenated part md5s followed by the number of parts
+    """
+    file_md5 = md5()
+    part_md5s = []
+    with open(file_path, "rb") as file:
+        for chunk in iter(lambda: file.read(part_size or 8 * 1024 * 1024), b""):
+            file_md5.update(chunk)
+            part_md5s.append(md5(chunk).digest())
+    if not part_size:
+        return file_md5.hexdigest()
+    return md5(b"".join(part_md5s)).hexdigest() + "-" + str(len(part_md5s))
+
+@lru_cache(maxsize=None)
+def get_s3_client():
+    """
+    Returns the s3 client of this worker process, it's thread safe and reused across volumes
+    """
+    return boto3.client("s3",\
+        aws_access_key_id=config.get("S3_BUCKET_ACCESS_KEY", ""),\
+        aws_secret_access_key=config.get("S3_BUCKET_SECRET_KEY", ""),\
+        config=BotocoreConfig(max_pool_connections=config.get('S3_UPLOAD_WORKERS', 16) * config.get('S3_MULTIPART_CONCURRENCY', 4)))
+
+def generate_volume_json(vol: JournalVolume, session: Session) -> Iterator[bytes]:
+    """
+    Yields the volume metadata serialized as JSON in chunks of SERVICE_DB_PUSH_CHUNK_SIZE pages.
+    The output is byte for byte the same as sending JournalVolume.to_dict() as json with requests
+    but it's built from two queries, one for the page2article pairs and one streaming the pages,
+    instead of loading the articles for each page and holding the full payload in memory
+    """
+    page_table = Page.__table__
+    bibcodes_by_page = Article.get_bibcodes_by_page(vol.id, session)
+
+    chunk_size = config.get('SERVICE_DB_PUSH_CHUNK_SIZE', 500)
+    head = json.dumps({'type': vol.type, 'journal': vol.journal, 'volume': vol.volume, 'pages': []}, allow_nan=False)
+    chunk = [head[:-2]]
+    pages = session.execute(select([page_table.c.id, page_table.c.name, page_table.c.label, page_table.c.format,
+            page_table.c.color_type, page_table.c.page_type, page_table.c.width, page_table.c.height, page_table.c.volume_running_page_num])
+        .where(page_table.c.journal_volume_id == vol.id).order_by(page_table.c.volume_running_page_num)
+        .execution_options(stream_results=True))
+    for n, (page_id, name, label, format, color_type, page_type, width, height, volume_running_page_num) in enumerate(pages):
+        page = {
+            'name': name,
+            'label': label,
+            'format': format,
+            'color_type': color_type.name,
+            'page_type': page_type.name,
+            'width': width,
+            'height': height,
+            'volume_running_page_num': volume_running_page_num,
+            'articles': [{'bibcode': bibcode} for bibcode in bibcodes_by_page.get(page_id, [])],
+        }
+        chunk.append((", " if n > 0 else "") + json.dumps(page, allow_nan=False))
+        if (n + 1) % chunk_size == 0:
+            yield "".join(chunk).encode("utf-8")
+            chunk = []
+    chunk.append(head[-2:])
+    yield "".join(chunk).encode("utf-8")
+
+@lru_cache(maxsize=None)
+def get_service_pool() -> urllib3.PoolManager:
+    """
+    Returns the connection pool of this worker process for the service db push, its connections are kept alive and reused across volumes.
+    urllib3 is used directly since requests doesn't apply timeouts to streamed request bodies
+    """
+    return urllib3.PoolManager(maxsize=config.get('SERVICE_DB_PUSH_POOL_SIZE', 10))
+
+def push_volume_json(vol: JournalVolume, session: Session) -> urllib3.HTTPResponse:
+    """
+    Sends the volume metadata to the service
+    """
+    return push_json(config.get('SERVICE_DB_PUSH_URL', ''), lambda: generate_volume_json(vol, session), vol.id)
+
+def push_volume_batch(batch: List[Tuple[JournalVolume, bytes]]) -> Dict[str, bool]:
+    """
+    Sends the serialized metadata of several volumes as a JSON list in one request to the batch endpoint of the service.
+    The service answers with a JSON list holding one result per volume in the same order, e.g. [{"status": 200}, ...].
+    Returns whether each volume was stored by volume id, raises if the request as a whole failed
+    """
+    def generate_body():
+        yield b"["
+        for n, (vol, data) in enumerate(batch):
+            yield (b", " if n > 0 else b"") + data
+        yield b"]"
+    response = push_json(config.get('SERVICE_DB_BATCH_PUSH_URL', ''), generate_body, "batch of %d volumes" % len(batch))
+    if response.status != 200:
+        raise Exception(response.data)
+    results = json.loads(response.data)
+    if not isinstance(results, list) or len(results) != len(batch):
+        raise Exception("Expected %d volume results but got: %s" % (len(batch), response.data[:200]))
+    return {vol.id: result.get('status') == 200 for (vol, data), result in zip(batch, results)}
+
+def batch_volumes_json(vols: List[JournalVolume], session: Session) -> Iterator[List[Tuple[JournalVolume, bytes]]]:
+    """
+    Serializes the volumes and groups them in batches of at most SERVICE_DB_BATCH_MAX_PAGES pages
+    and SERVICE_DB_BATCH_MAX_BYTES bytes, a volume larger than the limits makes up a batch on its own
+    """
+    max_pages = config.get('SERVICE_DB_BATCH_MAX_PAGES', 20000)
+    max_bytes = config.get('SERVICE_DB_BATCH_MAX_BYTES', 20 * 1024 * 1024)
+    page_counts = Page.get_page_counts([vol.id for vol in vols], session)
+    batch = []
+    batch_pages = 0
+    batch_bytes = 0
+    for vol in vols:
+        data = b"".join(generate_volume_json(vol, session))
+        n_pages = page_counts.get(vol.id, 0)
+        if batch and (batch_pages + n_pages > max_pages or batch_bytes + len(data) > max_bytes):
+            yield batch
+            batch = []
+            batch_pages = 0
+            batch_bytes = 0
+        batch.append((vol, data))
+        batch_pages += n_pages
+        batch_bytes += len(data)
+    if batch:
+        yield batch
+
+def push_json(url: str, generate_body: Callable[[], Iterable[bytes]], description: str) -> urllib3.HTTPResponse:
+    """
+    Sends a streamed JSON body to the service through the pooled connections, optionally gzip compressed.
+    Connection errors, timeouts and 5xx responses are retried SERVICE_DB_PUSH_MAX_RETRIES times with exponential backoff,
+    the body is generated again for each attempt since a streamed body can't be replayed
+    """
+    headers = {'Authorization': 'Bearer:' + config.get('SERVICE_AUTHENTICATION_TOKEN', ''), 'Content-Type': 'application/json'}
+    use_gzip = config.get('SERVICE_DB_PUSH_GZIP', False)
+    if use_gzip:
+        headers['Content-Encoding'] = 'gzip'
+    timeout = urllib3.Timeout(connect=config.get('SERVICE_DB_PUSH_CONNECT_TIMEOUT', 10), read=config.get('SERVICE_DB_PUSH_READ_TIMEOUT', 300))
+    max_retries = config.get('SERVICE_DB_PUSH_MAX_RETRIES', 3)
+    backoff = config.get('SERVICE_DB_PUSH_INITIAL_BACKOFF', 1)
+    for attempt in range(max_retries + 1):
+        body = generate_body()
+        if use_gzip:
+            body = gzip_chunks(body)
+        body = count_bytes(body)
+        try:
+            response = get_service_pool().urlopen('PUT', url, body=body, headers=headers, chunked=True, timeout=timeout, retries=False)
+            if response.status < 500 or attempt == max_retries:
+                return response
+            logger.warning("Service db push of %s failed with status %d, retrying", description, response.status)
+        except urllib3.exceptions.HTTPError as e:
+            if attempt == max_retries:
+                raise
+            logger.warning("Service db push of %s failed due to: %s, retrying", description, e)
+        time.sleep(backoff * 2 ** attempt)
+
+def count_bytes(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    for chunk in chunks:
+        record(bytes=len(chunk))
+        yield chunk
+
+def gzip_chunks(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    """
+    Compresses the chunks as a single gzip stream
+    """
+    compressor = zlib.compressobj(wbits=zlib.MAX_WBITS | 16)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+def index_ocr_files(ocr_path: str, vol: JournalVolume, session: Session) -> Tuple[int, int]:
     """
     Loops through all ocr files to the volume and adds them to an Open Search index.
+    The documents are sent through the bulk api in chunks, items rejected by Open Search
+    are retried with backoff. Indexed pages are checkpointed so a run that was interrupted
+    keeps the documents already indexed and only sends the remaining pages.
+    Returns the number of indexed and failed documents
     """
 
     opensearch = opensearchpy.OpenSearch(config.get("OPEN_SEARCH_URL", ""))
@@ -207,9 +723,57 @@ def index_ocr_files(ocr_path: str, vol: JournalVolume, session: Session):
              }
         }
     }
-    opensearch.delete_by_query(index=config.get("OPEN_SEARCH_INDEX", ""), body=query)
+    completed = VolumeStageCheckpoint.get_completed(vol.id, CHECKPOINT_STAGE_OCR, session)
+    if completed:
+        logger.info("Resuming ocr indexing for volume %s, %d pages already indexed", vol.id, len(completed))
+    else:
+        opensearch.delete_by_query(index=config.get("OPEN_SEARCH_INDEX", ""), body=query)
+    indexed = len(completed)
+    failed = 0
+    checkpoint = []
+    for ok, item in opensearchpy.helpers.streaming_bulk(opensearch, generate_ocr_documents(ocr_path, vol, session, completed),
+            chunk_size=config.get("OPEN_SEARCH_BULK_CHUNK_SIZE", 500),
+            max_chunk_bytes=config.get("OPEN_SEARCH_BULK_MAX_BYTES", 10 * 1024 * 1024),
+            max_retries=config.get("OPEN_SEARCH_BULK_MAX_RETRIES", 3),
+            initial_backoff=config.get("OPEN_SEARCH_BULK_INITIAL_BACKOFF", 2),
+            raise_on_error=False):
+        if ok:
+            indexed += 1
+            record(items=1)
+            checkpoint.append(item['index']['_id'])
+            if len(checkpoint) >= config.get('STAGE_CHECKPOINT_INTERVAL', 100):
+                save_stage_checkpoint(vol.id, CHECKPOINT_STAGE_OCR, checkpoint, session)
+                checkpoint = []
+        else:
+            failed += 1
+            logger.error("Failed to index ocr page in volume %s: %s", vol.id, item)
+    if failed:
+        save_stage_checkpoint(vol.id, CHECKPOINT_STAGE_OCR, checkpoint, session)
+    else:
+        VolumeStageCheckpoint.clear(vol.id, session, CHECKPOINT_STAGE_OCR)
+    return indexed, failed
+
+def save_stage_checkpoint(journal_volume_id: str, stage: str, items: List[str], session: Session):
+    """
+    Stores the completed files or pages of the stage and commits them right away to survive the worker dying
+    """
+    if not items:
+        return
+    session.add_all([VolumeStageCheckpoint(journal_volume_id, stage, item) for item in items])
+    session.commit()
+
+def generate_ocr_documents(ocr_path: str, vol: JournalVolume, session: Session, completed: Set[str] = frozenset()) -> Iterator[dict]:
+    """
+    Yields a bulk index action with the ocr text and page metadata for each page in the volume except the completed ones.
+    The page id is used as document id so a page is only indexed once. The pages are read as records and
+    the bibcodes of their articles with one query, instead of loading the Page objects and their articles
+    """
     ocr_list = os.listdir(ocr_path)
-    for page in Page.get_all_from_volume(vol.id, session):
+    bibcodes = Article.get_bibcodes_by_page(vol.id, session)
+    project = get_project_from_journal_name(vol.journal)
+    for page in Page.get_records_from_volume(vol.id, session):
+        if page.id in completed:
+            continue
         ocr_filename = page.name + ".txt"
         page_text = ''
         if ocr_filename not in ocr_list:
@@ -217,14 +781,12 @@ def index_ocr_files(ocr_path: str, vol: JournalVolume, session: Session):
         else:
             with open(os.path.join(ocr_path, ocr_filename)) as file:    
                 page_text = html.unescape(file.read())
-        articles = []
-        for article in page.articles:
-            articles.append(article.bibcode)
+                record(bytes=os.fstat(file.fileno()).st_size)
         doc = {
             'page_id': page.id,
             'volume_id': vol.id,
             'text':  page_text,
-            'article_bibcodes': articles,
+            'article_bibcodes': bibcodes.get(page.id, []),
             'journal': vol.journal,
             'volume': vol.volume,
             'volume_int': vol.volume,
@@ -232,9 +794,9 @@ def index_ocr_files(ocr_path: str, vol: JournalVolume, session: Session):
             'page_number': page.volume_running_page_num,
             'page_label': page.label,
             'page_color': page.color_type.name,
-            'project': get_project_from_journal_name(page.journal_volume.journal)
+            'project': project
         }
-        opensearch.index(index=config.get("OPEN_SEARCH_INDEX", ""), body=doc)
+        yield {'_index': config.get("OPEN_SEARCH_INDEX", ""), '_id': page.id, '_source': doc}
         
 def get_project_from_journal_name(journal_name:str):
     historical_journals = ['BuAst', 'OSUC.', 'BuChr', 'DurOO', 'POPot', 'GOAM.', 'PGenA', 'JBAA.', 'AnHar', 'ViHei', 'AnGVP', 'MiGoe', 'PA...', 'PSprO', 'MMAAR', 'VeLdn',
@@ -257,28 +819,69 @@ def get_project_from_journal_name(journal_name:str):
 
 def identify_journals(input_folder_path : str) -> Iterable[JournalVolume]:
     """
-    Loops through the base folder to identify all journal volumnes that exists
+    Loops through the base folder to identify all journal volumnes that exists.
+    Each directory is scanned once and the list files are grouped by volume in a single pass
+    """
+    for type, journal in list_journals(input_folder_path):
+        yield from identify_journal_volumes(input_folder_path, type, journal)
+
+def list_journals(input_folder_path : str) -> List[Tuple[str, str]]:
+    """
+    Lists the type and name of all journal directories in the base folder
     """
     list_path = os.path.join(input_folder_path, config.get('TOP_SUB_DIR', ''))
-    for type in os.listdir(list_path):
-        type_path = os.path.join(list_path, type)
-        if not os.path.isdir(type_path):
+    journals = []
+    for type_entry in scan_dir(list_path):
+        if not type_entry.is_dir():
             continue
-        for journal in os.listdir(type_path):
-            journal_path = os.path.join(type_path, journal) 
-            if not os.path.isdir(journal_path):
-                continue
-            for file in os.listdir(journal_path):
-                if file.endswith(".top"):
-                    volume = parse_volume_from_top_file(file, journal)
-                    vol = JournalVolume(type, journal, volume)
-                    try:
-                        vol.file_hash = hash_volume(input_folder_path, vol)
-                    except Exception as e:
-                        vol.status = VolumeStatus.Error
-                        vol.status_message = "Error checking file hash on top file: " +  os.path.join(journal_path,file) + " due to " + str(e)
-                        logger.error(vol.status_message)
-                    yield vol
+        for journal_entry in scan_dir(type_entry.path):
+            if journal_entry.is_dir():
+                journals.append((type_entry.name, journal_entry.name))
+    return journals
+
+def identify_journal_volumes(input_folder_path : str, type : str, journal : str) -> Iterable[JournalVolume]:
+    """
+    Identifies all volumes of a journal from its .top files and calculates their file manifest and hash
+    """
+    list_entries = scan_dir(os.path.join(input_folder_path, config.get('TOP_SUB_DIR', ''), type, journal))
+    top_entries = [entry for entry in list_entries if entry.name.endswith(".top")]
+    volumes = [parse_volume_from_top_file(entry.name, journal) for entry in top_entries]
+    list_entries_by_volume = group_list_files_by_volume(list_entries, volumes)
+    for entry, volume in zip(top_entries, volumes):
+        vol = JournalVolume(type, journal, volume)
+        try:
+            vol.file_manifest = build_volume_manifest(input_folder_path, vol, list_entries_by_volume[volume])
+            vol.file_hash = hash_volume_manifest(vol.file_manifest)
+        except Exception as e:
+            vol.status = VolumeStatus.Error
+            vol.status_message = "Error checking file hash on top file: " +  entry.path + " due to " + str(e)
+            logger.error(vol.status_message)
+        yield vol
+
+def scan_dir(path: str) -> List[os.DirEntry]:
+    with os.scandir(path) as entries:
+        return list(entries)
+
+def group_list_files_by_volume(entries: List[os.DirEntry], volumes: List[str]) -> Dict[str, List[os.DirEntry]]:
+    """
+    Groups the list files by each volume whose name is part of the file name.
+    Instead of testing every volume against every file, each file name is cut into
+    windows of the volume name lengths which are looked up in a set
+    """
+    volumes_by_length = {}
+    for volume in volumes:
+        volumes_by_length.setdefault(len(volume), set()).add(volume)
+    entries_by_volume = {volume: [] for volume in volumes}
+    for entry in entries:
+        matched_volumes = set()
+        for length, candidates in volumes_by_length.items():
+            for start in range(len(entry.name) - length + 1):
+                window = entry.name[start:start + length]
+                if window in candidates:
+                    matched_volumes.add(window)
+        for volume in matched_volumes:
+            entries_by_volume[volume].append(entry)
+    return entries_by_volume
 
 def parse_volume_from_top_file(filename : str, journal : str):
     """ Parses out the volume name from the top file"""
@@ -286,30 +889,67 @@ def parse_volume_from_top_file(filename : str, journal : str):
 
 def hash_volume(base_path: str, vol: JournalVolume) -> str:
     """
-    Calculates a md5 hash from the change dates and name of all the associated images and files to the volume  
+    Calculates a md5 hash from the file manifest of all the associated images and files to the volume
     """
-    vol_hash = ""
-    list_path = os.path.join(base_path, config.get('TOP_SUB_DIR', '') ,vol.type, vol.journal)
-    for file in sorted(os.listdir(list_path)):
-        if str(vol.volume) in file:
-            file_path = os.path.join(list_path, file)
-            modified_time = os.path.getmtime(file_path)
-            vol_hash = md5((vol_hash + str(modified_time) + file).encode("utf-8")).hexdigest()
-    
-    image_path = os.path.join(base_path, config.get('BITMAP_SUB_DIR', '') ,vol.type, vol.journal, vol.volume, "600")
-    for file in sorted(os.listdir(image_path)):
-        file_path = os.path.join(image_path, file)
-        modified_time = os.path.getmtime(file_path)
-        vol_hash = md5((vol_hash + str(modified_time) + file).encode("utf-8")).hexdigest()
+    return hash_volume_manifest(build_volume_manifest(base_path, vol))
 
+def build_volume_manifest(base_path: str, vol: JournalVolume, list_entries: List[os.DirEntry] = None) -> Dict[str, Dict[str, list]]:
+    """
+    Lists the name, size and change date of all list, bitmap and ocr files associated to the volume.
+    With MANIFEST_CHECKSUM set the md5 of each file is added as well.
+    The list files of the volume can be passed in if the list directory has already been scanned
+    """
+    if list_entries is None:
+        list_path = os.path.join(base_path, config.get('TOP_SUB_DIR', '') ,vol.type, vol.journal)
+        list_entries = [entry for entry in scan_dir(list_path) if str(vol.volume) in entry.name]
+    image_path = os.path.join(base_path, config.get('BITMAP_SUB_DIR', '') ,vol.type, vol.journal, vol.volume, "600")
     ocr_path = os.path.join(base_path, config.get('OCR_SUB_DIR', '') ,vol.type, vol.journal, vol.volume)
-    for file in sorted(os.listdir(ocr_path)):
-        file_path = os.path.join(ocr_path, file)
-        modified_time = os.path.getmtime(file_path)
-        vol_hash = md5((vol_hash + str(modified_time) + file).encode("utf-8")).hexdigest()
-        
+    return {
+        'lists': manifest_files(list_entries),
+        'bitmaps': manifest_files(scan_dir(image_path)),
+        'ocr': manifest_files(scan_dir(ocr_path)),
+    }
+
+def manifest_files(entries: List[os.DirEntry]) -> Dict[str, list]:
+    manifest = {}
+    for entry in sorted(entries, key=lambda entry: entry.name):
+        stat = entry.stat()
+        file_entry = [stat.st_size, stat.st_mtime]
+        if config.get('MANIFEST_CHECKSUM', False):
+            file_entry.append(md5_file(entry.path))
+        manifest[entry.name] = file_entry
+    return manifest
+
+def md5_file(file_path: str) -> str:
+    file_md5 = md5()
+    with open(file_path, "rb") as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b""):
+            file_md5.update(chunk)
+    return file_md5.hexdigest()
+
+def hash_volume_manifest(manifest: Dict[str, Dict[str, list]]) -> str:
+    return md5(json.dumps(manifest, sort_keys=True).encode("utf-8")).hexdigest()
+
+def hash_volume_manifest_legacy(manifest: Dict[str, Dict[str, list]]) -> str:
+    """
+    Calculates the hash volumes had before their manifest was stored, a md5 chained over the change date
+    and name of the list, bitmap and ocr files in that order, from the names and change dates in the manifest
+    """
+    vol_hash = ""
+    for category in ['lists', 'bitmaps', 'ocr']:
+        for file, file_entry in sorted(manifest.get(category, {}).items()):
+            vol_hash = md5((vol_hash + str(file_entry[1]) + file).encode("utf-8")).hexdigest()
     return vol_hash
 
+def diff_volume_manifest(old_manifest: Optional[Dict[str, Dict[str, list]]], new_manifest: Dict[str, Dict[str, list]]) -> Set[str]:
+    """
+    Returns which file categories (lists, bitmaps and ocr) differ between the manifests.
+    Volumes without a stored manifest are considered changed in all categories
+    """
+    if not old_manifest:
+        return set(new_manifest.keys())
+    return {category for category in new_manifest if old_manifest.get(category) != new_manifest[category]}
+
 def set_ingestion_error_status(session: Session, journal_volume_id: str, error_msg: str):
     """
     Sets error status and error message on the failed volume
@@ -323,9 +963,16 @@ def set_ingestion_error_status(session: Session, journal_volume_id: str, error_m
     except Exception as e:
         logger.error("Failed setting error on volume: %s due to: %s", str(journal_volume_id), e)
 
+def add_volume_status_summary(vol: JournalVolume, summary: str):
+    """
+    Appends the summary of a completed stage to the status message of the volume. The message is appended by the
+    UPDATE itself since the stages run concurrently in their own sessions and would overwrite each other's summary
+    """
+    message = JournalVolume.status_message
+    vol.status_message = case([(or_(message == None, message == ""), summary)], else_=message + "; " + summary)
+
 def set_correct_volume_status(vol: JournalVolume, session: Session):
     if vol.status != VolumeStatus.Error:
-        vol.status_message = ""
         if vol.bucket_uploaded and vol.db_done and vol.db_uploaded and vol.ocr_uploaded:
             vol.status = VolumeStatus.Done
         session.add(vol)
@@ -0,0 +1,115 @@
+import os
+import time
+import threading
+from contextlib import contextmanager
+from typing import Iterator
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import QueuePool
+from ADSScanExplorerPipeline.models import VolumeStageMetrics
+from adsputils import setup_logging, load_config
+
+# ============================= INITIALIZATION ==================================== #
+
+proj_home = os.path.realpath(os.path.join(os.path.dirname(__file__), '../'))
+config = load_config(proj_home=proj_home)
+logger = setup_logging(__name__, proj_home=proj_home,
+                        level=config.get('LOGGING_LEVEL', 'INFO'),
+                        attach_stdout=config.get('LOG_STDOUT', False))
+
+# Metrics of the stage running in the current thread
+_active = threading.local()
+
+# Prometheus metric name and help text of the summed stage totals, in the column order of VolumeStageMetrics.get_stage_totals
+PROMETHEUS_METRICS = [
+    ('scan_pipeline_stage_runs_total', 'Number of completed stage runs'),
+    ('scan_pipeline_stage_seconds_total', 'Time spent in completed stage runs'),
+    ('scan_pipeline_stage_items_total', 'Pages, articles, files or documents processed by completed stage runs'),
+    ('scan_pipeline_stage_bytes_total', 'Bytes read or sent by completed stage runs'),
+    ('scan_pipeline_stage_queries_total', 'SQL statements executed by completed stage runs'),
+    ('scan_pipeline_stage_checkout_wait_seconds_total', 'Time completed stage runs waited for a pooled db connection'),
+]
+
+# ============================= FUNCTIONS ========================================= #
+
+class StageMetrics:
+    """Counters of a single stage run for a volume"""
+
+    def __init__(self, journal_volume_id: str, stage: str):
+        self.journal_volume_id = journal_volume_id
+        self.stage = stage
+        self.items = 0
+        self.bytes = 0
+        self.queries = 0
+        self.checkout_wait = 0.0
+        self.duration = 0.0
+
+    def rate(self, count: int) -> float:
+        return count / self.duration if self.duration > 0 else 0.0
+
+@event.listens_for(Engine, "before_cursor_execute")
+def count_statement(conn, cursor, statement, parameters, context, executemany):
+    metrics = getattr(_active, 'metrics', None)
+    if metrics:
+        metrics.queries += 1
+
+def record(items: int = 0, bytes: int = 0):
+    """
+    Adds processed items and bytes to the stage running in the current thread, if any
+    """
+    metrics = getattr(_active, 'metrics', None)
+    if metrics:
+        metrics.items += items
+        metrics.bytes += bytes
+
+class TimedQueuePool(QueuePool):
+    """
+    Queue pool adding the time each checkout waited for a connection, including opening or pinging it,
+    to the stage running in the current thread and logging checkouts slower than SQLALCHEMY_POOL_SLOW_CHECKOUT
+    """
+
+    def connect(self):
+        start = time.perf_counter()
+        try:
+            return super().connect()
+        finally:
+            wait = time.perf_counter() - start
+            metrics = getattr(_active, 'metrics', None)
+            if metrics:
+                metrics.checkout_wait += wait
+            if wait > config.get('SQLALCHEMY_POOL_SLOW_CHECKOUT', 1.0):
+                logger.warning("Waited %.2fs for a db connection, %s", wait, self.status())
+
+@contextmanager
+def measure_stage(journal_volume_id: str, stage: str, session: Session) -> Iterator[StageMetrics]:
+    """
+    Measures the duration and the SQL statements of the stage run in the current thread while collecting
+    the items and bytes reported through record(). The metrics of a completed run are logged and added to the session
+    """
+    metrics = StageMetrics(journal_volume_id, stage)
+    previous = getattr(_active, 'metrics', None)
+    _active.metrics = metrics
+    start = time.perf_counter()
+    try:
+        yield metrics
+    finally:
+        metrics.duration = time.perf_counter() - start
+        _active.metrics = previous
+    logger.info("Stage %s for volume %s took %.2fs: %d items (%.1f/s), %d bytes (%.1f/s), %d queries, %.2fs waiting for connections", stage, journal_volume_id,
+        metrics.duration, metrics.items, metrics.rate(metrics.items), metrics.bytes, metrics.rate(metrics.bytes), metrics.queries, metrics.checkout_wait)
+    if config.get('STAGE_METRICS', True):
+        session.add(VolumeStageMetrics(journal_volume_id, stage, metrics.duration, metrics.items, metrics.bytes, metrics.queries, metrics.checkout_wait))
+
+def format_prometheus(session: Session) -> str:
+    """
+    Renders the totals of the stored stage metrics in the Prometheus text exposition format
+    """
+    totals = VolumeStageMetrics.get_stage_totals(session)
+    lines = []
+    for n, (name, help_text) in enumerate(PROMETHEUS_METRICS):
+        lines.append("# HELP %s %s" % (name, help_text))
+        lines.append("# TYPE %s counter" % name)
+        for row in totals:
+            lines.append('%s{stage="%s"} %s' % (name, row[0], row[n + 1] or 0))
+    return "\n".join(lines) + "\n"
@@ -1,9 +1,10 @@
 from __future__ import annotations
 import uuid 
-from typing import List
+from typing import Dict, List, Set
+from datetime import datetime
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Column, ForeignKey, Integer, String, Boolean, Table, UniqueConstraint, Enum, Index
-from sqlalchemy.orm import relationship, Session
+from sqlalchemy import Column, ForeignKey, Integer, BigInteger, Float, String, Boolean, Table, UniqueConstraint, Enum, Index, JSON, func, or_
+from sqlalchemy.orm import relationship, Session, defer, object_session, selectinload
 from sqlalchemy_utils.models import Timestamp
 
 from ADSScanExplorerPipeline.exceptions import PageNameException
@@ -35,14 +36,32 @@ class PageType(enum.Enum):
 
     @classmethod
     def page_type_from_separator(cls, separator:str):
-        return {
-            '.': cls.Normal,
-            ',': cls.FrontMatter,
-            ':': cls.BackMatter,
-            'I': cls.Insert,
-            'P': cls.Plate,
-            'M': cls.Normal,
-        }[separator]
+        return SEPARATOR_PAGE_TYPES[separator]
+
+# Page type of the separator at position 8 of the page name
+SEPARATOR_PAGE_TYPES = {
+    '.': PageType.Normal,
+    ',': PageType.FrontMatter,
+    ':': PageType.BackMatter,
+    'I': PageType.Insert,
+    'P': PageType.Plate,
+    'M': PageType.Normal,
+}
+# Label suffix of the last 3 digits of the page name, names with other characters fall back to int() to get the same labels
+PAGE_END_NUMBER_LABELS = {"%03d" % n: "-%d" % n if n else "" for n in range(1000)}
+
+def page_label_from_name(name: str) -> str:
+    """Label of the 11 letter page name, e.g. 255 for 0000255.000, 255-1 for 0000255.001 and A-255 for A000255.000"""
+    first_num = name[1:7]
+    end_label = PAGE_END_NUMBER_LABELS.get(name[8:11])
+    if end_label is not None and first_num.isascii() and first_num.isdigit():
+        label = (first_num.lstrip("0") or "0") + end_label
+    else:
+        end_num = int(name[8:11])
+        label = str(int(first_num)) + ("-" + str(end_num) if end_num > 0 else "")
+    if name[0] != "0":
+        label = name[0] + "-" + label
+    return label
 
 class JournalVolume(Base, Timestamp):
     
@@ -53,7 +72,8 @@ class JournalVolume(Base, Timestamp):
         self.id = self.journal +  self.volume
 
     __tablename__ = 'journal_volume'
-    __table_args__ = (Index('volume_index', "journal", "volume"), )
+    __table_args__ = (UniqueConstraint("journal", "volume", name="journal_volume_journal_volume_key"), Index('volume_index', "journal", "volume"),
+        Index('volume_type_index', "type", "journal", "volume", unique=True), Index('volume_status_index', "status"))
 
     id = Column(String, primary_key=True)
     journal = Column(String)
@@ -66,8 +86,7 @@ class JournalVolume(Base, Timestamp):
     bucket_uploaded = Column(Boolean, default=False)
     ocr_uploaded = Column(Boolean, default=False)
     file_hash = Column(String)
-
-    UniqueConstraint(journal, volume)
+    file_manifest = Column(JSON)
 
     articles = relationship(
         'Article', primaryjoin='JournalVolume.id==Article.journal_volume_id', back_populates='journal_volume')
@@ -78,13 +97,29 @@ class JournalVolume(Base, Timestamp):
     def get_from_obj(cls, vol: JournalVolume, session: Session) -> JournalVolume:
         return session.query(cls).filter(cls.type == vol.type, cls.journal == vol.journal, cls.volume == vol.volume).one_or_none()
     
+    @classmethod
+    def get_all_from_journal(cls, type: str, journal: str, session: Session) -> List[JournalVolume]:
+        """The file manifest is only loaded when accessed since it's only needed for changed volumes"""
+        return session.query(cls).options(defer(cls.file_manifest)).filter(cls.type == type, cls.journal == journal).all()
+
     @classmethod
     def get(cls, id: str, session: Session) -> JournalVolume:
         return session.query(cls).filter(cls.id == id).one_or_none()
     
     @classmethod
-    def get_to_be_processed(cls, session: Session) -> List[JournalVolume]:
-        return session.query(cls).filter(cls.status.in_([VolumeStatus.New, VolumeStatus.Update, VolumeStatus.Error])).all()
+    def get_all_from_ids(cls, ids: List[str], session: Session) -> List[JournalVolume]:
+        return session.query(cls).filter(cls.id.in_(ids)).order_by(cls.id).all()
+
+    @classmethod
+    def get_to_be_processed(cls, session: Session, stuck_since: datetime = None, ids: List[str] = None) -> List[JournalVolume]:
+        """New, updated and failed volumes, and with stuck_since the ones in Processing not updated since then, optionally only the given ids"""
+        query = session.query(cls)
+        if ids is not None:
+            query = query.filter(cls.id.in_(ids))
+        if stuck_since is None:
+            return query.filter(cls.status.in_([VolumeStatus.New, VolumeStatus.Update, VolumeStatus.Error])).all()
+        return query.filter(cls.status.in_([VolumeStatus.New, VolumeStatus.Update, VolumeStatus.Error, VolumeStatus.Processing]),
+            or_(cls.status != VolumeStatus.Processing, cls.updated < stuck_since)).all()
 
     @classmethod
     def get_all(cls, session: Session) -> List[JournalVolume]:
@@ -101,16 +136,24 @@ class JournalVolume(Base, Timestamp):
         raise ValueError
         
 
+    @classmethod
+    def count_in_flight(cls, since: datetime, session: Session) -> int:
+        """Volumes being processed that have been updated since the given time, older ones are considered stuck"""
+        return session.query(cls).filter(cls.status == VolumeStatus.Processing, cls.updated >= since).count()
+
     @classmethod
     def get_errors(cls, session: Session) -> JournalVolume:
         return session.query(cls).filter(cls.status == VolumeStatus.Error).all()
     
     def to_dict(self):
+        #Pages of a stored volume are loaded with their articles in two queries instead of one query per page
+        session = object_session(self)
+        pages = Page.get_all_from_volume_with_articles(self.id, session) if session else self.pages
         return {
             'type': self.type,
             'journal': self.journal,
             'volume': self.volume,
-            'pages': [page.to_dict() for page in self.pages]
+            'pages': [page.to_dict() for page in pages]
         }
 
 page_article_association_table = Table('page2article', Base.metadata,
@@ -140,13 +183,29 @@ class Article(Base, Timestamp):
             article = Article(bibcode, journal_volume_id)
         return article
 
+    @classmethod
+    def get_all_from_volume(cls, volume_id: str, session: Session) -> List[Article]:
+        return session.query(cls).filter(cls.journal_volume_id == volume_id).all()
+
+    @classmethod
+    def get_bibcodes_by_page(cls, volume_id: str, session: Session) -> Dict[str, List[str]]:
+        """Returns the bibcodes of the articles of the volume by page id with a single query"""
+        link_table = page_article_association_table
+        bibcodes = {}
+        for page_id, bibcode in session.query(link_table.c.page_id, cls.bibcode).select_from(link_table) \
+                .join(cls, cls.bibcode == link_table.c.article_id).filter(cls.journal_volume_id == volume_id).order_by(cls.bibcode):
+            bibcodes.setdefault(page_id, []).append(bibcode)
+        return bibcodes
+
     @classmethod
     def delete_all_from_volume(cls, journal_volume_id: str, session: Session):
         return session.query(cls).filter(cls.journal_volume_id == journal_volume_id).delete()
 
 class Page(Base, Timestamp):
     __tablename__ = 'page'
-    __table_args__ = (Index('page_volume_index', "journal_volume_id"), Index('page_name_index', "name"))
+    __table_args__ = (UniqueConstraint("journal_volume_id", "name", name="page_journal_volume_id_name_key"),
+        UniqueConstraint("journal_volume_id", "volume_running_page_num", name="page_journal_volume_id_volume_running_page_num_key"),
+        Index('page_volume_index', "journal_volume_id"), Index('page_name_index', "name"))
 
     def __init__(self, name, journal_volume_id):
         self.name = name
@@ -167,17 +226,32 @@ class Page(Base, Timestamp):
     journal_volume_id = Column(String, ForeignKey(JournalVolume.id))
     volume_running_page_num = Column(Integer)
     
-    articles = relationship('Article', secondary=page_article_association_table, back_populates='pages')
+    articles = relationship('Article', secondary=page_article_association_table, back_populates='pages', order_by='Article.bibcode')
     journal_volume = relationship('JournalVolume', back_populates='pages')
 
-    UniqueConstraint(journal_volume_id, volume_running_page_num)
-    UniqueConstraint(journal_volume_id, name)
-
-
     @classmethod
     def get_all_from_volume(cls, volume_id: uuid.UUID, session: Session) -> List[Page]:
         return session.query(cls).filter(cls.journal_volume_id == volume_id).all()
-    
+
+    @classmethod
+    def get_all_from_volume_with_articles(cls, volume_id: str, session: Session) -> List[Page]:
+        """Loads the pages of the volume in page order with their articles selected in one more query"""
+        return session.query(cls).options(selectinload(cls.articles)).filter(cls.journal_volume_id == volume_id).order_by(cls.volume_running_page_num).all()
+
+    @classmethod
+    def get_names_from_volume(cls, volume_id: str, session: Session) -> Set[str]:
+        return set(name for name, in session.query(cls.name).filter(cls.journal_volume_id == volume_id))
+
+    @classmethod
+    def get_records_from_volume(cls, volume_id: str, session: Session) -> List[PageRecord]:
+        """Loads the pages of the volume as plain column rows without creating Page objects"""
+        query = session.query(*[getattr(cls, field) for field in PageRecord.__slots__]).filter(cls.journal_volume_id == volume_id)
+        return [PageRecord.from_row(row) for row in query.order_by(cls.volume_running_page_num)]
+
+    @classmethod
+    def get_page_counts(cls, volume_ids: List[str], session: Session) -> Dict[str, int]:
+        return dict(session.query(cls.journal_volume_id, func.count(cls.id)).filter(cls.journal_volume_id.in_(volume_ids)).group_by(cls.journal_volume_id).all())
+
     @classmethod
     def get_from_name_and_journal(cls, name: str, volume_id: uuid.UUID, session: Session) -> Page:
         return session.query(cls).filter(cls.name == name, cls.journal_volume_id == volume_id).first()
@@ -207,15 +281,7 @@ class Page(Base, Timestamp):
             raise PageNameException("Page name should consist of exactly 11 letters")
         
         self.page_type = PageType.page_type_from_separator(name[7])
-        
-        first_num = int(name[1:7])
-        end_num = int(name[8:11])
-        if end_num > 0:
-            self.label = str(first_num) + "-" + str(end_num)
-        else:
-                self.label = str(first_num)
-        if name[0] != "0":
-                self.label = name[0] + "-" + self.label
+        self.label = page_label_from_name(name)
 
     def to_dict(self):
         return {
@@ -229,3 +295,113 @@ class Page(Base, Timestamp):
             'volume_running_page_num': self.volume_running_page_num,
             'articles': [{'bibcode':article.bibcode} for article in self.articles],
         }
+
+class PageRecord:
+    """Page parsed from the list and image files or read as plain columns, without the ORM state of a Page.
+    The slots are in the column order of the page rows, Page objects are only created to store it through the ORM"""
+    __slots__ = ('id', 'name', 'label', 'format', 'color_type', 'page_type', 'width', 'height', 'journal_volume_id', 'volume_running_page_num')
+
+    def __init__(self, name, journal_volume_id, page_type=None):
+        if len(name) != 11:
+            raise PageNameException("Page name should consist of exactly 11 letters")
+        self.id = journal_volume_id + "_" + name
+        self.name = name
+        self.label = page_label_from_name(name)
+        self.format = 'image/tiff'
+        self.color_type = PageColor.BW
+        self.page_type = page_type or PageType.page_type_from_separator(name[7])
+        self.width = None
+        self.height = None
+        self.journal_volume_id = journal_volume_id
+        self.volume_running_page_num = None
+
+    @classmethod
+    def from_row(cls, row: tuple) -> PageRecord:
+        record = cls.__new__(cls)
+        for field, value in zip(cls.__slots__, row):
+            setattr(record, field, value)
+        return record
+
+    def to_row(self) -> tuple:
+        """Page row without the timestamps with the enums given by name"""
+        return (self.id, self.name, self.label, self.format, self.color_type.name, self.page_type.name,
+            self.width, self.height, self.journal_volume_id, self.volume_running_page_num)
+
+    def to_page(self) -> Page:
+        page = Page(self.name, self.journal_volume_id)
+        for field in self.__slots__:
+            setattr(page, field, getattr(self, field))
+        return page
+
+class ArticleRecord:
+    """Article parsed from the .dat file with the page records it links to, Article objects are only created to store it through the ORM"""
+    __slots__ = ('bibcode', 'journal_volume_id', 'start_page_number', 'pages')
+
+    def __init__(self, bibcode, journal_volume_id):
+        self.bibcode = bibcode
+        self.journal_volume_id = journal_volume_id
+        self.start_page_number = None
+        self.pages = []
+
+    def to_row(self) -> tuple:
+        return (self.bibcode, self.journal_volume_id, self.start_page_number)
+
+    def to_article(self, pages: Dict[str, Page]) -> Article:
+        """Creates the Article linked to the Page objects of its page records, given by page name"""
+        article = Article(self.bibcode, self.journal_volume_id)
+        article.start_page_number = self.start_page_number
+        article.pages = [pages[page.name] for page in self.pages]
+        return article
+
+class VolumeStageCheckpoint(Base):
+    """Files or pages a stage has completed for a volume, so an interrupted run can continue where it stopped"""
+    __tablename__ = 'volume_stage_checkpoint'
+
+    def __init__(self, journal_volume_id, stage, item):
+        self.journal_volume_id = journal_volume_id
+        self.stage = stage
+        self.item = item
+
+    journal_volume_id = Column(String, ForeignKey(JournalVolume.id), primary_key=True)
+    stage = Column(String, primary_key=True)
+    item = Column(String, primary_key=True)
+
+    @classmethod
+    def get_completed(cls, journal_volume_id: str, stage: str, session: Session) -> Set[str]:
+        return set(item for item, in session.query(cls.item).filter(cls.journal_volume_id == journal_volume_id, cls.stage == stage))
+
+    @classmethod
+    def clear(cls, journal_volume_id: str, session: Session, stage: str = None):
+        query = session.query(cls).filter(cls.journal_volume_id == journal_volume_id)
+        if stage:
+            query = query.filter(cls.stage == stage)
+        return query.delete()
+
+class VolumeStageMetrics(Base, Timestamp):
+    """Duration, processed items, bytes, SQL statements and connection checkout wait of a completed stage run for a volume"""
+    __tablename__ = 'volume_stage_metrics'
+    __table_args__ = (Index('volume_stage_metrics_stage_index', "stage"), )
+
+    def __init__(self, journal_volume_id, stage, duration, items, bytes, queries, checkout_wait=0.0):
+        self.journal_volume_id = journal_volume_id
+        self.stage = stage
+        self.duration = duration
+        self.items = items
+        self.bytes = bytes
+        self.queries = queries
+        self.checkout_wait = checkout_wait
+
+    id = Column(Integer, primary_key=True)
+    journal_volume_id = Column(String, ForeignKey(JournalVolume.id))
+    stage = Column(String)
+    duration = Column(Float)
+    items = Column(Integer)
+    bytes = Column(BigInteger)
+    queries = Column(Integer)
+    checkout_wait = Column(Float)
+
+    @classmethod
+    def get_stage_totals(cls, session: Session) -> List[tuple]:
+        """Returns the number of runs and the summed duration, items, bytes, queries and checkout wait of each stage"""
+        return session.query(cls.stage, func.count(cls.id), func.sum(cls.duration), func.sum(cls.items), func.sum(cls.bytes), func.sum(cls.queries),
+            func.sum(cls.checkout_wait)).group_by(cls.stage).order_by(cls.stage).all()
@@ -1,10 +1,17 @@
-import requests
 import traceback
 import os
-from ADSScanExplorerPipeline.models import JournalVolume, VolumeStatus, Page, Article
-from ADSScanExplorerPipeline.ingestor import parse_top_file, parse_dat_file, parse_image_files, identify_journals, upload_image_files
-from ADSScanExplorerPipeline.ingestor import check_all_image_files_exists, index_ocr_files, set_ingestion_error_status, set_correct_volume_status
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, List, Tuple
+from ADSScanExplorerPipeline.models import JournalVolume, VolumeStatus, Page, Article, VolumeStageCheckpoint
+from ADSScanExplorerPipeline.ingestor import parse_volume_records, list_journals, identify_journal_volumes, upload_image_files
+from ADSScanExplorerPipeline.ingestor import check_all_image_files_exists, index_ocr_files, set_ingestion_error_status, set_correct_volume_status, add_volume_status_summary, diff_volume_manifest, hash_volume_manifest_legacy, load_volume, update_volume, push_volume_json, push_volume_batch, batch_volumes_json
+from ADSScanExplorerPipeline.metrics import measure_stage
 from kombu import Queue
+from celery import chain, group
+from sqlalchemy import func, select
 import ADSScanExplorerPipeline.app as app_module
 from adsputils import load_config
 
@@ -18,47 +25,78 @@ app = app_module.ADSScanExplorerPipeline('ads-scan-pipeline', proj_home=proj_hom
 logger = app.logger
 
 app.conf.CELERY_QUEUES = (
-    Queue('process-volume', app.exchange, routing_key='process-volume'),
+    Queue('process-volume', app.exchange, routing_key='process-volume', queue_arguments={'x-max-priority': 9}),
+    Queue('process-db', app.exchange, routing_key='process-db'),
+    Queue('upload-db', app.exchange, routing_key='upload-db'),
+    Queue('index-ocr', app.exchange, routing_key='index-ocr'),
+    Queue('upload-images', app.exchange, routing_key='upload-images'),
     Queue('process-new-volumes', app.exchange, routing_key='process-new-volumes'),
     Queue('investigate-new-volumes', app.exchange, routing_key='investigate-new-volumes'),
 )
 
+# Status flags of the stages that have to be redone when files of a category change.
+# The ocr documents carry the page color parsed from the bitmaps and the articles from the lists
+STAGE_FLAGS_BY_FILE_CATEGORY = {
+    'lists': ['db_done', 'db_uploaded', 'bucket_uploaded', 'ocr_uploaded'],
+    'bitmaps': ['db_done', 'db_uploaded', 'bucket_uploaded', 'ocr_uploaded'],
+    'ocr': ['ocr_uploaded'],
+}
+
+# Dispatch order of the volume statuses, updates go first and retries of failed volumes last
+STATUS_SCHEDULE_ORDER = {VolumeStatus.Update: 0, VolumeStatus.New: 1, VolumeStatus.Error: 2}
+# Page counts up to which volumes get a higher message priority within their status
+SIZE_PRIORITY_PAGES = [1000, 200]
+
+# Key of the advisory lock taken by the scheduling tasks while they count and mark the volumes in flight
+SCHEDULE_LOCK_KEY = 7190352
+
+# Session of the volume task running in the current thread
+_volume_session = threading.local()
+
 # ============================= TASKS ============================================= #
 
 @app.task(queue='process-volume')
-def task_process_volume(base_path: str, journal_volume_id: str, process_db: bool = True, upload_files: bool = True, index_ocr: bool = True, upload_db: bool = True, force_update: bool = False):
+def task_process_volume(base_path: str, journal_volume_id: str, process_db: bool = True, upload_files: bool = True, index_ocr: bool = True, upload_db: bool = True, force_update: bool = False, chain_stages: bool = None):
     """
-    Processes a journal volume
+    Processes a journal volume, either by chaining the stage tasks on their own queues
+    or by running the stages within this task if chain_stages (default PIPELINE_STAGE_QUEUES) is False
     """
     logger.info("Processing journal_volume id: %s", journal_volume_id)
-    with app.session_scope() as session:
+    with volume_session_scope() as session:
         try:
             vol = JournalVolume.get_from_id_or_name(journal_volume_id, session)
-            if force_update:
-                vol.status = VolumeStatus.Processing
-            elif vol.status != VolumeStatus.Done:
+            if force_update or vol.status != VolumeStatus.Done:
                 vol.status = VolumeStatus.Processing
+                #The stages add their summaries to the message of this run
+                vol.status_message = ""
 
             session.add(vol)
             session.commit()
 
+            if chain_stages is None:
+                chain_stages = config.get('PIPELINE_STAGE_QUEUES', True)
+            if chain_stages:
+                chain_volume_stages(base_path, vol, process_db and (not vol.db_done or force_update), upload_db, index_ocr, upload_files, force_update)
+                return session
+
             if process_db and (not vol.db_done or force_update):
                 task_process_db_for_volume(base_path, journal_volume_id)
 
             #Need to reload the volume to this session since it's been updated
             vol = JournalVolume.get_from_id_or_name(journal_volume_id, session)
-            if upload_db and vol.db_done and (not vol.db_uploaded or force_update):
-                task_upload_db_for_volume(journal_volume_id)
-
-            vol = JournalVolume.get_from_id_or_name(journal_volume_id, session)
-            if index_ocr and vol.db_done and (not vol.ocr_uploaded or force_update):
-                task_index_ocr_files_for_volume(base_path, journal_volume_id)
-            
-            vol = JournalVolume.get_from_id_or_name(journal_volume_id, session)
-            if upload_files and vol.db_done and (not vol.bucket_uploaded or force_update):
-                task_upload_image_files_for_volume(base_path, journal_volume_id)
+            #The remaining stages only depend on the db being done and mostly wait on the network,
+            #they run concurrently with their own sessions and each only sets its own flag
+            stages = []
+            if upload_db and is_stage_needed(vol, 'db_uploaded', force_update):
+                stages.append((task_upload_db_for_volume, (journal_volume_id,)))
+            if index_ocr and is_stage_needed(vol, 'ocr_uploaded', force_update):
+                stages.append((task_index_ocr_files_for_volume, (base_path, journal_volume_id)))
+            if upload_files and is_stage_needed(vol, 'bucket_uploaded', force_update):
+                stages.append((task_upload_image_files_for_volume, (base_path, journal_volume_id)))
+            run_stages(stages)
 
-            vol = JournalVolume.get_from_id_or_name(journal_volume_id, session)
+            #The stages committed their flags in their own sessions, the cached volume has to be reloaded
+            session.refresh(vol)
             set_correct_volume_status(vol, session)
 
         except Exception as e:
@@ -67,18 +105,84 @@ def task_process_volume(base_path: str, journal_volume_id: str, process_db: bool
             return
     return session
 
+@contextmanager
+def volume_session_scope():
+    """
+    Opens a session scope for a volume task, or reuses the one of the volume task already running in this thread so
+    its stages share one session and pooled connection instead of checking out another. A reused session is committed,
+    or rolled back, when the stage is done like its own scope would. Stages in other threads get their own session
+    """
+    session = getattr(_volume_session, 'session', None)
+    if session is not None:
+        try:
+            yield session
+            session.commit()
+        except:
+            session.rollback()
+            raise
+        return
+    with app.session_scope() as session:
+        _volume_session.session = session
+        try:
+            yield session
+        finally:
+            _volume_session.session = None
+
+def chain_volume_stages(base_path: str, vol: JournalVolume, run_db: bool, upload_db: bool, index_ocr: bool, upload_files: bool, force_update: bool):
+    """
+    Sends the stages of the volume as a chain of tasks on their own queues, the db stage first and then the
+    remaining stages as a group. Whether those are needed is only known once the db stage is done so they
+    check it themselves and each updates the volume status when done, the last one to finish sets it to Done
+    """
+    stages = []
+    if upload_db and (run_db or is_stage_needed(vol, 'db_uploaded', force_update)):
+        stages.append(task_upload_db_for_volume.si(vol.id, check_needed=True, force_update=force_update))
+    if index_ocr and (run_db or is_stage_needed(vol, 'ocr_uploaded', force_update)):
+        stages.append(task_index_ocr_files_for_volume.si(base_path, vol.id, check_needed=True, force_update=force_update))
+    if upload_files and (run_db or is_stage_needed(vol, 'bucket_uploaded', force_update)):
+        stages.append(task_upload_image_files_for_volume.si(base_path, vol.id, check_needed=True, force_update=force_update))
+    for stage in stages:
+        stage.link(task_set_volume_status.si(vol.id))
+    if not stages:
+        stages.append(task_set_volume_status.si(vol.id))
+    if run_db:
+        chain(task_process_db_for_volume.si(base_path, vol.id), group(stages)).delay()
+    else:
+        group(stages).delay()
+
+@app.task(queue='process-volume')
+def task_set_volume_status(journal_volume_id: str):
+    with volume_session_scope() as session:
+        vol = JournalVolume.get_from_id_or_name(journal_volume_id, session)
+        set_correct_volume_status(vol, session)
+
+def is_stage_needed(vol: JournalVolume, flag: str, force_update: bool) -> bool:
+    """
+    The stages after the db need it to be done and are skipped if their flag is already set unless forced
+    """
+    return vol.db_done and (not getattr(vol, flag) or force_update)
+
+def run_stages(stages: List[Tuple[Callable, tuple]]):
+    """
+    Runs the stage functions in their own threads and waits for all of them, a single stage runs on the calling thread
+    """
+    if len(stages) <= 1:
+        for stage, args in stages:
+            stage(*args)
+        return
+    with ThreadPoolExecutor(max_workers=len(stages)) as executor:
+        for future in [executor.submit(stage, *args) for stage, args in stages]:
+            future.result()
+
+@app.task(queue='process-db')
 def task_process_db_for_volume(base_path: str, journal_volume_id: str):
     logger.info("Processing db for journal_volume id: %s", journal_volume_id)
-    error_msg = ""  
 
-    with app.session_scope() as session:
+    with volume_session_scope() as session:
         vol = None
         try:
             vol = JournalVolume.get_from_id_or_name(journal_volume_id, session)
             vol.status = VolumeStatus.Processing
-            #Clear previous pages and articles associated with this journal in case of updates
-            Page.delete_all_from_volume(vol.id, session)
-            Article.delete_all_from_volume(vol.id, session)
             session.add(vol)
             session.commit()
         except Exception as e:
@@ -86,159 +190,388 @@ def task_process_db_for_volume(base_path: str, journal_volume_id: str):
             logger.error("Failed to get journal_volume: %s from db: %s", journal_volume_id, e)
             return
         try:
-            top_filename = vol.journal + vol.volume + ".top"
-            top_file_path = os.path.join(base_path, config.get('TOP_SUB_DIR', ''), vol.type, vol.journal, top_filename)
-            dat_file_path = top_file_path.replace(".top", ".dat")
-            image_path = os.path.join(base_path, config.get('BITMAP_SUB_DIR', ''), vol.type, vol.journal, vol.volume, "600")
-
-            for page in parse_top_file(top_file_path, vol, session):
-                session.add(page)
-                vol.pages.append(page)
+            with measure_stage(vol.id, 'process-db', session):
+                top_filename = vol.journal + vol.volume + ".top"
+                top_file_path = os.path.join(base_path, config.get('TOP_SUB_DIR', ''), vol.type, vol.journal, top_filename)
+                dat_file_path = top_file_path.replace(".top", ".dat")
+                image_path = os.path.join(base_path, config.get('BITMAP_SUB_DIR', ''), vol.type, vol.journal, vol.volume, "600")
 
-            if os.path.exists(dat_file_path):
-                for article in parse_dat_file(dat_file_path, vol, session):
-                    session.add(article)
-                    vol.articles.append(article)
+                #Previous pages and articles associated with this journal are updated or replaced in the same transaction in case of updates
+                if config.get('DB_BULK_LOAD', True) and config.get('DB_DIFF_UPDATE', True):
+                    changes = update_volume(top_file_path, dat_file_path, image_path, vol, session)
+                    logger.info("Updated journal_volume id: %s, rows inserted/updated/deleted: %s", journal_volume_id,
+                        ", ".join("%s %d/%d/%d" % ((table,) + counts) for table, counts in changes.items()))
+                elif config.get('DB_BULK_LOAD', True):
+                    n_pages, n_articles = load_volume(top_file_path, dat_file_path, image_path, vol, session)
+                    logger.info("Loaded %d pages and %d articles for journal_volume id: %s", n_pages, n_articles, journal_volume_id)
+                else:
+                    page_records, article_records = parse_volume_records(top_file_path, dat_file_path, image_path, vol, session)
+                    Page.delete_all_from_volume(vol.id, session)
+                    Article.delete_all_from_volume(vol.id, session)
 
-            check_all_image_files_exists(image_path, vol, session)
+                    pages = {}
+                    for record in page_records.values():
+                        page = record.to_page()
+                        pages[page.name] = page
+                        session.add(page)
+                        vol.pages.append(page)
 
-            for page in parse_image_files(image_path, vol, session):
-                session.add(page)
+                    for record in article_records.values():
+                        article = record.to_article(pages)
+                        session.add(article)
+                        vol.articles.append(article)
 
-            vol.db_done = True
-            set_correct_volume_status(vol, session)
+                vol.db_done = True
+                session.add(vol)
             
         except Exception as e:
             session.rollback()
             trace_string = traceback.format_exc()
             error_msg = "Failed to upload db from journal_volume_id: " + str(journal_volume_id) + " due to: " + str(e) + " traceback: " + trace_string
             logger.error(error_msg)
-    if error_msg != "":
-        set_ingestion_error_status(session, journal_volume_id, error_msg)
-        return
+            set_ingestion_error_status(session, journal_volume_id, error_msg)
+            return
     return session
 
 
-def task_upload_db_for_volume(journal_volume_id: str):
+@app.task(queue='upload-db')
+def task_upload_db_for_volume(journal_volume_id: str, check_needed: bool = False, force_update: bool = False):
     """
     Uploads the DB metadata to the service DB through a API call to the service
     """
     logger.info("Uploading db for journal_volume id: %s", journal_volume_id)
-    error_msg = ""  
-    with app.session_scope() as session:
+    with volume_session_scope() as session:
         vol = None
         try:
             vol = JournalVolume.get_from_id_or_name(journal_volume_id, session)
-            url = config.get('SERVICE_DB_PUSH_URL' ,'')
-            auth_token = config.get('SERVICE_AUTHENTICATION_TOKEN' ,'')
-            x = requests.put(url, json = vol.to_dict(), headers = {'Authorization': 'Bearer:' + auth_token} )
-            if x.status_code == 200:
-                vol.db_uploaded = True
-                set_correct_volume_status(vol, session)
-            else:
-                raise Exception(x.content)
+            if check_needed and not is_stage_needed(vol, 'db_uploaded', force_update):
+                logger.info("Skipping db upload for volume %s", journal_volume_id)
+                return session
+            with measure_stage(vol.id, 'upload-db', session):
+                #The body is streamed with chunked transfer encoding while the pages are read from the db
+                x = push_volume_json(vol, session)
+                if x.status == 200:
+                    vol.db_uploaded = True
+                    session.add(vol)
+                else:
+                    raise Exception(x.data)
         except Exception as e:
             session.rollback()
             trace_string = traceback.format_exc()
             error_msg = "Failed to upload db from journal_volume_id: " + str(journal_volume_id) + " due to: " + str(e) + " traceback: " + trace_string
             logger.error(error_msg)
-    if error_msg != "":
-        set_ingestion_error_status(session, journal_volume_id, error_msg)
+            set_ingestion_error_status(session, journal_volume_id, error_msg)
     return session
 
-def task_upload_image_files_for_volume(base_path: str, journal_volume_id: str):
-    error_msg = ""
-    logger.info("Uploading images files for volume %s", journal_volume_id)
+def task_upload_db_for_volumes(journal_volume_ids: List[str], force_update: bool = False):
+    """
+    Uploads the DB metadata of several volumes to the service in batched requests.
+    The volumes of a batch that failed as a whole are uploaded one by one instead
+    """
+    logger.info("Uploading db for %d journal volumes in batches", len(journal_volume_ids))
+    failed_ids = []
+    fallback_ids = []
+    with app.session_scope() as session:
+        vols = [vol for vol in JournalVolume.get_all_from_ids(journal_volume_ids, session) if vol.db_done and (not vol.db_uploaded or force_update)]
+        for batch in batch_volumes_json(vols, session):
+            try:
+                results = push_volume_batch(batch)
+            except Exception as e:
+                logger.warning("Failed to upload db for a batch of %d volumes, uploading them one by one due to: %s", len(batch), e)
+                fallback_ids.extend(vol.id for vol, data in batch)
+                continue
+            for vol, data in batch:
+                if results[vol.id]:
+                    vol.db_uploaded = True
+                    session.add(vol)
+                else:
+                    failed_ids.append(vol.id)
+        for journal_volume_id in failed_ids:
+            set_ingestion_error_status(session, journal_volume_id, "Failed to upload db from journal_volume_id: " + str(journal_volume_id) + " due to: rejected by the service in batch upload")
+    logger.info("Uploaded db for %d journal volumes in batches, %d rejected and %d uploaded one by one", len(vols), len(failed_ids), len(fallback_ids))
+    for journal_volume_id in fallback_ids:
+        task_upload_db_for_volume(journal_volume_id)
     with app.session_scope() as session:
+        for vol in JournalVolume.get_all_from_ids(journal_volume_ids, session):
+            set_correct_volume_status(vol, session)
+    return session
+
+@app.task(queue='upload-images')
+def task_upload_image_files_for_volume(base_path: str, journal_volume_id: str, check_needed: bool = False, force_update: bool = False):
+    logger.info("Uploading images files for volume %s", journal_volume_id)
+    with volume_session_scope() as session:
         vol = None
         try:
             vol = JournalVolume.get_from_id_or_name(journal_volume_id, session)
-            image_path = os.path.join(base_path, config.get('BITMAP_SUB_DIR', ''), vol.type, vol.journal, vol.volume, "600")
-            check_all_image_files_exists(image_path, vol, session)
-            upload_image_files(image_path, vol, session)
-            vol.bucket_uploaded = True
-            vol.status_message = None
-            session.add(vol)
+            if check_needed and not is_stage_needed(vol, 'bucket_uploaded', force_update):
+                logger.info("Skipping image upload for volume %s", journal_volume_id)
+                return session
+            with measure_stage(vol.id, 'upload-images', session):
+                image_path = os.path.join(base_path, config.get('BITMAP_SUB_DIR', ''), vol.type, vol.journal, vol.volume, "600")
+                check_all_image_files_exists(image_path, vol, session)
+                uploaded, skipped = upload_image_files(image_path, vol, session)
+                logger.info("Uploaded %d image files, skipped %d unchanged for volume %s", uploaded, skipped, journal_volume_id)
+                vol.bucket_uploaded = True
+                add_volume_status_summary(vol, "Uploaded %d image files, skipped %d unchanged" % (uploaded, skipped))
+                session.add(vol)
         except Exception as e:
             session.rollback()
             trace_string = traceback.format_exc()
             error_msg = "Failed to upload images from journal_volume_id: " + str(journal_volume_id) + " due to: " + str(e) + " traceback: " + trace_string
             logger.error(error_msg)
-    if error_msg != "":
-        set_ingestion_error_status(session, journal_volume_id, error_msg)
+            set_ingestion_error_status(session, journal_volume_id, error_msg)
     return session
 
-def task_index_ocr_files_for_volume(base_path: str, journal_volume_id: str):
-    error_msg = ""
+@app.task(queue='index-ocr')
+def task_index_ocr_files_for_volume(base_path: str, journal_volume_id: str, check_needed: bool = False, force_update: bool = False):
     logger.info("Indexing ocr files for volume %s", journal_volume_id)
 
-    with app.session_scope() as session:
+    with volume_session_scope() as session:
         vol = None
         try:
             vol = JournalVolume.get_from_id_or_name(journal_volume_id, session)
-            ocr_path = os.path.join(base_path, config.get('OCR_SUB_DIR', ''), vol.type, vol.journal, vol.volume)
-            index_ocr_files(ocr_path, vol, session)
-            vol.ocr_uploaded = True
-            set_correct_volume_status(vol, session)
+            if check_needed and not is_stage_needed(vol, 'ocr_uploaded', force_update):
+                logger.info("Skipping ocr indexing for volume %s", journal_volume_id)
+                return session
+            with measure_stage(vol.id, 'index-ocr', session):
+                ocr_path = os.path.join(base_path, config.get('OCR_SUB_DIR', ''), vol.type, vol.journal, vol.volume)
+                indexed, failed = index_ocr_files(ocr_path, vol, session)
+                summary = "Indexed %d ocr pages, %d failed" % (indexed, failed)
+                logger.info("%s for volume %s", summary, journal_volume_id)
+                if failed > 0:
+                    raise Exception(summary)
+                vol.ocr_uploaded = True
+                add_volume_status_summary(vol, summary)
+                session.add(vol)
         except Exception as e:
             session.rollback()
             trace_string = traceback.format_exc()
             error_msg = "Failed to index ocr files from journal_volume_id: " + str(journal_volume_id) + " due to: " + str(e) + " traceback: " + trace_string
             logger.error(error_msg)
-    if error_msg != "":
-        set_ingestion_error_status(session, journal_volume_id, error_msg)
+            set_ingestion_error_status(session, journal_volume_id, error_msg)
     return session
 
 @app.task(queue='investigate-new-volumes')
 def task_investigate_new_volumes(base_path: str, process_db: bool = True, upload_files: bool = True, index_ocr: bool = True,  upload_db: bool = True, process: bool = True, dry_run: bool = False):
     """
-    Investigate if any new or updated volumes exists and process them if process flag is set to True
+    Investigate if any new or updated volumes exists and process them if process flag is set to True.
+    The journals are scanned concurrently and the volumes of each journal are merged and
+    sent for processing as soon as the journal is done
     """
     logger.info("Investigating new or changed volumes in %s", base_path)
+    dispatched_ids = set()
     with app.session_scope() as session:
-        for vol in identify_journals(base_path):
-            existing_vol = JournalVolume.get_from_obj(vol, session)
-            if existing_vol:
-                if vol.file_hash != existing_vol.file_hash:
-                        existing_vol.status = VolumeStatus.Update
-                        existing_vol.db_done = False
-                        existing_vol.db_uploaded = False
-                        existing_vol.bucket_uploaded = False
-                        existing_vol.ocr_uploaded = False
-                        existing_vol.file_hash = vol.file_hash
-                        if dry_run:
-                            logger.info("DRY RUN: Volume: %s would have been updated", str(vol.id))
-                        else:
-                            session.add(existing_vol)
-            else:
-                if vol.status != VolumeStatus.Error:
-                    vol.status = VolumeStatus.New
+        with ThreadPoolExecutor(max_workers=config.get('INVESTIGATE_WORKERS', 8)) as executor:
+            futures = [executor.submit(list, identify_journal_volumes(base_path, type, journal)) for type, journal in list_journals(base_path)]
+            for future in as_completed(futures):
+                changed_ids = merge_journal_volumes(future.result(), session, dry_run)
                 if dry_run:
-                    logger.info("DRY RUN: Volume: %s would have been added", str(vol.id))
-                else:
-                    session.add(vol)
-    if process and not dry_run:
-        task_process_new_volumes.delay(base_path, process_db, upload_files, index_ocr, upload_db)  
+                    continue
+                session.commit()
+                if process and changed_ids:
+                    task_process_new_volumes.delay(base_path, process_db, upload_files, index_ocr, upload_db, journal_volume_ids=changed_ids)
+                    dispatched_ids.update(changed_ids)
+
+        if process and not dry_run:
+            #Volumes left to process from earlier runs e.g. failed ones
+            remaining_ids = [vol.id for vol in JournalVolume.get_to_be_processed(session, get_in_flight_since()) if vol.id not in dispatched_ids]
+            if remaining_ids:
+                task_process_new_volumes.delay(base_path, process_db, upload_files, index_ocr, upload_db, journal_volume_ids=remaining_ids)
     return session 
 
+def merge_journal_volumes(volumes: List[JournalVolume], session, dry_run: bool) -> List[str]:
+    """
+    Merges the identified volumes of a journal with the existing ones which are looked up in one query.
+    Returns the ids of the new and updated volumes
+    """
+    if not volumes:
+        return []
+    existing_vols = {(vol.type, vol.journal, vol.volume): vol for vol in JournalVolume.get_all_from_journal(volumes[0].type, volumes[0].journal, session)}
+    changed_ids = []
+    for vol in volumes:
+        existing_vol = existing_vols.get((vol.type, vol.journal, vol.volume))
+        if existing_vol:
+            if vol.file_hash != existing_vol.file_hash and is_legacy_hash_unchanged(existing_vol, vol):
+                #Volumes hashed before the manifest was stored only get it backfilled since their files are the same
+                existing_vol.file_hash = vol.file_hash
+                existing_vol.file_manifest = vol.file_manifest
+                if not dry_run:
+                    session.add(existing_vol)
+            elif vol.file_hash != existing_vol.file_hash:
+                changed_categories = diff_volume_manifest(existing_vol.file_manifest, vol.file_manifest)
+                existing_vol.status = VolumeStatus.Update
+                for category in changed_categories:
+                    for flag in STAGE_FLAGS_BY_FILE_CATEGORY[category]:
+                        setattr(existing_vol, flag, False)
+                existing_vol.file_hash = vol.file_hash
+                existing_vol.file_manifest = vol.file_manifest
+                if dry_run:
+                    logger.info("DRY RUN: Volume: %s would have been updated due to changed %s", str(vol.id), ", ".join(sorted(changed_categories)))
+                else:
+                    #Progress of interrupted stages refers to the previous files
+                    VolumeStageCheckpoint.clear(existing_vol.id, session)
+                    session.add(existing_vol)
+                    changed_ids.append(existing_vol.id)
+        else:
+            if vol.status != VolumeStatus.Error:
+                vol.status = VolumeStatus.New
+            if dry_run:
+                logger.info("DRY RUN: Volume: %s would have been added", str(vol.id))
+            else:
+                session.add(vol)
+                changed_ids.append(vol.id)
+    return changed_ids
+
+def is_legacy_hash_unchanged(existing_vol: JournalVolume, vol: JournalVolume) -> bool:
+    """
+    Checks if a volume stored without a manifest has the same legacy hash as the identified volume
+    """
+    if existing_vol.file_manifest is not None or vol.file_manifest is None:
+        return False
+    return existing_vol.file_hash == hash_volume_manifest_legacy(vol.file_manifest)
+
+@app.task(queue='process-volume')
+def task_process_volume_batch(base_path: str, journal_volume_ids: List[str], process_db: bool = True, upload_files: bool = True, index_ocr: bool = True, upload_db: bool = True, force_update: bool = False, chain_stages: bool = None):
+    """
+    Processes several journal volumes and uploads their DB metadata to the service in batches afterwards.
+    With chain_stages (default PIPELINE_STAGE_QUEUES) each volume is sent as its own chain of stage tasks without
+    the db upload, which task_upload_db_for_batch does for the whole batch once the other stages are done
+    """
+    if chain_stages is None:
+        chain_stages = config.get('PIPELINE_STAGE_QUEUES', True)
+    if chain_stages and upload_db and force_update:
+        #The flags of the stages run again are reset so the batch upload waits for them
+        with app.session_scope() as session:
+            for vol in JournalVolume.get_all_from_ids(journal_volume_ids, session):
+                vol.db_done = vol.db_done and not process_db
+                vol.ocr_uploaded = vol.ocr_uploaded and not index_ocr
+                vol.bucket_uploaded = vol.bucket_uploaded and not upload_files
+                session.add(vol)
+    for journal_volume_id in journal_volume_ids:
+        task_process_volume(base_path, journal_volume_id, process_db, upload_files, index_ocr, False, force_update=force_update, chain_stages=chain_stages)
+    if not upload_db:
+        return
+    if chain_stages:
+        task_upload_db_for_batch.apply_async((journal_volume_ids, process_db, upload_files, index_ocr, force_update),
+            countdown=config.get('SERVICE_DB_BATCH_WAIT_INTERVAL', 60))
+    else:
+        task_upload_db_for_volumes(journal_volume_ids, force_update)
+
+@app.task(queue='upload-db')
+def task_upload_db_for_batch(journal_volume_ids: List[str], process_db: bool = True, upload_files: bool = True, index_ocr: bool = True, force_update: bool = False):
+    """
+    Uploads the DB metadata of a batch of volumes once none of them has a stage left to run, otherwise the task
+    is sent again after SERVICE_DB_BATCH_WAIT_INTERVAL seconds. Volumes stuck for longer than PROCESS_IN_FLIGHT_TIMEOUT
+    are not waited for
+    """
+    with app.session_scope() as session:
+        since = get_in_flight_since()
+        pending_ids = [vol.id for vol in JournalVolume.get_all_from_ids(journal_volume_ids, session)
+            if vol.updated >= since and is_batch_stage_pending(vol, process_db, upload_files, index_ocr)]
+    if pending_ids and not config.get('CELERY_ALWAYS_EAGER', False):
+        logger.info("Waiting for the stages of %d of %d volumes before uploading their db", len(pending_ids), len(journal_volume_ids))
+        task_upload_db_for_batch.apply_async((journal_volume_ids, process_db, upload_files, index_ocr, force_update),
+            countdown=config.get('SERVICE_DB_BATCH_WAIT_INTERVAL', 60))
+        return
+    task_upload_db_for_volumes(journal_volume_ids, force_update)
+
+def is_batch_stage_pending(vol: JournalVolume, process_db: bool, upload_files: bool, index_ocr: bool) -> bool:
+    """
+    A volume of a batch has a stage left to run until it failed or its db, ocr and image stages are done
+    """
+    if vol.status == VolumeStatus.Error:
+        return False
+    if not vol.db_done:
+        return process_db
+    return (index_ocr and not vol.ocr_uploaded) or (upload_files and not vol.bucket_uploaded)
+
 @app.task(queue='process-new-volumes')
-def task_process_new_volumes(base_path: str, process_db: bool = True, upload_files: bool = True, index_ocr: bool = True,  upload_db: bool = True, process_all: bool = False, force_update: bool = False):
+def task_process_new_volumes(base_path: str, process_db: bool = True, upload_files: bool = True, index_ocr: bool = True,  upload_db: bool = True, process_all: bool = False, force_update: bool = False, journal_volume_ids: List[str] = None, max_in_flight: int = None):
     """
-    Process new or updated volumes
+    Process new or updated volumes, or only the given volumes if journal_volume_ids is set.
+    The volumes are dispatched in the order and with the priority from schedule_volumes. With max_in_flight
+    (default PROCESS_MAX_IN_FLIGHT, 0 for no limit) only as many volumes are dispatched as there are free slots
+    and the task is sent again for the remaining ones after PROCESS_SCHEDULE_INTERVAL seconds. The cap holds with
+    several scheduling tasks running at the same time, e.g. one per journal from the investigation, since they
+    select, count and mark the volumes in flight one after another under a lock
     """
     logger.info("Processing new or changed volumes in %s", base_path)
-    volumes_to_process = []
+    if max_in_flight is None:
+        max_in_flight = config.get('PROCESS_MAX_IN_FLIGHT', 0)
+    #In eager mode the volumes are processed one at a time anyway
+    capped = max_in_flight and not config.get('CELERY_ALWAYS_EAGER', False)
+    remaining = []
     with app.session_scope() as session:
-        if process_all:
-            for vol in JournalVolume.get_all(session):
-                volumes_to_process.append(vol.id)
+        if capped:
+            lock_volume_scheduling(session)
+        if journal_volume_ids is not None:
+            #The volumes may have been dispatched by another scheduling task since the ids were sent
+            vols = JournalVolume.get_to_be_processed(session, get_in_flight_since(), journal_volume_ids)
+        elif process_all:
+            vols = JournalVolume.get_all(session)
         else:
-            for vol in JournalVolume.get_to_be_processed(session):
-                volumes_to_process.append(vol.id)
+            vols = JournalVolume.get_to_be_processed(session, get_in_flight_since())
+        scheduled = schedule_volumes(vols, session)
+
+        if capped:
+            slots = max(0, max_in_flight - JournalVolume.count_in_flight(get_in_flight_since(), session))
+            scheduled, remaining = scheduled[:slots], scheduled[slots:]
+            #The dispatched volumes count as in flight while waiting in the queue
+            dispatched_ids = set(vol_id for vol_id, priority in scheduled)
+            for vol in vols:
+                if vol.id in dispatched_ids:
+                    vol.status = VolumeStatus.Processing
+                    session.add(vol)
+            session.commit()
+
+    if upload_db and config.get('SERVICE_DB_BATCH_PUSH', False):
+        batch_size = config.get('SERVICE_DB_BATCH_VOLUMES', 50)
+        for i in range(0, len(scheduled), batch_size):
+            batch = scheduled[i:i + batch_size]
+            task_process_volume_batch.apply_async((base_path, [vol_id for vol_id, priority in batch], process_db, upload_files, index_ocr, upload_db),
+                {'force_update': force_update}, priority=max(priority for vol_id, priority in batch))
+    else:
+        for vol_id, priority in scheduled:
+            task_process_volume.apply_async((base_path, vol_id, process_db, upload_files, index_ocr, upload_db), {'force_update': force_update}, priority=priority)
 
-    for vol_id in volumes_to_process:
-        task_process_volume.delay(base_path, vol_id, process_db, upload_files, index_ocr, upload_db, force_update=force_update)
+    if remaining:
+        logger.info("Dispatched %d volumes, %d wait for volumes in flight to finish", len(scheduled), len(remaining))
+        task_process_new_volumes.apply_async((base_path, process_db, upload_files, index_ocr, upload_db),
+            {'force_update': force_update, 'journal_volume_ids': [vol_id for vol_id, priority in remaining], 'max_in_flight': max_in_flight},
+            countdown=config.get('PROCESS_SCHEDULE_INTERVAL', 60))
     return session
 
+def lock_volume_scheduling(session):
+    """
+    Takes a lock held until the transaction ends so concurrent scheduling tasks select, count and mark the volumes
+    in flight one after another. It's a postgres advisory lock, SQLite serializes the writing transactions itself
+    """
+    if session.get_bind().dialect.name == "postgresql":
+        session.execute(select([func.pg_advisory_xact_lock(SCHEDULE_LOCK_KEY)]))
+
+def get_in_flight_since() -> datetime:
+    """
+    Volumes in Processing that have not been updated since PROCESS_IN_FLIGHT_TIMEOUT seconds are considered stuck,
+    e.g. their message was lost, they no longer count as in flight and are processed again
+    """
+    return datetime.utcnow() - timedelta(seconds=config.get('PROCESS_IN_FLIGHT_TIMEOUT', 6 * 3600))
+
+def schedule_volumes(vols: List[JournalVolume], session) -> List[Tuple[str, int]]:
+    """
+    Orders the volumes for dispatch by status and then by size, smallest first, and gives each a celery message priority
+    from 0 to 8 (higher goes first) so small fixes don't wait behind huge volumes. The size is the page count of the
+    previous run or the number of bitmap files in the file manifest for volumes that haven't been processed yet
+    """
+    page_counts = Page.get_page_counts([vol.id for vol in vols], session)
+    scheduled = []
+    for vol in vols:
+        n_pages = page_counts.get(vol.id) or len((vol.file_manifest or {}).get('bitmaps', {}))
+        status_order = STATUS_SCHEDULE_ORDER.get(vol.status, STATUS_SCHEDULE_ORDER[VolumeStatus.New])
+        size_priority = sum(1 for max_pages in SIZE_PRIORITY_PAGES if n_pages <= max_pages)
+        priority = (max(STATUS_SCHEDULE_ORDER.values()) - status_order) * (len(SIZE_PRIORITY_PAGES) + 1) + size_priority
+        scheduled.append((status_order, n_pages, vol.id, priority))
+    scheduled.sort()
+    return [(vol_id, priority) for status_order, n_pages, vol_id, priority in scheduled]
+
 if __name__ == '__main__':
     app.start()
@@ -2,11 +2,89 @@ import unittest
 from unittest.mock import patch
 from alchemy_mock.mocking import UnifiedAlchemyMagicMock
 import os
-from ADSScanExplorerPipeline.models import JournalVolume, Page, Article, PageColor
+import json
+import shutil
+import struct
+import tempfile
+import threading
+import time
+import gzip
+from hashlib import md5
+import requests
+import urllib3
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from ADSScanExplorerPipeline.models import Base, JournalVolume, Page, Article, PageRecord, ArticleRecord, PageColor, PageType, VolumeStageCheckpoint
 from ADSScanExplorerPipeline.exceptions import MissingImageFileException
-from ADSScanExplorerPipeline.ingestor import hash_volume, identify_journals, parse_volume_from_top_file, parse_top_file, parse_dat_file, parse_image_files, check_all_image_files_exists, upload_image_files, split_top_row, split_top_map_row
+from ADSScanExplorerPipeline.ingestor import hash_volume, identify_journals, parse_volume_from_top_file, parse_top_file, parse_dat_file, parse_image_files, check_all_image_files_exists, upload_image_files, split_top_row, split_top_map_row, parse_top_rows, TopRow
+from ADSScanExplorerPipeline.ingestor import read_tiff_header, read_tiff_header_with_pil, index_ocr_files, generate_ocr_documents, get_s3_client
+from ADSScanExplorerPipeline.ingestor import build_volume_manifest, diff_volume_manifest, hash_volume_manifest, hash_volume_manifest_legacy, group_list_files_by_volume, scan_dir, bulk_insert, load_volume, update_volume, generate_volume_json, push_volume_json, push_volume_batch, batch_volumes_json
 from moto import mock_s3
 import boto3
+import opensearchpy
+from opensearchpy.connection import Connection
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+
+class MockBulkConnection(Connection):
+    """ Open Search connection answering bulk requests locally.
+    Documents with text 'reject' are rejected with 429 the first time and documents with text 'fail' always fail"""
+    requests = []
+    rejected = set()
+
+    def perform_request(self, method, url, params=None, body=None, timeout=None, ignore=(), headers=None):
+        MockBulkConnection.requests.append((method, url, body))
+        if not url.endswith("/_bulk"):
+            return 200, {}, json.dumps({"deleted": 0})
+        lines = body.decode("utf-8").strip().split("\n")
+        items = []
+        for action, source in zip(lines[0::2], lines[1::2]):
+            doc = json.loads(source)
+            status = 201
+            if doc['text'] == 'fail':
+                status = 400
+            elif doc['text'] == 'reject' and doc['page_id'] not in MockBulkConnection.rejected:
+                MockBulkConnection.rejected.add(doc['page_id'])
+                status = 429
+            item = {"_index": json.loads(action)["index"]["_index"], "_id": json.loads(action)["index"]["_id"], "status": status}
+            if status != 201:
+                item["error"] = {"type": "mock_error"}
+            items.append({"index": item})
+        return 200, {}, json.dumps({"took": 1, "errors": any("error" in item["index"] for item in items), "items": items})
+
+class StubServiceHandler(BaseHTTPRequestHandler):
+    """ Service db push endpoint recording the decoded request bodies.
+    Answers with the queued statuses, delays and bodies, 200 without delay and body once they are used up"""
+    protocol_version = "HTTP/1.1"
+    requests = []
+    statuses = []
+    delays = []
+    bodies = []
+
+    def do_PUT(self):
+        body = b""
+        if self.headers.get('Transfer-Encoding') == 'chunked':
+            while True:
+                size = int(self.rfile.readline().strip(), 16)
+                if size == 0:
+                    self.rfile.readline()
+                    break
+                body += self.rfile.read(size)
+                self.rfile.readline()
+        else:
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        StubServiceHandler.requests.append((self.client_address[1], dict(self.headers), body))
+        if StubServiceHandler.delays:
+            time.sleep(StubServiceHandler.delays.pop(0))
+        response_body = StubServiceHandler.bodies.pop(0) if StubServiceHandler.bodies else b""
+        self.send_response(StubServiceHandler.statuses.pop(0) if StubServiceHandler.statuses else 200)
+        self.send_header('Content-Length', str(len(response_body)))
+        self.end_headers()
+        self.wfile.write(response_body)
+
+    def log_message(self, format, *args):
+        pass
 
 class TestIngestor(unittest.TestCase):
 
@@ -19,6 +97,73 @@ class TestIngestor(unittest.TestCase):
         #Hash changes in different OS env due to full relative link being different
         #self.assertEqual(hash, "15716c95d1241e876efc339e98fa206e")
     
+    def test_volume_manifest(self):
+        vol = JournalVolume("seri", "test.", "0001")
+        manifest = build_volume_manifest(self.data_folder, vol)
+        self.assertEqual(sorted(manifest['lists'].keys()), ["test.0001.dat", "test.0001.top"])
+        self.assertEqual(sorted(manifest['bitmaps'].keys()), ["0000255,001", "0000255,001.tif"])
+        self.assertEqual(sorted(manifest['ocr'].keys()), ["0000255,001.txt"])
+        self.assertEqual(manifest['bitmaps']["0000255,001.tif"][0], 1003424)
+        self.assertEqual(hash_volume(self.data_folder, vol), hash_volume_manifest(manifest))
+
+        with patch.dict('ADSScanExplorerPipeline.ingestor.config', {'MANIFEST_CHECKSUM': True}):
+            manifest = build_volume_manifest(self.data_folder, vol)
+        self.assertEqual(len(manifest['ocr']["0000255,001.txt"]), 3)
+
+    def test_volume_manifest_legacy_hash(self):
+        """ Makes sure the legacy hash from the manifest is the one the volumes were hashed with before the manifest was stored"""
+        vol = JournalVolume("seri", "test.", "0001")
+        vol_hash = ""
+        for path in [os.path.join(self.data_folder, "lists", vol.type, vol.journal), os.path.join(self.data_folder, "bitmaps", vol.type, vol.journal, vol.volume, "600"),
+                os.path.join(self.data_folder, "ocr", "full", vol.type, vol.journal, vol.volume)]:
+            for file in sorted(os.listdir(path)):
+                if path.endswith(vol.journal) and vol.volume not in file:
+                    continue
+                vol_hash = md5((vol_hash + str(os.path.getmtime(os.path.join(path, file))) + file).encode("utf-8")).hexdigest()
+        manifest = json.loads(json.dumps(build_volume_manifest(self.data_folder, vol)))
+        self.assertEqual(hash_volume_manifest_legacy(manifest), vol_hash)
+
+    def test_diff_volume_manifest(self):
+        """ Makes sure each file category is reported on its own when changed"""
+        vol = JournalVolume("seri", "test.", "0001")
+        with tempfile.TemporaryDirectory() as folder:
+            shutil.copytree(self.data_folder, folder, dirs_exist_ok=True)
+            manifest = build_volume_manifest(folder, vol)
+            self.assertEqual(diff_volume_manifest(manifest, build_volume_manifest(folder, vol)), set())
+            self.assertEqual(diff_volume_manifest(None, manifest), {'lists', 'bitmaps', 'ocr'})
+
+            changed_files = {
+                'lists': os.path.join(folder, "lists", "seri", "test.", "test.0001.top"),
+                'bitmaps': os.path.join(folder, "bitmaps", "seri", "test.", "0001", "600", "0000255,001.tif"),
+                'ocr': os.path.join(folder, "ocr", "full", "seri", "test.", "0001", "0000255,001.txt"),
+            }
+            for category, file_path in changed_files.items():
+                previous_manifest = build_volume_manifest(folder, vol)
+                with open(file_path, "ab") as file:
+                    file.write(b"\n")
+                self.assertEqual(diff_volume_manifest(previous_manifest, build_volume_manifest(folder, vol)), {category})
+
+            previous_manifest = build_volume_manifest(folder, vol)
+            os.remove(os.path.join(folder, "ocr", "full", "seri", "test.", "0001", "0000255,001.txt"))
+            self.assertEqual(diff_volume_manifest(previous_manifest, build_volume_manifest(folder, vol)), {'ocr'})
+
+    def test_group_list_files_by_volume(self):
+        """ Makes sure list files are grouped the same way as matching each volume name against each file name"""
+        filenames = ["test.0001.top", "test.0001.dat", "test.0001.top.map", "test.0010.top", "test.0100.top", "test.10001.top", "test.001.top", "README"]
+        with tempfile.TemporaryDirectory() as folder:
+            for filename in filenames:
+                open(os.path.join(folder, filename), "w").close()
+            entries = scan_dir(folder)
+            volumes = ["0001", "0010", "0100", "10001", "001"]
+            grouped = group_list_files_by_volume(entries, volumes)
+            for volume in volumes:
+                self.assertEqual(sorted(entry.name for entry in grouped[volume]), sorted(filename for filename in filenames if volume in filename))
+
+    def test_identify_journals_hash(self):
+        for vol in identify_journals(self.data_folder):
+            self.assertEqual(vol.file_hash, hash_volume(self.data_folder, vol))
+            self.assertEqual(vol.file_manifest, build_volume_manifest(self.data_folder, vol))
+
     def test_parse_volume(self):
         vol = JournalVolume("seri", "test.", "0001")
         volym_str = parse_volume_from_top_file("test.0001.top", vol.journal)
@@ -73,6 +218,32 @@ class TestIngestor(unittest.TestCase):
         self.assertEqual(name, "A000136M000")
         self.assertEqual(label, "A261/A262")
 
+        name, label = split_top_map_row("A000136_000\t\t1\n")
+        self.assertEqual(name, "A000136_000")
+        self.assertEqual(label, "1")
+
+        name, label = split_top_map_row("  A000136.000 ii 1")
+        self.assertEqual(name, "")
+        self.assertEqual(label, "A000136.000")
+
+    def test_parse_top_rows(self):
+        """ Makes sure only rows with valid page names are numbered and the .top.map file is preferred"""
+        with tempfile.TemporaryDirectory() as folder:
+            top_file_path = os.path.join(folder, "test.0001.top")
+            with open(top_file_path, "w") as file:
+                file.write("12\n001485\ntest 0001\n0000001,000\n0000001.000   1\n0000001X000 x\nA000002P001A-2\n")
+            self.assertEqual(parse_top_rows(top_file_path), [
+                TopRow("0000001,000", PageType.FrontMatter, None, 1),
+                TopRow("0000001.000", PageType.Normal, "1", 2),
+                TopRow("A000002P001", PageType.Plate, "A-2", 3),
+            ])
+            with open(top_file_path + ".map", "w") as file:
+                file.write("0000001_000\tii\tC\n0000001_000\t1\t1\n\n0000002_000\n")
+            self.assertEqual(parse_top_rows(top_file_path), [
+                TopRow("0000001,000", PageType.FrontMatter, "ii", 1),
+                TopRow("0000001.000", PageType.Normal, "1", 2),
+            ])
+
     @patch('sqlalchemy.orm.Session')
     def test_parse_top_file(self, Session):
         session = Session.return_value
@@ -92,14 +263,15 @@ class TestIngestor(unittest.TestCase):
         self.assertEqual(n , 1)
 
     @patch('sqlalchemy.orm.Session')
-    @patch('ADSScanExplorerPipeline.models.Page.get_from_name_and_journal')
-    def test_parse_dat_file(self, get_from_name_and_journal, Session):
+    @patch('ADSScanExplorerPipeline.models.Article.get_all_from_volume')
+    @patch('ADSScanExplorerPipeline.models.Page.get_all_from_volume')
+    def test_parse_dat_file(self, get_all_pages_from_volume, get_all_articles_from_volume, Session):
         session = Session.return_value
-        session.query.return_value.filter.return_value.one_or_none.return_value = None
         vol = JournalVolume("seri", "test.", "0001")
         page =  Page("0000255,001", vol.id)
         expected_article =  Article("test......001..test", vol.id)
-        get_from_name_and_journal.return_value = page
+        get_all_pages_from_volume.return_value = [page]
+        get_all_articles_from_volume.return_value = []
         dat_filename = vol.journal + vol.volume + ".dat"
         dat_file_path = os.path.join(self.data_folder, "lists", vol.type, vol.journal, dat_filename)
         n = 0
@@ -109,11 +281,11 @@ class TestIngestor(unittest.TestCase):
             self.assertTrue(page in article.pages)
         self.assertEqual(n , 1)
 
-    @patch('ADSScanExplorerPipeline.models.Page.get_from_name_and_journal')
-    def test_parse_image_files(self, get_from_name_and_journal):
+    @patch('ADSScanExplorerPipeline.models.Page.get_all_from_volume')
+    def test_parse_image_files(self, get_all_from_volume):
         vol = JournalVolume("seri", "test.", "0001")
         expected_page =  Page("0000255,001", vol.id)
-        get_from_name_and_journal.return_value = expected_page
+        get_all_from_volume.return_value = [expected_page]
         image_folder_path = os.path.join(self.data_folder,  "bitmaps", vol.type, vol.journal, vol.volume, "600")
         n = 0
         for page in parse_image_files(image_folder_path, vol, None):
@@ -124,14 +296,74 @@ class TestIngestor(unittest.TestCase):
             self.assertTrue(page.color_type in [PageColor.Grayscale, PageColor.BW])
         self.assertEqual(n , 2)
 
-    @patch('ADSScanExplorerPipeline.models.Page.get_from_name_and_journal')
-    def test_parse_image_files_wrong_page(self, get_from_name_and_journal):
+    @patch('ADSScanExplorerPipeline.models.Page.get_all_from_volume')
+    def test_parse_image_files_parallel(self, get_all_from_volume):
+        """ Makes sure the threaded header reading gives the same pages and errors as the serial one"""
         vol = JournalVolume("seri", "test.", "0001")
-        get_from_name_and_journal.return_value = None
+        get_all_from_volume.side_effect = lambda volume_id, session: [Page("000025%d,001" % n, volume_id) for n in range(1, 6)]
+        image_folder_path = os.path.join(self.data_folder,  "bitmaps", vol.type, vol.journal, vol.volume, "600")
+        with tempfile.TemporaryDirectory() as folder:
+            for n in range(1, 6):
+                shutil.copy(os.path.join(image_folder_path, "0000255,001"), os.path.join(folder, "000025%d,001" % n))
+                shutil.copy(os.path.join(image_folder_path, "0000255,001.tif"), os.path.join(folder, "000025%d,001.tif" % n))
+
+            results = {}
+            for workers in [1, 4]:
+                with patch.dict('ADSScanExplorerPipeline.ingestor.config', {'IMAGE_PARSE_WORKERS': workers}):
+                    results[workers] = [(page.name, page.width, page.height, page.color_type) for page in parse_image_files(folder, vol, None)]
+            self.assertEqual(len(results[1]), 10)
+            self.assertEqual(results[1], results[4])
+
+            with open(os.path.join(folder, "0000253,001.tif"), "w") as file:
+                file.write("not a tiff")
+            errors = {}
+            for workers in [1, 4]:
+                with patch.dict('ADSScanExplorerPipeline.ingestor.config', {'IMAGE_PARSE_WORKERS': workers}):
+                    pages = []
+                    with self.assertRaises(Exception) as context:
+                        for page in parse_image_files(folder, vol, None):
+                            pages.append(page.name)
+                    errors[workers] = (pages, str(context.exception))
+            self.assertEqual(errors[1], errors[4])
+            self.assertEqual(len(errors[1][0]), 5)
+            self.assertTrue(errors[1][1].startswith("Failed to parse image file: " + os.path.join(folder, "0000253,001.tif")))
+
+    @patch('ADSScanExplorerPipeline.models.Page.get_all_from_volume')
+    def test_parse_image_files_wrong_page(self, get_all_from_volume):
+        vol = JournalVolume("seri", "test.", "0001")
+        get_all_from_volume.return_value = [Page("0000256,001", vol.id)]
         image_folder_path = os.path.join(self.data_folder,  "bitmaps", vol.type, vol.journal, vol.volume, "600")
         for page in parse_image_files(image_folder_path, vol, None):
             raise ValueError("Should not be here")
 
+    def test_read_tiff_header(self):
+        image_folder_path = os.path.join(self.data_folder,  "bitmaps", "seri", "test.", "0001", "600")
+        for filename in ["0000255,001", "0000255,001.tif"]:
+            file_path = os.path.join(image_folder_path, filename)
+            self.assertEqual(read_tiff_header(file_path), read_tiff_header_with_pil(file_path))
+        self.assertEqual(read_tiff_header(os.path.join(image_folder_path, "0000255,001")), (4320, 5312, 1))
+        self.assertEqual(read_tiff_header(os.path.join(image_folder_path, "0000255,001.tif")), (4304, 5312, 1))
+
+    def test_read_tiff_header_big_endian(self):
+        ifd_entries = [(256, 4, 1, struct.pack(">I", 4320)), (257, 3, 1, struct.pack(">HH", 5312, 0)), (258, 3, 3, struct.pack(">I", 50))]
+        header = b"MM" + struct.pack(">HI", 42, 8) + struct.pack(">H", len(ifd_entries))
+        for tag, field_type, count, value in ifd_entries:
+            header += struct.pack(">HHI", tag, field_type, count) + value
+        with tempfile.NamedTemporaryFile() as file:
+            file.write(header + struct.pack(">I", 0))
+            file.flush()
+            self.assertEqual(read_tiff_header(file.name), (4320, 5312, 3))
+
+    @patch('ADSScanExplorerPipeline.ingestor.read_tiff_header_with_pil')
+    def test_read_tiff_header_falls_back_to_pil(self, read_tiff_header_with_pil):
+        read_tiff_header_with_pil.return_value = (1, 2, 3)
+        big_tiff_header = b"II" + struct.pack("<HHHQ", 43, 8, 0, 16)
+        with tempfile.NamedTemporaryFile() as file:
+            file.write(big_tiff_header)
+            file.flush()
+            self.assertEqual(read_tiff_header(file.name), (1, 2, 3))
+            read_tiff_header_with_pil.assert_called_once_with(file.name)
+
     @patch('ADSScanExplorerPipeline.models.Page.get_all_from_volume')
     def test_parse_image_files_not_missing_page(self, get_all_from_volume):
         vol = JournalVolume("seri", "test.", "0001")
@@ -149,16 +381,15 @@ class TestIngestor(unittest.TestCase):
         self.assertRaises(MissingImageFileException, check_all_image_files_exists, image_folder_path, vol, None)
 
     @mock_s3
-    @patch('ADSScanExplorerPipeline.models.Page.get_from_name_and_journal')
-    def test_upload_images(self, get_from_name_and_journal):
+    @patch('ADSScanExplorerPipeline.models.Page.get_names_from_volume')
+    def test_upload_images(self, get_names_from_volume):
         """ Makes sure the files are uploaded to a mock s3 bucket"""
-        vol = JournalVolume("seri", "test.", "0001")
+        vol, session = self.get_empty_volume_session()
         image_folder_path = os.path.join(self.data_folder, "bitmaps", vol.type, vol.journal, vol.volume, "600")
-        expected_page =  Page("0000255,001", vol.id)
-        get_from_name_and_journal.return_value = expected_page
+        get_names_from_volume.return_value = {"0000255,001"}
         conn = boto3.resource('s3')
         bucket = conn.create_bucket(Bucket='scan-explorer')
-        upload_image_files(image_folder_path, vol, None)
+        upload_image_files(image_folder_path, vol, session)
         keys = []
         for obj in bucket.objects.all():
             keys.append(obj.key)
@@ -166,6 +397,350 @@ class TestIngestor(unittest.TestCase):
         self.assertTrue('bitmaps/seri/test_/0001/600/0000255,001' in keys)
         self.assertTrue('bitmaps/seri/test_/0001/600/0000255,001.tif' in keys)
     
+    @mock_s3
+    @patch('ADSScanExplorerPipeline.models.Page.get_names_from_volume')
+    def test_upload_images_multipart(self, get_names_from_volume):
+        """ Makes sure files above the multipart threshold are uploaded intact"""
+        vol, session = self.get_empty_volume_session()
+        image_folder_path = os.path.join(self.data_folder, "bitmaps", vol.type, vol.journal, vol.volume, "600")
+        get_names_from_volume.return_value = {"0000255,001"}
+        conn = boto3.resource('s3')
+        bucket = conn.create_bucket(Bucket='scan-explorer')
+        with patch.dict('ADSScanExplorerPipeline.ingestor.config', {'S3_MULTIPART_THRESHOLD': 512 * 1024, 'S3_UPLOAD_WORKERS': 2}):
+            upload_image_files(image_folder_path, vol, session)
+        obj = bucket.Object('bitmaps/seri/test_/0001/600/0000255,001.tif').get()
+        with open(os.path.join(image_folder_path, "0000255,001.tif"), "rb") as file:
+            self.assertEqual(obj['Body'].read(), file.read())
+        self.assertIn('-', obj['ETag'])
+
+    @mock_s3
+    @patch('ADSScanExplorerPipeline.models.Page.get_names_from_volume')
+    def test_upload_images_failed(self, get_names_from_volume):
+        """ Makes sure the stage fails if any file fails to upload"""
+        vol, session = self.get_empty_volume_session()
+        image_folder_path = os.path.join(self.data_folder, "bitmaps", vol.type, vol.journal, vol.volume, "600")
+        get_names_from_volume.return_value = {"0000255,001"}
+        conn = boto3.resource('s3')
+        bucket = conn.create_bucket(Bucket='scan-explorer')
+        s3_client = get_s3_client()
+        upload_file = s3_client.upload_file
+        def failing_upload_file(file_path, *args, **kwargs):
+            if file_path.endswith(".tif"):
+                raise IOError("connection reset")
+            return upload_file(file_path, *args, **kwargs)
+        with patch.object(s3_client, 'upload_file', side_effect=failing_upload_file):
+            with self.assertRaisesRegex(Exception, "Failed to upload 1 of 2 image files: .*0000255,001.tif: connection reset"):
+                upload_image_files(image_folder_path, vol, session)
+        self.assertEqual([obj.key for obj in bucket.objects.all()], ['bitmaps/seri/test_/0001/600/0000255,001'])
+
+    @mock_s3
+    @patch('ADSScanExplorerPipeline.models.Page.get_names_from_volume')
+    def test_upload_images_resume(self, get_names_from_volume):
+        """ Makes sure a rerun after a failed upload continues with the files that were not uploaded"""
+        vol, session = self.get_empty_volume_session()
+        image_folder_path = os.path.join(self.data_folder, "bitmaps", vol.type, vol.journal, vol.volume, "600")
+        get_names_from_volume.return_value = {"0000255,001"}
+        conn = boto3.resource('s3')
+        conn.create_bucket(Bucket='scan-explorer')
+        s3_client = get_s3_client()
+        upload_file = s3_client.upload_file
+        def failing_upload_file(file_path, *args, **kwargs):
+            if file_path.endswith(".tif"):
+                raise IOError("connection reset")
+            return upload_file(file_path, *args, **kwargs)
+        with patch.object(s3_client, 'upload_file', side_effect=failing_upload_file):
+            with self.assertRaises(Exception):
+                upload_image_files(image_folder_path, vol, session)
+        self.assertEqual(VolumeStageCheckpoint.get_completed(vol.id, 'upload-images', session), {'0000255,001'})
+
+        with patch.object(s3_client, 'upload_file', side_effect=upload_file) as resumed_upload_file:
+            self.assertEqual(upload_image_files(image_folder_path, vol, session), (1, 1))
+        self.assertEqual([call[0][0] for call in resumed_upload_file.call_args_list], [os.path.join(image_folder_path, "0000255,001.tif")])
+        self.assertEqual(VolumeStageCheckpoint.get_completed(vol.id, 'upload-images', session), set())
+
+    @mock_s3
+    @patch('ADSScanExplorerPipeline.models.Page.get_names_from_volume')
+    def test_upload_images_incremental(self, get_names_from_volume):
+        """ Makes sure only new or changed files are uploaded again"""
+        vol, session = self.get_empty_volume_session()
+        image_folder_path = os.path.join(self.data_folder, "bitmaps", vol.type, vol.journal, vol.volume, "600")
+        get_names_from_volume.return_value = {"0000255,001", "0000256,001"}
+        conn = boto3.resource('s3')
+        bucket = conn.create_bucket(Bucket='scan-explorer')
+        with tempfile.TemporaryDirectory() as folder:
+            for filename in os.listdir(image_folder_path):
+                shutil.copy(os.path.join(image_folder_path, filename), folder)
+            #Multipart upload for the .tif to also compare multipart ETags
+            with patch.dict('ADSScanExplorerPipeline.ingestor.config', {'S3_MULTIPART_THRESHOLD': 512 * 1024}):
+                self.assertEqual(upload_image_files(folder, vol, session), (2, 0))
+                self.assertEqual(upload_image_files(folder, vol, session), (0, 2))
+
+                with open(os.path.join(folder, "0000255,001"), "ab") as file:
+                    file.write(b"\0")
+                shutil.copy(os.path.join(image_folder_path, "0000255,001"), os.path.join(folder, "0000256,001"))
+                self.assertEqual(upload_image_files(folder, vol, session), (2, 1))
+
+        keys = [obj.key for obj in bucket.objects.all()]
+        self.assertEqual(len(keys), 3)
+        self.assertEqual(bucket.Object('bitmaps/seri/test_/0001/600/0000255,001').content_length, os.path.getsize(os.path.join(image_folder_path, "0000255,001")) + 1)
+
+    @mock_s3
+    @patch('ADSScanExplorerPipeline.models.Page.get_names_from_volume')
+    def test_upload_images_default_config_objects(self, get_names_from_volume):
+        """ Makes sure objects uploaded earlier in parts with the boto3 default config are not uploaded again"""
+        vol, session = self.get_empty_volume_session()
+        get_names_from_volume.return_value = {"0000255,001"}
+        conn = boto3.resource('s3')
+        bucket = conn.create_bucket(Bucket='scan-explorer')
+        with tempfile.TemporaryDirectory() as folder:
+            file_path = os.path.join(folder, "0000255,001.tif")
+            with open(file_path, "wb") as file:
+                file.write(os.urandom(20 * 1024 * 1024))
+            get_s3_client().upload_file(file_path, 'scan-explorer', 'bitmaps/seri/test_/0001/600/0000255,001.tif')
+            self.assertTrue(bucket.Object('bitmaps/seri/test_/0001/600/0000255,001.tif').e_tag.endswith('-3"'))
+            self.assertEqual(upload_image_files(folder, vol, session), (0, 1))
+
+            with open(file_path, "r+b") as file:
+                file.write(b"\0" * 16)
+            self.assertEqual(upload_image_files(folder, vol, session), (1, 0))
+
+    def test_s3_client_reused(self):
+        self.assertIs(get_s3_client(), get_s3_client())
+
+    @patch('sqlalchemy.orm.Session')
+    def test_bulk_insert_copy(self, Session):
+        """ Makes sure rows are sent as csv to COPY on postgres keeping NULL and empty strings apart"""
+        session = Session.return_value
+        session.get_bind.return_value.dialect.name = "postgresql"
+        cursor = session.connection.return_value.connection.cursor.return_value
+        copied = []
+        cursor.copy_expert.side_effect = lambda sql, buffer: copied.append((sql, buffer.read()))
+        bulk_insert(session, Article.__table__, ['bibcode', 'journal_volume_id', 'start_page_number'], [("a,b", "", None), ("c\"d", "vol", 12)])
+        self.assertEqual(copied[0][0], "COPY article (bibcode, journal_volume_id, start_page_number) FROM STDIN WITH (FORMAT csv, NULL '\\N')")
+        self.assertEqual(copied[0][1], '"a,b",,\\N\r\n"c""d",vol,12\r\n')
+        session.execute.assert_not_called()
+
+    def test_update_volume(self):
+        """ Makes sure only the added, changed and removed rows are written when a volume is reprocessed"""
+        engine = create_engine("sqlite://")
+        Base.metadata.create_all(engine)
+        session = sessionmaker(bind=engine)()
+        vol = JournalVolume("seri", "test.", "0001")
+        session.add(vol)
+        session.commit()
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            top_file_path = os.path.join(tmp_dir, "test.0001.top")
+            dat_file_path = os.path.join(tmp_dir, "test.0001.dat")
+            for page_name in ["0000255,001", "0000256.000", "0000257.000"]:
+                shutil.copy(os.path.join(self.data_folder, "bitmaps/seri/test./0001/600/0000255,001"), os.path.join(tmp_dir, page_name))
+            with open(top_file_path, "w") as file:
+                file.write("0000255,001 255-01\n0000256.000\n")
+            with open(dat_file_path, "w") as file:
+                file.write("test......001..test\tseri/test./0001/ 012 0000255,001\n")
+                file.write("test......002..test\tseri/test./0001/ 012 0000256.000\n")
+            self.assertEqual(load_volume(top_file_path, dat_file_path, tmp_dir, vol, session), (2, 2))
+            session.commit()
+            created = session.execute("SELECT created FROM page WHERE name = '0000255,001'").scalar()
+
+            with open(top_file_path, "w") as file:
+                file.write("0000255,001 i\n0000257.000\n")
+            with open(dat_file_path, "w") as file:
+                file.write("test......001..test\tseri/test./0001/ 012 0000255,001\n")
+                file.write("test......002..test\tseri/test./0001/ 012 0000257.000\n")
+            changes = update_volume(top_file_path, dat_file_path, tmp_dir, vol, session)
+            session.commit()
+
+        self.assertEqual(changes, {'page': (1, 1, 1), 'article': (0, 0, 0), 'page2article': (1, 0, 1)})
+        self.assertEqual(session.execute("SELECT name, label, volume_running_page_num FROM page ORDER BY name").fetchall(), [('0000255,001', 'i', 1), ('0000257.000', '257', 2)])
+        self.assertEqual(session.execute("SELECT page_id, article_id FROM page2article ORDER BY page_id").fetchall(),
+            [('test.0001_0000255,001', 'test......001..test'), ('test.0001_0000257.000', 'test......002..test')])
+        self.assertEqual(session.execute("SELECT created FROM page WHERE name = '0000255,001'").scalar(), created)
+
+    def test_update_volume_inserted_page(self):
+        """ Makes sure a page inserted at the start of the volume renumbers the following pages without colliding on the running page numbers"""
+        engine = create_engine("sqlite://")
+        Base.metadata.create_all(engine)
+        session = sessionmaker(bind=engine)()
+        vol = JournalVolume("seri", "test.", "0001")
+        session.add(vol)
+        session.commit()
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            top_file_path = os.path.join(tmp_dir, "test.0001.top")
+            dat_file_path = os.path.join(tmp_dir, "test.0001.dat")
+            for page_name in ["0000254.000", "0000255.000", "0000256.000", "0000257.000"]:
+                shutil.copy(os.path.join(self.data_folder, "bitmaps/seri/test./0001/600/0000255,001"), os.path.join(tmp_dir, page_name))
+            with open(dat_file_path, "w") as file:
+                file.write("test......255..test\tseri/test./0001/ 012 0000255.000 0000256.000 0000257.000\n")
+            with open(top_file_path, "w") as file:
+                file.write("0000255.000\n0000256.000\n0000257.000\n")
+            self.assertEqual(load_volume(top_file_path, dat_file_path, tmp_dir, vol, session), (3, 1))
+            session.commit()
+
+            with open(top_file_path, "w") as file:
+                file.write("0000254.000\n0000255.000\n0000256.000\n0000257.000\n")
+            changes = update_volume(top_file_path, dat_file_path, tmp_dir, vol, session)
+            session.commit()
+
+        self.assertEqual(changes, {'page': (1, 3, 0), 'article': (0, 1, 0), 'page2article': (0, 0, 0)})
+        self.assertEqual(session.execute("SELECT name, volume_running_page_num FROM page ORDER BY name").fetchall(),
+            [('0000254.000', 1), ('0000255.000', 2), ('0000256.000', 3), ('0000257.000', 4)])
+
+    def test_generate_volume_json(self):
+        """ Makes sure the streamed volume json is the same as the volume dict sent by requests and takes two queries"""
+        engine = create_engine("sqlite://")
+        Base.metadata.create_all(engine)
+        session = sessionmaker(bind=engine)()
+        vol = JournalVolume("seri", "test.", "0002")
+        session.add(vol)
+        top_file_path = os.path.join(self.data_folder, "problematic_lists", "test.0002.top")
+        dat_file_path = os.path.join(self.data_folder, "problematic_lists", "test.0002.dat")
+        pages = {}
+        for n, record in enumerate(parse_top_file(top_file_path, vol, session)):
+            record.width = 100 + n
+            record.height = 200
+            pages[record.name] = record.to_page()
+            session.add(pages[record.name])
+        session.flush()
+        for article in parse_dat_file(dat_file_path, vol, session):
+            session.add(article.to_article(pages))
+        session.commit()
+        session.refresh(vol)
+
+        statements = []
+        def count_statement(conn, cursor, statement, *args):
+            statements.append(statement)
+        event.listen(engine, "before_cursor_execute", count_statement)
+        with patch.dict('ADSScanExplorerPipeline.ingestor.config', {'SERVICE_DB_PUSH_CHUNK_SIZE': 2}):
+            chunks = list(generate_volume_json(vol, session))
+        event.remove(engine, "before_cursor_execute", count_statement)
+        self.assertEqual(len(statements), 2)
+        self.assertEqual(len(chunks), 3)
+        self.assertEqual(b"".join(chunks), requests.Request('PUT', 'http://localhost', json=vol.to_dict()).prepare().body)
+
+    def test_volume_to_dict_query_count(self):
+        """ Makes sure the volume dict is built with the same number of queries whatever the number of pages"""
+        queries = {}
+        for n_pages in [2, 40]:
+            vol, session = self.get_empty_volume_session()
+            pages = {}
+            for n in range(n_pages):
+                record = PageRecord("%07d.000" % (n + 1), vol.id)
+                record.volume_running_page_num = n + 1
+                pages[record.name] = record.to_page()
+                session.add(pages[record.name])
+            for n in range(0, n_pages, 2):
+                article = ArticleRecord("article%05d" % n, vol.id)
+                article.pages = [PageRecord("%07d.000" % (n + 1), vol.id), PageRecord("%07d.000" % (n + 2), vol.id)]
+                session.add(article.to_article(pages))
+            session.commit()
+            session.refresh(vol)
+
+            statements = []
+            def count_statement(conn, cursor, statement, *args):
+                statements.append(statement)
+            event.listen(session.bind, "before_cursor_execute", count_statement)
+            volume_dict = vol.to_dict()
+            event.remove(session.bind, "before_cursor_execute", count_statement)
+            queries[n_pages] = len(statements)
+            self.assertEqual(len(volume_dict['pages']), n_pages)
+            self.assertEqual(volume_dict['pages'][-1]['articles'], [{'bibcode': "article%05d" % (n_pages - 2)}])
+        self.assertEqual(queries, {2: 2, 40: 2})
+
+    def start_stub_service(self, **push_config):
+        StubServiceHandler.requests = []
+        StubServiceHandler.statuses = []
+        StubServiceHandler.delays = []
+        StubServiceHandler.bodies = []
+        server = ThreadingHTTPServer(("127.0.0.1", 0), StubServiceHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        push_config['SERVICE_DB_PUSH_URL'] = "http://127.0.0.1:%d/metadata/collection" % server.server_address[1]
+        push_config['SERVICE_DB_BATCH_PUSH_URL'] = "http://127.0.0.1:%d/metadata/collections" % server.server_address[1]
+        push_config.setdefault('SERVICE_DB_PUSH_INITIAL_BACKOFF', 0)
+        config_patch = patch.dict('ADSScanExplorerPipeline.ingestor.config', push_config)
+        config_patch.start()
+        self.addCleanup(config_patch.stop)
+
+    def get_empty_volume_session(self):
+        engine = create_engine("sqlite://")
+        Base.metadata.create_all(engine)
+        session = sessionmaker(bind=engine)()
+        vol = JournalVolume("seri", "test.", "0001")
+        session.add(vol)
+        session.commit()
+        return vol, session
+
+    def test_push_volume_json_retries(self):
+        """ Makes sure 5xx responses are retried on the pooled connection with the whole gzip body sent again"""
+        vol, session = self.get_empty_volume_session()
+        self.start_stub_service(SERVICE_DB_PUSH_GZIP=True)
+        StubServiceHandler.statuses = [503, 502]
+        response = push_volume_json(vol, session)
+        self.assertEqual(response.status, 200)
+        self.assertEqual(len(StubServiceHandler.requests), 3)
+        expected_body = requests.Request('PUT', 'http://localhost', json=vol.to_dict()).prepare().body
+        for port, headers, body in StubServiceHandler.requests:
+            self.assertEqual(body, expected_body)
+            self.assertEqual(headers['Content-Encoding'], 'gzip')
+            self.assertEqual(headers['Authorization'], 'Bearer:CHANGE-ME')
+        #Keep alive connection reused between attempts
+        self.assertEqual(len(set(port for port, headers, body in StubServiceHandler.requests)), 1)
+
+    def test_push_volume_json_retries_exhausted(self):
+        vol, session = self.get_empty_volume_session()
+        self.start_stub_service(SERVICE_DB_PUSH_MAX_RETRIES=1)
+        StubServiceHandler.statuses = [500, 500]
+        response = push_volume_json(vol, session)
+        self.assertEqual(response.status, 500)
+        self.assertEqual(len(StubServiceHandler.requests), 2)
+        self.assertNotIn('Content-Encoding', StubServiceHandler.requests[0][1])
+
+    def test_push_volume_json_timeout(self):
+        """ Makes sure a request timing out is retried and raised once the retries are used up"""
+        vol, session = self.get_empty_volume_session()
+        self.start_stub_service(SERVICE_DB_PUSH_READ_TIMEOUT=0.2, SERVICE_DB_PUSH_MAX_RETRIES=1)
+        StubServiceHandler.delays = [1]
+        self.assertEqual(push_volume_json(vol, session).status, 200)
+        self.assertEqual(len(StubServiceHandler.requests), 2)
+
+        StubServiceHandler.delays = [1, 1]
+        with self.assertRaises(urllib3.exceptions.ReadTimeoutError):
+            push_volume_json(vol, session)
+
+    def test_push_volume_batch(self):
+        """ Makes sure volumes are grouped by page count and the per volume results of the batch are mapped back"""
+        engine = create_engine("sqlite://")
+        Base.metadata.create_all(engine)
+        session = sessionmaker(bind=engine)()
+        vols = []
+        for volume, n_pages in [("0001", 1), ("0002", 1), ("0003", 3)]:
+            vol = JournalVolume("seri", "test.", volume)
+            session.add(vol)
+            for n in range(n_pages):
+                page = Page("%07d.000" % (n + 1), vol.id)
+                page.volume_running_page_num = n + 1
+                session.add(page)
+            vols.append(vol)
+        session.commit()
+        self.start_stub_service(SERVICE_DB_BATCH_MAX_PAGES=2)
+
+        batches = list(batch_volumes_json(vols, session))
+        self.assertEqual([[vol.id for vol, data in batch] for batch in batches], [["test.0001", "test.0002"], ["test.0003"]])
+        StubServiceHandler.bodies = [json.dumps([{"status": 200}, {"status": 400, "message": "invalid"}]).encode()]
+        self.assertEqual(push_volume_batch(batches[0]), {"test.0001": True, "test.0002": False})
+        self.assertEqual(json.loads(StubServiceHandler.requests[0][2]), [vols[0].to_dict(), vols[1].to_dict()])
+        self.assertEqual(StubServiceHandler.requests[0][1]['Transfer-Encoding'], 'chunked')
+
+        StubServiceHandler.bodies = [b"[]"]
+        with self.assertRaisesRegex(Exception, "Expected 1 volume results"):
+            push_volume_batch(batches[1])
+        StubServiceHandler.statuses = [404]
+        with self.assertRaises(Exception):
+            push_volume_batch(batches[1])
+
     def test_parse_problematic_files(self):
         session = UnifiedAlchemyMagicMock()
         vol = JournalVolume("seri", "test.", "0002")
@@ -174,10 +749,138 @@ class TestIngestor(unittest.TestCase):
         top_file_path = os.path.join(self.data_folder, "problematic_lists", top_filename)
         dat_file_path = os.path.join(self.data_folder, "problematic_lists", dat_filename)
 
-        for page in parse_top_file(top_file_path, vol, session):
-            session.add(page)
+        pages = {}
+        for record in parse_top_file(top_file_path, vol, session):
+            pages[record.name] = record.to_page()
+            session.add(pages[record.name])
         for article in parse_dat_file(dat_file_path, vol, session):
-            session.add(article)
+            session.add(article.to_article(pages))
 
         self.assertEqual(session.query(Page).count(),5)
         self.assertEqual(session.query(Article).count(),2)
+
+    def test_parse_dat_file_query_count(self):
+        """ Makes sure the .dat file is resolved against the volume with a constant number of queries"""
+        engine = create_engine("sqlite://")
+        Base.metadata.create_all(engine)
+        session = sessionmaker(bind=engine)()
+        vol = JournalVolume("seri", "test.", "0002")
+        session.add(vol)
+        top_file_path = os.path.join(self.data_folder, "problematic_lists", "test.0002.top")
+        dat_file_path = os.path.join(self.data_folder, "problematic_lists", "test.0002.dat")
+        for record in parse_top_file(top_file_path, vol, session):
+            session.add(record.to_page())
+        session.commit()
+        session.refresh(vol)
+
+        statements = []
+        def count_statement(conn, cursor, statement, *args):
+            statements.append(statement)
+        event.listen(engine, "before_cursor_execute", count_statement)
+        articles = list(parse_dat_file(dat_file_path, vol, session))
+        event.remove(engine, "before_cursor_execute", count_statement)
+        selects = [statement for statement in statements if statement.lstrip().upper().startswith("SELECT")]
+        self.assertEqual(len(selects), 2)
+
+        self.assertEqual(len(articles), 2)
+        self.assertEqual(articles[0].start_page_number, 1)
+        self.assertEqual([page.name for page in articles[0].pages], ["0000255,001"])
+        self.assertEqual(articles[1].start_page_number, 5)
+        self.assertEqual([page.name for page in articles[1].pages], ["0001062.000"])
+
+    def test_parse_dat_file_missing_page(self):
+        engine = create_engine("sqlite://")
+        Base.metadata.create_all(engine)
+        session = sessionmaker(bind=engine)()
+        vol = JournalVolume("seri", "test.", "0002")
+        session.add(vol)
+        session.commit()
+        dat_file_path = os.path.join(self.data_folder, "problematic_lists", "test.0002.dat")
+        with self.assertRaisesRegex(Exception, "Page: 0000255,001 in .dat but not .top"):
+            list(parse_dat_file(dat_file_path, vol, session))
+
+    @patch('ADSScanExplorerPipeline.models.Page.get_records_from_volume')
+    def test_index_ocr_files_bulk(self, get_records_from_volume):
+        """ Makes sure ocr pages are sent in bulk chunks, rejected documents are retried and failures counted"""
+        _, session = self.get_empty_volume_session()
+        vol = JournalVolume("seri", "test.", "0001")
+        texts = ["page 1", "reject", "page 3", "fail", "page 5"]
+        pages = []
+        for n, text in enumerate(texts):
+            pages.append(PageRecord("000000%d.000" % (n + 1), vol.id))
+        get_records_from_volume.return_value = pages
+        MockBulkConnection.requests = []
+        MockBulkConnection.rejected = set()
+
+        with tempfile.TemporaryDirectory() as ocr_path:
+            for page, text in zip(pages, texts):
+                with open(os.path.join(ocr_path, page.name + ".txt"), "w") as file:
+                    file.write(text)
+            client = opensearchpy.OpenSearch(connection_class=MockBulkConnection)
+            with patch('opensearchpy.OpenSearch', return_value=client), \
+                    patch.dict('ADSScanExplorerPipeline.ingestor.config', {'OPEN_SEARCH_BULK_CHUNK_SIZE': 2, 'OPEN_SEARCH_BULK_INITIAL_BACKOFF': 0}):
+                indexed, failed = index_ocr_files(ocr_path, vol, session)
+
+        self.assertEqual(indexed, 4)
+        self.assertEqual(failed, 1)
+        urls = [url for method, url, body in MockBulkConnection.requests]
+        self.assertTrue(urls[0].endswith("/_delete_by_query"))
+        #3 chunks of at most 2 documents and one retry of the rejected document
+        self.assertEqual(len([url for url in urls if url.endswith("/_bulk")]), 4)
+
+    def test_generate_ocr_documents(self):
+        """ Makes sure the ocr documents are built from page records and the article bibcodes with two queries"""
+        vol, session = self.get_empty_volume_session()
+        top_file_path = os.path.join(self.data_folder, "lists", vol.type, vol.journal, "test.0001.top")
+        image_path = os.path.join(self.data_folder, "bitmaps", vol.type, vol.journal, vol.volume, "600")
+        load_volume(top_file_path, top_file_path.replace(".top", ".dat"), image_path, vol, session)
+        session.commit()
+        session.refresh(vol)
+
+        statements = []
+        def count_statement(conn, cursor, statement, *args):
+            statements.append(statement)
+        event.listen(session.bind, "before_cursor_execute", count_statement)
+        with tempfile.TemporaryDirectory() as ocr_path:
+            documents = list(generate_ocr_documents(ocr_path, vol, session))
+        event.remove(session.bind, "before_cursor_execute", count_statement)
+        self.assertEqual(len(statements), 2)
+        self.assertEqual(len(documents), 1)
+        self.assertEqual(documents[0]['_id'], "test.0001_0000255,001")
+        self.assertEqual(documents[0]['_source']['article_bibcodes'], ["test......001..test"])
+        self.assertEqual((documents[0]['_source']['page_number'], documents[0]['_source']['page_color']), (1, "Grayscale"))
+
+    @patch('ADSScanExplorerPipeline.models.Page.get_records_from_volume')
+    def test_index_ocr_files_resume(self, get_records_from_volume):
+        """ Makes sure a rerun after failed documents keeps the indexed pages and only sends the remaining ones"""
+        _, session = self.get_empty_volume_session()
+        vol = JournalVolume("seri", "test.", "0001")
+        texts = ["page 1", "page 2", "fail"]
+        pages = []
+        for n, text in enumerate(texts):
+            pages.append(PageRecord("000000%d.000" % (n + 1), vol.id))
+        get_records_from_volume.return_value = pages
+        MockBulkConnection.requests = []
+        MockBulkConnection.rejected = set()
+
+        with tempfile.TemporaryDirectory() as ocr_path:
+            for page, text in zip(pages, texts):
+                with open(os.path.join(ocr_path, page.name + ".txt"), "w") as file:
+                    file.write(text)
+            client = opensearchpy.OpenSearch(connection_class=MockBulkConnection)
+            with patch('opensearchpy.OpenSearch', return_value=client), \
+                    patch.dict('ADSScanExplorerPipeline.ingestor.config', {'STAGE_CHECKPOINT_INTERVAL': 1}):
+                self.assertEqual(index_ocr_files(ocr_path, vol, session), (2, 1))
+                self.assertEqual(VolumeStageCheckpoint.get_completed(vol.id, 'index-ocr', session), {pages[0].id, pages[1].id})
+
+                with open(os.path.join(ocr_path, pages[2].name + ".txt"), "w") as file:
+                    file.write("page 3")
+                MockBulkConnection.requests = []
+                self.assertEqual(index_ocr_files(ocr_path, vol, session), (3, 0))
+
+        urls = [url for method, url, body in MockBulkConnection.requests]
+        self.assertEqual(len(urls), 1)
+        self.assertTrue(urls[0].endswith("/_bulk"))
+        self.assertIn(b"page 3", MockBulkConnection.requests[0][2])
+        self.assertNotIn(b"page 1", MockBulkConnection.requests[0][2])
+        self.assertEqual(VolumeStageCheckpoint.get_completed(vol.id, 'index-ocr', session), set())
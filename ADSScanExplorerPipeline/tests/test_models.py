@@ -1,5 +1,9 @@
 import unittest
-from  ADSScanExplorerPipeline.models import PageType, Page
+from datetime import datetime
+from sqlalchemy import create_engine, event
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import sessionmaker
+from  ADSScanExplorerPipeline.models import Base, JournalVolume, PageType, PageColor, Page, PageRecord, ArticleRecord, page_label_from_name
 from  ADSScanExplorerPipeline.exceptions import PageNameException
 
 class TestModels(unittest.TestCase):
@@ -26,3 +30,68 @@ class TestModels(unittest.TestCase):
         self.assertEqual(page.label, "A-255-1")
 
         self.assertRaises(PageNameException, Page, "00023232", "")
+
+    def testPageLabelFromName(self):
+        self.assertEqual(page_label_from_name("0000000.000"), "0")
+        self.assertEqual(page_label_from_name("0010200.120"), "10200-120")
+        self.assertEqual(page_label_from_name("B000012P003"), "B-12-3")
+        #Names that aren't plain digits get the labels int() gives
+        self.assertEqual(page_label_from_name("0 00012.0_1"), "12-1")
+        self.assertEqual(page_label_from_name("0-00012.000"), "-12")
+        self.assertEqual(page_label_from_name("0\u0661\u0662\u0663\u0664\u0665\u0666.000"), "123456")
+        self.assertRaises(ValueError, page_label_from_name, "0abcdef.000")
+
+    def testPageRecord(self):
+        record = PageRecord("A000255P001", "vol_id")
+        self.assertEqual((record.id, record.label, record.page_type, record.color_type), ("vol_id_A000255P001", "A-255-1", PageType.Plate, PageColor.BW))
+        self.assertFalse(hasattr(record, "__dict__"))
+        self.assertRaises(PageNameException, PageRecord, "00023232", "")
+
+        record.label = "P12"
+        record.width = 4320
+        record.volume_running_page_num = 3
+        row = record.to_row()
+        self.assertEqual(row, ("vol_id_A000255P001", "A000255P001", "P12", "image/tiff", "BW", "Plate", 4320, None, "vol_id", 3))
+        page = record.to_page()
+        self.assertEqual((page.id, page.label, page.page_type, page.width, page.volume_running_page_num), ("vol_id_A000255P001", "P12", PageType.Plate, 4320, 3))
+        self.assertEqual(PageRecord.from_row((page.id, page.name, page.label, page.format, page.color_type, page.page_type, page.width,
+            page.height, page.journal_volume_id, page.volume_running_page_num)).to_row(), row)
+
+        article = ArticleRecord("bibcode", "vol_id")
+        article.pages = [record]
+        self.assertEqual(list(article.to_article({page.name: page}).pages), [page])
+
+    def testLookupQueryPlans(self):
+        """ Makes sure the volume and page lookups search the composite and status indexes instead of scanning the tables"""
+        engine = create_engine("sqlite://")
+        Base.metadata.create_all(engine)
+        session = sessionmaker(bind=engine)()
+        vol = JournalVolume("seri", "test.", "0001")
+        session.add(vol)
+        session.commit()
+
+        statements = []
+        def capture_statement(conn, cursor, statement, parameters, *args):
+            statements.append((statement, parameters))
+        #Searched index and columns of each lookup, the unique constraints on the volume and page names are indexed by SQLite itself
+        lookups = [
+            (lambda: Page.get_from_name_and_journal("0000255,001", vol.id, session), "(journal_volume_id=? AND name=?)"),
+            (lambda: JournalVolume.get_from_obj(vol, session), "(type=? AND journal=? AND volume=?)"),
+            (lambda: JournalVolume.get_all_from_journal("seri", "test.", session), "volume_type_index (type=? AND journal=?)"),
+            (lambda: JournalVolume.get_to_be_processed(session), "volume_status_index (status=?)"),
+            (lambda: JournalVolume.get_to_be_processed(session, datetime.utcnow()), "volume_status_index (status=?)"),
+        ]
+        for lookup, search in lookups:
+            statements.clear()
+            event.listen(engine, "before_cursor_execute", capture_statement)
+            lookup()
+            event.remove(engine, "before_cursor_execute", capture_statement)
+            statement, parameters = statements[-1]
+            cursor = session.connection().connection.cursor()
+            plan = " ".join(row[-1] for row in cursor.execute("EXPLAIN QUERY PLAN " + statement, parameters))
+            self.assertIn(search, plan)
+            self.assertNotIn("SCAN", plan)
+
+        #A second row for the same journal and volume is rejected by the unique index
+        with self.assertRaises(IntegrityError):
+            session.execute(JournalVolume.__table__.insert().values(id="other", type="seri", journal="test.", volume="0001"))
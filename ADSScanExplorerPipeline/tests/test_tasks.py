@@ -1,12 +1,24 @@
 from concurrent.futures import process
 import os
+import copy
+import shutil
+import tempfile
+import threading
 import unittest
+import requests
+from datetime import datetime, timedelta
 from unittest.mock import patch, MagicMock
 from alchemy_mock.mocking import UnifiedAlchemyMagicMock
-from ADSScanExplorerPipeline.tasks import task_investigate_new_volumes, task_process_volume, task_upload_image_files_for_volume, task_index_ocr_files_for_volume
-from ADSScanExplorerPipeline.models import JournalVolume, VolumeStatus, Page, PageColor, PageType, Article
+from ADSScanExplorerPipeline.tasks import task_investigate_new_volumes, task_process_volume, task_upload_image_files_for_volume, task_index_ocr_files_for_volume, task_process_db_for_volume
+from ADSScanExplorerPipeline.tasks import task_upload_db_for_volumes, task_process_new_volumes, task_upload_db_for_volume, merge_journal_volumes, volume_session_scope, lock_volume_scheduling
+from ADSScanExplorerPipeline.tasks import task_process_volume_batch, task_upload_db_for_batch, chain_volume_stages
+from ADSScanExplorerPipeline.models import Base, JournalVolume, VolumeStatus, Page, PageRecord, PageColor, PageType, Article, VolumeStageCheckpoint, VolumeStageMetrics
+from ADSScanExplorerPipeline.ingestor import build_volume_manifest, hash_volume_manifest, hash_volume_manifest_legacy, set_ingestion_error_status
 from moto import mock_s3
 import boto3
+from contextlib import nullcontext, contextmanager
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
 
 class TestTasks(unittest.TestCase):
 
@@ -25,6 +37,98 @@ class TestTasks(unittest.TestCase):
             self.assertEqual(vol.volume, "0001")
             self.assertEqual(vol.status, VolumeStatus.New)
         
+    @patch('ADSScanExplorerPipeline.app.ADSScanExplorerPipeline.session_scope')
+    @patch('ADSScanExplorerPipeline.tasks.task_process_new_volumes.delay')
+    def test_task_investigate_new_volumes_per_journal(self, process_new_volumes, session_scope):
+        """ Makes sure each journal is merged and sent for processing on its own"""
+        session = UnifiedAlchemyMagicMock()
+        failed_vol = JournalVolume("seri", "fail.", "0001")
+        failed_vol.status = VolumeStatus.Error
+        session.add(failed_vol)
+        session_scope.return_value.__enter__.return_value = session
+        with tempfile.TemporaryDirectory() as folder:
+            shutil.copytree(self.data_folder, folder, dirs_exist_ok=True)
+            for sub_dir in ["bitmaps", "ocr/full"]:
+                shutil.copytree(os.path.join(folder, sub_dir, "seri", "test."), os.path.join(folder, sub_dir, "seri", "tst2."))
+            os.makedirs(os.path.join(folder, "lists", "seri", "tst2."))
+            for extension in [".top", ".dat"]:
+                shutil.copy(os.path.join(folder, "lists", "seri", "test.", "test.0001" + extension), os.path.join(folder, "lists", "seri", "tst2.", "tst2.0001" + extension))
+
+            task_investigate_new_volumes(folder, process=True)
+
+        new_volumes = [vol for vol in session.query(JournalVolume).all() if vol.status == VolumeStatus.New]
+        self.assertEqual(sorted(vol.id for vol in new_volumes), ["test.0001", "tst2.0001"])
+        dispatched_ids = [call[1]['journal_volume_ids'] for call in process_new_volumes.call_args_list]
+        self.assertEqual(len(dispatched_ids), 3)
+        self.assertEqual(sorted(dispatched_ids[:2]), [["test.0001"], ["tst2.0001"]])
+        #Volumes failed in earlier runs are sent for processing after all journals are done
+        self.assertEqual(dispatched_ids[2], ["fail.0001"])
+
+    @patch('ADSScanExplorerPipeline.app.ADSScanExplorerPipeline.session_scope')
+    def test_task_investigate_updated_volumes(self, session_scope):
+        """ Makes sure only the flags of the stages affected by the changed files are reset"""
+        expected_flags = {
+            'lists': {'db_done': False, 'db_uploaded': False, 'bucket_uploaded': False, 'ocr_uploaded': False},
+            'bitmaps': {'db_done': False, 'db_uploaded': False, 'bucket_uploaded': False, 'ocr_uploaded': False},
+            'ocr': {'db_done': True, 'db_uploaded': True, 'bucket_uploaded': True, 'ocr_uploaded': False},
+        }
+        manifest = build_volume_manifest(self.data_folder, JournalVolume("seri", "test.", "0001"))
+        for category, flags in expected_flags.items():
+            existing_vol = JournalVolume("seri", "test.", "0001")
+            existing_vol.status = VolumeStatus.Done
+            existing_vol.db_done = existing_vol.db_uploaded = existing_vol.bucket_uploaded = existing_vol.ocr_uploaded = True
+            existing_vol.file_manifest = copy.deepcopy(manifest)
+            for file in existing_vol.file_manifest[category].values():
+                file[1] -= 1
+            existing_vol.file_hash = hash_volume_manifest(existing_vol.file_manifest)
+            session = UnifiedAlchemyMagicMock()
+            session.add(existing_vol)
+            session_scope.return_value.__enter__.return_value = session
+
+            task_investigate_new_volumes(self.data_folder, process=False)
+            self.assertEqual(existing_vol.status, VolumeStatus.Update)
+            self.assertEqual(existing_vol.file_manifest, manifest)
+            for flag, value in flags.items():
+                self.assertEqual(getattr(existing_vol, flag), value, category + " " + flag)
+
+    @patch('ADSScanExplorerPipeline.app.ADSScanExplorerPipeline.session_scope')
+    def test_task_investigate_legacy_hash_volumes(self, session_scope):
+        """ Makes sure volumes stored before the manifest only get it backfilled if their legacy hash still matches"""
+        manifest = build_volume_manifest(self.data_folder, JournalVolume("seri", "test.", "0001"))
+        for legacy_hash, status, flag in [(hash_volume_manifest_legacy(manifest), VolumeStatus.Done, True), ("changed", VolumeStatus.Update, False)]:
+            existing_vol = JournalVolume("seri", "test.", "0001")
+            existing_vol.status = VolumeStatus.Done
+            existing_vol.db_done = existing_vol.db_uploaded = existing_vol.bucket_uploaded = existing_vol.ocr_uploaded = True
+            existing_vol.file_hash = legacy_hash
+            session = UnifiedAlchemyMagicMock()
+            session.add(existing_vol)
+            session_scope.return_value.__enter__.return_value = session
+
+            task_investigate_new_volumes(self.data_folder, process=False)
+            self.assertEqual(existing_vol.status, status)
+            self.assertEqual(existing_vol.file_manifest, manifest)
+            self.assertEqual(existing_vol.file_hash, hash_volume_manifest(manifest))
+            for flag_name in ['db_done', 'db_uploaded', 'bucket_uploaded', 'ocr_uploaded']:
+                self.assertEqual(getattr(existing_vol, flag_name), flag)
+
+    def test_merge_journal_volumes_clears_checkpoints(self):
+        """ Makes sure the stage checkpoints of a volume are dropped when its files changed"""
+        session = self.get_volumes_session([("0001", VolumeStatus.Done, 0, 2), ("0002", VolumeStatus.Done, 0, 2)])
+        for volume_id in ["test.0001", "test.0002"]:
+            session.add(VolumeStageCheckpoint(volume_id, 'upload-images', '0000000.000'))
+        session.commit()
+        volumes = []
+        for volume, n_bitmaps in [("0001", 3), ("0002", 2)]:
+            vol = JournalVolume("seri", "test.", volume)
+            vol.file_manifest = {'lists': {}, 'bitmaps': {"%07d.000" % n: [1, 1] for n in range(n_bitmaps)}, 'ocr': {}}
+            vol.file_hash = hash_volume_manifest(vol.file_manifest)
+            volumes.append(vol)
+        JournalVolume.get("test.0002", session).file_hash = volumes[1].file_hash
+
+        self.assertEqual(merge_journal_volumes(volumes, session, False), ["test.0001"])
+        self.assertEqual(VolumeStageCheckpoint.get_completed("test.0001", 'upload-images', session), set())
+        self.assertEqual(VolumeStageCheckpoint.get_completed("test.0002", 'upload-images', session), {'0000000.000'})
+
     @patch('ADSScanExplorerPipeline.app.ADSScanExplorerPipeline.session_scope')
     @patch('ADSScanExplorerPipeline.models.JournalVolume.get_from_id_or_name')
     def test_task_process_volume(self, get_from_id_or_name, session_scope):
@@ -46,7 +150,9 @@ class TestTasks(unittest.TestCase):
         session = UnifiedAlchemyMagicMock()
         session_scope.return_value = session
 
-        used_session = task_process_volume(self.data_folder, vol.id, upload_files=False, index_ocr=False, upload_db=False)
+        #The mocked session only keeps objects added through the ORM
+        with patch.dict('ADSScanExplorerPipeline.tasks.config', {'DB_BULK_LOAD': False}):
+            used_session = task_process_volume(self.data_folder, vol.id, upload_files=False, index_ocr=False, upload_db=False)
         for vol in used_session.query(JournalVolume).filter().all():
             self.assertEqual(vol.type, "seri")
             self.assertEqual(vol.journal, "test.")
@@ -72,8 +178,8 @@ class TestTasks(unittest.TestCase):
             self.assertEqual(vol.to_dict(), expected_dict)
 
 
-        #Mocked session doesn't update the row but adds a new row when adding to the db therefore we get 3 identical rows
-        self.assertEqual(len(used_session.query(Page).filter().all()), 3)
+        #Pages are parsed into records and only added to the session once they are complete
+        self.assertEqual(len(used_session.query(Page).filter().all()), 1)
         for page in used_session.query(Page).filter(JournalVolume.journal == "").all():
             self.assertEqual(page.name, expected_page.name)
             self.assertEqual(page.label, expected_page.label)
@@ -89,19 +195,380 @@ class TestTasks(unittest.TestCase):
             self.assertEqual(article.bibcode, expected_article.bibcode)
             self.assertEqual(article.journal_volume_id, vol.id)
 
+    def test_task_process_db_for_volume_bulk_load(self):
+        """ Makes sure the bulk load and the diff update write the same rows as the ORM"""
+        rows = {}
+        for bulk_load, diff_update in [(False, False), (True, False), (True, True)]:
+            engine = create_engine("sqlite://")
+            Base.metadata.create_all(engine)
+            session = sessionmaker(bind=engine)()
+            session.add(JournalVolume("seri", "test.", "0001"))
+            session.commit()
+            with patch('ADSScanExplorerPipeline.app.ADSScanExplorerPipeline.session_scope', return_value=nullcontext(session)), \
+                    patch.dict('ADSScanExplorerPipeline.tasks.config', {'DB_BULK_LOAD': bulk_load, 'DB_DIFF_UPDATE': diff_update}):
+                #Run twice to replace the rows of the first run
+                task_process_db_for_volume(self.data_folder, "test.0001")
+                task_process_db_for_volume(self.data_folder, "test.0001")
+            vol = JournalVolume.get("test.0001", session)
+            self.assertTrue(vol.db_done)
+            rows[(bulk_load, diff_update)] = {
+                'page': session.execute("SELECT id, name, label, format, color_type, page_type, width, height, journal_volume_id, volume_running_page_num FROM page ORDER BY id").fetchall(),
+                'article': session.execute("SELECT bibcode, journal_volume_id, start_page_number FROM article ORDER BY bibcode").fetchall(),
+                'page2article': session.execute("SELECT page_id, article_id FROM page2article ORDER BY page_id, article_id").fetchall(),
+            }
+        self.assertEqual(rows[(True, False)], rows[(False, False)])
+        self.assertEqual(rows[(True, True)], rows[(False, False)])
+        self.assertEqual(rows[(True, True)]['page'], [('test.0001_0000255,001', '0000255,001', '255-01', 'image/tiff', 'Grayscale', 'FrontMatter', 4304, 5312, 'test.0001', 1)])
+        self.assertEqual(rows[(True, True)]['article'], [('test......001..test', 'test.0001', 1)])
+        self.assertEqual(rows[(True, True)]['page2article'], [('test.0001_0000255,001', 'test......001..test')])
+
+    def test_task_process_db_for_volume_metrics(self):
+        """ Makes sure a completed db stage stores its duration, parsed image files and SQL statements"""
+        session = self.get_volumes_session([("0001", VolumeStatus.New, 0, 0)])
+        with patch('ADSScanExplorerPipeline.app.ADSScanExplorerPipeline.session_scope', return_value=nullcontext(session)):
+            task_process_db_for_volume(self.data_folder, "test.0001")
+        metrics = session.query(VolumeStageMetrics).all()
+        self.assertEqual(len(metrics), 1)
+        self.assertEqual((metrics[0].journal_volume_id, metrics[0].stage, metrics[0].items), ("test.0001", "process-db", 2))
+        self.assertGreater(metrics[0].queries, 0)
+        self.assertGreater(metrics[0].duration, 0)
+
+    def test_task_process_volume_concurrent_stages(self):
+        """ Makes sure the stages after the db run at the same time in their own sessions and the volume is set to Done at the end"""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            engine = create_engine("sqlite:///" + os.path.join(tmp_dir, "test.db"), connect_args={'check_same_thread': False})
+            Base.metadata.create_all(engine)
+            Session = sessionmaker(bind=engine)
+            session = Session()
+            vol = JournalVolume("seri", "test.", "0001")
+            vol.db_done = True
+            session.add(vol)
+            session.commit()
+            session.close()
+
+            @contextmanager
+            def session_scope():
+                session = Session()
+                try:
+                    yield session
+                    session.commit()
+                except:
+                    session.rollback()
+                    raise
+                finally:
+                    session.close()
+
+            #Each stage only passes the barrier if the other two are running as well
+            barrier = threading.Barrier(3, timeout=5)
+            stage_threads = []
+            def stage(flag):
+                def run(*args):
+                    stage_threads.append(threading.current_thread())
+                    barrier.wait()
+                    with volume_session_scope() as session:
+                        setattr(JournalVolume.get_from_id_or_name("test.0001", session), flag, True)
+                return run
+            with patch('ADSScanExplorerPipeline.app.ADSScanExplorerPipeline.session_scope', side_effect=session_scope), \
+                    patch('ADSScanExplorerPipeline.tasks.task_upload_db_for_volume', side_effect=stage('db_uploaded')), \
+                    patch('ADSScanExplorerPipeline.tasks.task_index_ocr_files_for_volume', side_effect=stage('ocr_uploaded')), \
+                    patch('ADSScanExplorerPipeline.tasks.task_upload_image_files_for_volume', side_effect=stage('bucket_uploaded')):
+                task_process_volume(self.data_folder, "test.0001", process_db=False, chain_stages=False)
+            self.assertEqual(len(set(stage_threads)), 3)
+            session = Session()
+            vol = JournalVolume.get("test.0001", session)
+            self.assertTrue(vol.db_uploaded and vol.ocr_uploaded and vol.bucket_uploaded)
+            self.assertEqual(vol.status, VolumeStatus.Done)
+            session.close()
+            engine.dispose()
+
+    @patch('ADSScanExplorerPipeline.app.ADSScanExplorerPipeline.session_scope')
+    def test_volume_session_scope(self, session_scope):
+        """ Makes sure stages in the thread of the volume task reuse its session and stages in other threads open their own"""
+        session_scope.side_effect = lambda: nullcontext(MagicMock())
+        sessions = []
+        def stage(fail=False):
+            with volume_session_scope() as session:
+                sessions.append(session)
+                if fail:
+                    raise ValueError("failed")
+        with volume_session_scope() as outer_session:
+            stage()
+            outer_session.commit.assert_called_once()
+            with self.assertRaises(ValueError):
+                stage(fail=True)
+            outer_session.rollback.assert_called_once()
+            thread = threading.Thread(target=stage)
+            thread.start()
+            thread.join()
+        stage()
+        self.assertEqual(sessions[:2], [outer_session, outer_session])
+        self.assertNotIn(sessions[2], [outer_session, sessions[3]])
+        self.assertNotEqual(sessions[3], outer_session)
+        self.assertEqual(session_scope.call_count, 3)
+
+    @patch('ADSScanExplorerPipeline.tasks.upload_image_files', return_value=(1, 0))
+    @patch('ADSScanExplorerPipeline.tasks.index_ocr_files', return_value=(1, 0))
+    @patch('ADSScanExplorerPipeline.tasks.push_volume_json')
+    def test_task_process_volume_chained_stages(self, push_volume_json, index_ocr_files, upload_image_files):
+        """ Makes sure the stages run as chained tasks on their own queues and skip when already done"""
+        self.assertEqual(task_process_db_for_volume.queue, 'process-db')
+        self.assertEqual(task_upload_db_for_volume.queue, 'upload-db')
+        self.assertEqual(task_index_ocr_files_for_volume.queue, 'index-ocr')
+        self.assertEqual(task_upload_image_files_for_volume.queue, 'upload-images')
+        engine = create_engine("sqlite://")
+        Base.metadata.create_all(engine)
+        session = sessionmaker(bind=engine)()
+        session.add(JournalVolume("seri", "test.", "0001"))
+        session.commit()
+        push_volume_json.return_value.status = 200
+
+        with patch('ADSScanExplorerPipeline.app.ADSScanExplorerPipeline.session_scope', return_value=nullcontext(session)), \
+                patch.dict('ADSScanExplorerPipeline.tasks.config', {'PIPELINE_STAGE_QUEUES': True}):
+            task_process_volume(self.data_folder, "test.0001")
+            vol = JournalVolume.get("test.0001", session)
+            self.assertTrue(vol.db_done and vol.db_uploaded and vol.ocr_uploaded and vol.bucket_uploaded)
+            self.assertEqual(vol.status, VolumeStatus.Done)
+            self.assertEqual(vol.status_message, "Indexed 1 ocr pages, 0 failed; Uploaded 1 image files, skipped 0 unchanged")
+            self.assertEqual(session.query(Page).count(), 1)
+
+            #Only the stage with its flag reset runs again
+            vol.ocr_uploaded = False
+            session.commit()
+            task_process_volume(self.data_folder, "test.0001")
+            self.assertEqual(push_volume_json.call_count, 1)
+            self.assertEqual(index_ocr_files.call_count, 2)
+            self.assertEqual(upload_image_files.call_count, 1)
+            self.assertEqual(JournalVolume.get("test.0001", session).status, VolumeStatus.Done)
+
+            task_process_volume(self.data_folder, "test.0001", force_update=True)
+            self.assertEqual(push_volume_json.call_count, 2)
+            self.assertEqual(upload_image_files.call_count, 2)
+
+    @patch('ADSScanExplorerPipeline.tasks.task_upload_db_for_volume')
+    @patch('ADSScanExplorerPipeline.tasks.push_volume_batch')
+    def test_task_upload_db_for_volumes(self, push_volume_batch, task_upload_db_for_volume):
+        """ Makes sure the batch results set the right flags and failed batches fall back to single volume uploads"""
+        engine = create_engine("sqlite://")
+        Base.metadata.create_all(engine)
+        session = sessionmaker(bind=engine)()
+        for volume in ["0001", "0002", "0003", "0004"]:
+            vol = JournalVolume("seri", "test.", volume)
+            vol.status = VolumeStatus.Processing
+            vol.db_done = volume != "0004"
+            vol.bucket_uploaded = True
+            vol.ocr_uploaded = True
+            session.add(vol)
+        session.commit()
+        batches = []
+        def push(batch):
+            batches.append([vol.id for vol, data in batch])
+            if len(batches) == 1:
+                return {"test.0001": True, "test.0002": False}
+            raise Exception("Not found")
+        push_volume_batch.side_effect = push
+
+        with patch('ADSScanExplorerPipeline.app.ADSScanExplorerPipeline.session_scope', return_value=nullcontext(session)), \
+                patch.dict('ADSScanExplorerPipeline.ingestor.config', {'SERVICE_DB_BATCH_MAX_BYTES': 150}):
+            task_upload_db_for_volumes(["test.0001", "test.0002", "test.0003", "test.0004"])
+
+        self.assertEqual(batches, [["test.0001", "test.0002"], ["test.0003"]])
+        vols = {vol.id: vol for vol in JournalVolume.get_all(session)}
+        self.assertTrue(vols["test.0001"].db_uploaded)
+        self.assertEqual(vols["test.0001"].status, VolumeStatus.Done)
+        self.assertFalse(vols["test.0002"].db_uploaded)
+        self.assertEqual(vols["test.0002"].status, VolumeStatus.Error)
+        self.assertFalse(vols["test.0003"].db_uploaded)
+        task_upload_db_for_volume.assert_called_once_with("test.0003")
+        self.assertFalse(vols["test.0004"].db_uploaded)
+
+    def test_stage_error_status_set_in_scope(self):
+        """ Makes sure a failed stage sets the error status with its session before the scope is closed"""
+        session = self.get_volumes_session([("0001", VolumeStatus.Processing, 0, 0)])
+        scope_open = []
+        @contextmanager
+        def session_scope():
+            scope_open.append(True)
+            try:
+                yield session
+                session.commit()
+            finally:
+                scope_open.append(False)
+        def set_error_status(*args):
+            self.assertTrue(scope_open[-1])
+            set_ingestion_error_status(*args)
+        with patch('ADSScanExplorerPipeline.app.ADSScanExplorerPipeline.session_scope', side_effect=session_scope), \
+                patch('ADSScanExplorerPipeline.tasks.upload_image_files', side_effect=IOError("connection reset")), \
+                patch('ADSScanExplorerPipeline.tasks.set_ingestion_error_status', side_effect=set_error_status) as error_status:
+            task_upload_image_files_for_volume(self.data_folder, "test.0001")
+        error_status.assert_called_once()
+        vol = JournalVolume.get("test.0001", session)
+        self.assertEqual(vol.status, VolumeStatus.Error)
+        self.assertIn("connection reset", vol.status_message)
+
+    def get_volumes_session(self, volumes):
+        """ SQLite session with a volume for each (volume, status, number of pages, number of bitmaps in the manifest)"""
+        engine = create_engine("sqlite://")
+        Base.metadata.create_all(engine)
+        session = sessionmaker(bind=engine)()
+        for volume, status, n_pages, n_bitmaps in volumes:
+            vol = JournalVolume("seri", "test.", volume)
+            vol.status = status
+            vol.file_manifest = {'lists': {}, 'bitmaps': {"%07d.000" % n: [1, 1] for n in range(n_bitmaps)}, 'ocr': {}}
+            session.add(vol)
+            for n in range(n_pages):
+                page = Page("%07d.000" % (n + 1), vol.id)
+                page.volume_running_page_num = n + 1
+                session.add(page)
+        session.commit()
+        return session
+
+    @patch('ADSScanExplorerPipeline.tasks.task_process_volume.apply_async')
+    @patch('ADSScanExplorerPipeline.tasks.task_process_volume_batch.apply_async')
+    def test_task_process_new_volumes_batch_push(self, process_volume_batch, process_volume):
+        ids = ["test.0001", "test.0002", "test.0003"]
+        session = self.get_volumes_session([(volume[-4:], VolumeStatus.New, 0, 0) for volume in ids])
+        with patch('ADSScanExplorerPipeline.app.ADSScanExplorerPipeline.session_scope', return_value=nullcontext(session)):
+            with patch.dict('ADSScanExplorerPipeline.tasks.config', {'SERVICE_DB_BATCH_PUSH': True, 'SERVICE_DB_BATCH_VOLUMES': 2}):
+                task_process_new_volumes(self.data_folder, journal_volume_ids=ids)
+            self.assertEqual([call[0][0][1] for call in process_volume_batch.call_args_list], [ids[:2], ids[2:]])
+            process_volume.assert_not_called()
+
+            with patch.dict('ADSScanExplorerPipeline.tasks.config', {'SERVICE_DB_BATCH_PUSH': True}):
+                task_process_new_volumes(self.data_folder, upload_db=False, journal_volume_ids=ids)
+            self.assertEqual(process_volume.call_count, 3)
+
+    @patch('ADSScanExplorerPipeline.tasks.upload_image_files', return_value=(1, 0))
+    @patch('ADSScanExplorerPipeline.tasks.index_ocr_files', return_value=(1, 0))
+    @patch('ADSScanExplorerPipeline.tasks.push_volume_json')
+    @patch('ADSScanExplorerPipeline.tasks.push_volume_batch')
+    def test_task_process_volume_batch_stage_queues(self, push_volume_batch, push_volume_json, index_ocr_files, upload_image_files):
+        """ Makes sure the volumes of a batch run as their own stage chains and only the db upload is done for the batch"""
+        session = self.get_volumes_session([("0001", VolumeStatus.New, 0, 0)])
+        push_volume_batch.side_effect = lambda batch: {vol.id: True for vol, data in batch}
+        with patch('ADSScanExplorerPipeline.app.ADSScanExplorerPipeline.session_scope', return_value=nullcontext(session)), \
+                patch.dict('ADSScanExplorerPipeline.tasks.config', {'PIPELINE_STAGE_QUEUES': True}), \
+                patch('ADSScanExplorerPipeline.tasks.chain_volume_stages', wraps=chain_volume_stages) as chain_stages:
+            task_process_volume_batch(self.data_folder, ["test.0001"])
+        chain_stages.assert_called_once()
+        push_volume_json.assert_not_called()
+        self.assertEqual([[vol.id for vol, data in call[0][0]] for call in push_volume_batch.call_args_list], [["test.0001"]])
+        vol = JournalVolume.get("test.0001", session)
+        self.assertTrue(vol.db_done and vol.db_uploaded and vol.ocr_uploaded and vol.bucket_uploaded)
+        self.assertEqual(vol.status, VolumeStatus.Done)
+
+    @patch('ADSScanExplorerPipeline.tasks.task_upload_db_for_volumes')
+    @patch('ADSScanExplorerPipeline.tasks.task_upload_db_for_batch.apply_async')
+    def test_task_upload_db_for_batch_waits(self, upload_db_for_batch, upload_db_for_volumes):
+        """ Makes sure the batch db upload waits for the volumes with stages left and skips failed and stuck ones"""
+        session = self.get_volumes_session([("0001", VolumeStatus.Processing, 0, 0), ("0002", VolumeStatus.Error, 0, 0), ("0003", VolumeStatus.Processing, 0, 0)])
+        for vol in JournalVolume.get_all(session):
+            vol.db_done = vol.ocr_uploaded = True
+        session.commit()
+        session.execute(JournalVolume.__table__.update().where(JournalVolume.id == "test.0003").values(updated=datetime.utcnow() - timedelta(hours=7)))
+        session.commit()
+        ids = ["test.0001", "test.0002", "test.0003"]
+        with patch('ADSScanExplorerPipeline.app.ADSScanExplorerPipeline.session_scope', return_value=nullcontext(session)), \
+                patch.dict('ADSScanExplorerPipeline.tasks.config', {'CELERY_ALWAYS_EAGER': False, 'PROCESS_IN_FLIGHT_TIMEOUT': 6 * 3600}):
+            task_upload_db_for_batch(ids)
+            upload_db_for_batch.assert_called_once()
+            upload_db_for_volumes.assert_not_called()
+
+            JournalVolume.get("test.0001", session).bucket_uploaded = True
+            session.commit()
+            task_upload_db_for_batch(ids)
+            upload_db_for_batch.assert_called_once()
+            upload_db_for_volumes.assert_called_once_with(ids, False)
+
+    @patch('ADSScanExplorerPipeline.tasks.task_process_volume.apply_async')
+    def test_task_process_new_volumes_schedule(self, process_volume):
+        """ Makes sure updates go first and failed volumes last, smaller volumes first and with a higher priority"""
+        session = self.get_volumes_session([
+            ("0001", VolumeStatus.Error, 10, 0),
+            ("0002", VolumeStatus.New, 0, 5000),
+            ("0003", VolumeStatus.New, 0, 50),
+            ("0004", VolumeStatus.Update, 300, 0),
+            ("0005", VolumeStatus.Update, 20, 0),
+            ("0006", VolumeStatus.Done, 10, 0),
+        ])
+        with patch('ADSScanExplorerPipeline.app.ADSScanExplorerPipeline.session_scope', return_value=nullcontext(session)):
+            task_process_new_volumes(self.data_folder)
+        dispatched = [(call[0][0][1], call[1]['priority']) for call in process_volume.call_args_list]
+        self.assertEqual(dispatched, [("test.0005", 8), ("test.0004", 7), ("test.0003", 5), ("test.0002", 3), ("test.0001", 2)])
+
+    @patch('ADSScanExplorerPipeline.tasks.task_process_new_volumes.apply_async')
+    @patch('ADSScanExplorerPipeline.tasks.task_process_volume.apply_async')
+    def test_task_process_new_volumes_max_in_flight(self, process_volume, process_new_volumes):
+        """ Makes sure only the free slots are dispatched and the remaining volumes are scheduled again"""
+        session = self.get_volumes_session([
+            ("0001", VolumeStatus.Processing, 0, 0),
+            ("0002", VolumeStatus.New, 0, 0),
+            ("0003", VolumeStatus.New, 0, 0),
+            ("0004", VolumeStatus.New, 0, 0),
+        ])
+        with patch('ADSScanExplorerPipeline.app.ADSScanExplorerPipeline.session_scope', return_value=nullcontext(session)), \
+                patch.dict('ADSScanExplorerPipeline.tasks.config', {'CELERY_ALWAYS_EAGER': False}), \
+                patch('ADSScanExplorerPipeline.tasks.lock_volume_scheduling', wraps=lock_volume_scheduling) as lock:
+            task_process_new_volumes(self.data_folder, max_in_flight=2)
+        lock.assert_called_once_with(session)
+        self.assertEqual([call[0][0][1] for call in process_volume.call_args_list], ["test.0002"])
+        self.assertEqual(JournalVolume.get("test.0002", session).status, VolumeStatus.Processing)
+        process_new_volumes.assert_called_once()
+        self.assertEqual(process_new_volumes.call_args[0][1]['journal_volume_ids'], ["test.0003", "test.0004"])
+        self.assertEqual(process_new_volumes.call_args[0][1]['max_in_flight'], 2)
+
+    def test_lock_volume_scheduling(self):
+        """ Makes sure the scheduling tasks take the advisory lock on postgres only"""
+        session = MagicMock()
+        session.get_bind.return_value.dialect.name = "postgresql"
+        lock_volume_scheduling(session)
+        self.assertIn("pg_advisory_xact_lock", str(session.execute.call_args[0][0]))
+        session = MagicMock()
+        session.get_bind.return_value.dialect.name = "sqlite"
+        lock_volume_scheduling(session)
+        session.execute.assert_not_called()
+
+    @patch('ADSScanExplorerPipeline.tasks.task_process_volume.apply_async')
+    def test_task_process_new_volumes_rescheduled_dispatched(self, process_volume):
+        """ Makes sure rescheduled volumes dispatched or finished by another scheduling task in the meantime are skipped"""
+        session = self.get_volumes_session([
+            ("0001", VolumeStatus.Processing, 0, 0),
+            ("0002", VolumeStatus.Done, 0, 0),
+            ("0003", VolumeStatus.New, 0, 0),
+        ])
+        with patch('ADSScanExplorerPipeline.app.ADSScanExplorerPipeline.session_scope', return_value=nullcontext(session)), \
+                patch.dict('ADSScanExplorerPipeline.tasks.config', {'CELERY_ALWAYS_EAGER': False}):
+            task_process_new_volumes(self.data_folder, journal_volume_ids=["test.0001", "test.0002", "test.0003"], max_in_flight=5)
+        self.assertEqual([call[0][0][1] for call in process_volume.call_args_list], ["test.0003"])
+        self.assertEqual(JournalVolume.get("test.0002", session).status, VolumeStatus.Done)
+
+    @patch('ADSScanExplorerPipeline.tasks.task_process_volume.apply_async')
+    def test_task_process_new_volumes_stuck(self, process_volume):
+        """ Makes sure volumes left in Processing longer than PROCESS_IN_FLIGHT_TIMEOUT are processed again"""
+        session = self.get_volumes_session([
+            ("0001", VolumeStatus.Processing, 0, 0),
+            ("0002", VolumeStatus.Processing, 0, 0),
+            ("0003", VolumeStatus.New, 0, 0),
+        ])
+        session.execute(JournalVolume.__table__.update().where(JournalVolume.id == "test.0001").values(updated=datetime.utcnow() - timedelta(hours=7)))
+        session.commit()
+        with patch('ADSScanExplorerPipeline.app.ADSScanExplorerPipeline.session_scope', return_value=nullcontext(session)), \
+                patch.dict('ADSScanExplorerPipeline.tasks.config', {'PROCESS_IN_FLIGHT_TIMEOUT': 6 * 3600}):
+            task_process_new_volumes(self.data_folder)
+        self.assertEqual(sorted(call[0][0][1] for call in process_volume.call_args_list), ["test.0001", "test.0003"])
+
     @mock_s3
     @patch('ADSScanExplorerPipeline.app.ADSScanExplorerPipeline.session_scope')
     @patch('ADSScanExplorerPipeline.models.JournalVolume.get_from_id_or_name')
     @patch('ADSScanExplorerPipeline.models.Page.get_all_from_volume')
-    @patch('ADSScanExplorerPipeline.models.Page.get_from_name_and_journal')
-    def test_task_upload_image_files_for_volume(self, get_from_name_and_journal, get_all_from_volume, get_from_id_or_name, session_scope):
+    @patch('ADSScanExplorerPipeline.models.Page.get_names_from_volume')
+    def test_task_upload_image_files_for_volume(self, get_names_from_volume, get_all_from_volume, get_from_id_or_name, session_scope):
         
         vol = JournalVolume("seri", "test.", "0001")
         get_from_id_or_name.return_value = vol
 
         expected_page =  Page("0000255,001", vol.id)
         get_all_from_volume.return_value = [expected_page]
-        get_from_name_and_journal.return_value = expected_page
+        get_names_from_volume.return_value = {expected_page.name}
 
         session = UnifiedAlchemyMagicMock()
         session_scope.return_value = session
@@ -123,43 +590,73 @@ class TestTasks(unittest.TestCase):
 
     @patch('ADSScanExplorerPipeline.app.ADSScanExplorerPipeline.session_scope')
     @patch('ADSScanExplorerPipeline.models.JournalVolume.get_from_id_or_name')
-    @patch('ADSScanExplorerPipeline.models.Page.get_all_from_volume')
+    @patch('ADSScanExplorerPipeline.models.Page.get_records_from_volume')
+    @patch('opensearchpy.helpers.streaming_bulk')
     @patch('opensearchpy.OpenSearch')
-    def test_task_index_ocr_files_for_volume(self, OpenSearch, get_all_from_volume, get_from_id_or_name, session_scope):
+    def test_task_index_ocr_files_for_volume(self, OpenSearch, streaming_bulk, get_records_from_volume, get_from_id_or_name, session_scope):
         vol = JournalVolume("seri", "test.", "0001")
         get_from_id_or_name.return_value = vol
         
         session = UnifiedAlchemyMagicMock()
         session_scope.return_value = session
 
-        expected_page =  Page("0000255,001", vol.id)
-        expected_page.journal_volume = vol
-        get_all_from_volume.return_value = [expected_page]
+        get_records_from_volume.return_value = [PageRecord("0000255,001", vol.id)]
+
+        actions = []
+        def bulk(client, documents, **kwargs):
+            for action in documents:
+                actions.append(action)
+                yield True, {'index': {'_id': action['_id'], 'status': 201}}
+        streaming_bulk.side_effect = bulk
 
         used_session = task_index_ocr_files_for_volume(self.data_folder, vol.id)
         for vol in used_session.query(JournalVolume).filter(JournalVolume.journal == "").all():
             self.assertTrue(vol.ocr_uploaded)
+            self.assertEqual(vol.status_message, "Indexed 1 ocr pages, 0 failed")
         
         OpenSearch.assert_called()
         OpenSearch.return_value.delete_by_query.assert_called()
+        self.assertEqual(len(actions), 1)
+        self.assertEqual(actions[0]['_index'], 'scan-explorer')
         self.assertEqual("{'page_id': 'test.0001_0000255,001', 'volume_id': 'test.0001', 'text': 'test ocr text', 'article_bibcodes': [], 'journal': 'test.', 'volume': '0001', 'volume_int': '0001', 'page_type': 'FrontMatter', 'page_number': None, 'page_label': '255-1', 'page_color': 'BW', 'project': ''}",
-            str(OpenSearch.return_value.index.call_args_list[0][1]['body']))
+            str(actions[0]['_source']))
 
     @patch('ADSScanExplorerPipeline.app.ADSScanExplorerPipeline.session_scope')
     @patch('ADSScanExplorerPipeline.models.JournalVolume.get_from_id_or_name')
-    @patch('requests.put')
-    def test_task_task_upload_db_for_volume(self, mock_put, get_from_id_or_name, session_scope):
+    @patch('ADSScanExplorerPipeline.tasks.set_ingestion_error_status')
+    @patch('ADSScanExplorerPipeline.tasks.index_ocr_files')
+    def test_task_index_ocr_files_for_volume_failed_documents(self, index_ocr_files, set_ingestion_error_status, get_from_id_or_name, session_scope):
         vol = JournalVolume("seri", "test.", "0001")
         get_from_id_or_name.return_value = vol
+        session_scope.return_value = UnifiedAlchemyMagicMock()
+        index_ocr_files.return_value = (4, 1)
+
+        task_index_ocr_files_for_volume(self.data_folder, vol.id)
+        self.assertFalse(vol.ocr_uploaded)
+        set_ingestion_error_status.assert_called_once()
+        self.assertIn("Indexed 4 ocr pages, 1 failed", set_ingestion_error_status.call_args[0][2])
+
+    @patch('ADSScanExplorerPipeline.ingestor.get_service_pool')
+    def test_task_task_upload_db_for_volume(self, get_service_pool):
+        engine = create_engine("sqlite://")
+        Base.metadata.create_all(engine)
+        session = sessionmaker(bind=engine)()
+        vol = JournalVolume("seri", "test.", "0001")
+        session.add(vol)
+        session.commit()
 
-        session = UnifiedAlchemyMagicMock()
-        session_scope.return_value = session
-       
         mock_return = MagicMock()
-        mock_return.status_code = 200
-        mock_put.return_value = mock_return
+        mock_return.status = 200
+        bodies = []
+        def urlopen(method, url, body, headers, **kwargs):
+            bodies.append(b"".join(body))
+            return mock_return
+        mock_put = get_service_pool.return_value.urlopen
+        mock_put.side_effect = urlopen
 
-        used_session = task_process_volume(self.data_folder, vol.id, upload_files=False, index_ocr=False, upload_db=True)
+        with patch('ADSScanExplorerPipeline.app.ADSScanExplorerPipeline.session_scope', return_value=nullcontext(session)), \
+                patch.dict('ADSScanExplorerPipeline.ingestor.config', {'SERVICE_DB_PUSH_CHUNK_SIZE': 1}):
+            task_process_volume(self.data_folder, vol.id, upload_files=False, index_ocr=False, upload_db=True)
         
         expected_request_args = {'type': 'seri', 'journal': 'test.', 'volume': '0001', 'pages': [{'name': '0000255,001', 'label': '255-01', 'format': 'image/tiff', 'color_type': 'Grayscale', 'page_type': 'FrontMatter', 'width': 4304, 'height': 5312, 'volume_running_page_num': 1, 'articles': [{'bibcode': 'test......001..test'}]}]}
         from adsputils import load_config
@@ -167,11 +664,12 @@ class TestTasks(unittest.TestCase):
         config = load_config(proj_home=proj_home)
         url = config.get('SERVICE_DB_PUSH_URL' ,'')
         auth_token = config.get('SERVICE_AUTHENTICATION_TOKEN' ,'')
-        mock_put.assert_called()    
-        mock_put.assert_called_with(url, json=expected_request_args, headers={'Authorization': 'Bearer:' + auth_token})
-
-        for vol in used_session.query(JournalVolume).filter(JournalVolume.journal == "").all():
-            self.assertEqual(vol.type, "seri")
-            self.assertEqual(vol.journal, "test.")
-            self.assertEqual(vol.volume, "0001")
-            self.assertEqual(vol.status, VolumeStatus.Processing)
\ No newline at end of file
+        mock_put.assert_called_once()
+        self.assertEqual(mock_put.call_args[0][:2], ('PUT', url))
+        self.assertTrue(mock_put.call_args[1]['chunked'])
+        self.assertEqual(mock_put.call_args[1]['headers'], {'Authorization': 'Bearer:' + auth_token, 'Content-Type': 'application/json'})
+        #The streamed body has to match what requests sends for the volume dict
+        vol = JournalVolume.get(vol.id, session)
+        self.assertEqual(vol.to_dict(), expected_request_args)
+        self.assertEqual(bodies[0], requests.Request('PUT', url, json=expected_request_args).prepare().body)
+        self.assertTrue(vol.db_uploaded)
\ No newline at end of file
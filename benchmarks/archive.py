@@ -0,0 +1,107 @@
+"""
+Generates synthetic scan archives with the layout the pipeline reads:
+
+    lists/<type>/<journal>/<journal><volume>.top|.dat|.top.map
+    bitmaps/<type>/<journal>/<volume>/600/<page>[.tif]
+    ocr/full/<type>/<journal>/<volume>/<page>.txt
+
+The TIFF files only carry a valid header and IFD with 600dpi scan dimensions followed by
+optional padding, which is enough for the header reader, the manifest and the uploads.
+The same seed always generates the same archive.
+"""
+import os
+import random
+import struct
+from typing import List, Tuple
+from ADSScanExplorerPipeline.ingestor import config
+
+TOP_HEADER_ROWS = ["12", "001485", "%s %s", "<!--This file is sensitive.  Do not edit-->"]
+WORDS = ["the", "spectrum", "of", "star", "observed", "with", "&amp;", "nebula", "velocity", "plate", "magnitude", "orbit", "Fig.", "1900", "&lt;", "table"]
+
+
+def write_tiff(file_path: str, width: int, height: int, n_samples: int, padding: int = 0):
+    """
+    Writes a little endian TIFF with the ImageWidth, ImageLength and BitsPerSample tags followed by padding bytes
+    """
+    entries = [(256, 4, 1, struct.pack("<I", width)), (257, 4, 1, struct.pack("<I", height)), (258, 3, n_samples, struct.pack("<HH", 8, 0))]
+    data = b"II" + struct.pack("<HI", 42, 8) + struct.pack("<H", len(entries))
+    for tag, field_type, count, value in entries:
+        data += struct.pack("<HHI", tag, field_type, count) + value
+    data += struct.pack("<I", 0)
+    with open(file_path, "wb") as file:
+        file.write(data + b"\0" * padding)
+
+def generate_pages(rng: random.Random, n_pages: int) -> List[Tuple[str, str]]:
+    """
+    Returns the name and label of the pages of a volume, a few front matter pages followed
+    by numbered pages with the odd plate in between
+    """
+    pages = []
+    n_front = min(n_pages, rng.randint(1, 4))
+    for n in range(n_front):
+        pages.append(("%07d,%03d" % (n + 1, 0), "%d-%d" % (n + 1, 0)))
+    number = 0
+    while len(pages) < n_pages:
+        if rng.random() < 0.02:
+            pages.append(("%07dP%03d" % (number, 1), "P%d" % number))
+        else:
+            number += 1
+            pages.append(("%07d.%03d" % (number, 0), str(number)))
+    return pages
+
+def generate_volume(base_path: str, rng: random.Random, type: str, journal: str, volume: str, n_pages: int,
+        pages_per_article: int, map_file: bool, tiff_padding: int, ocr_words: int) -> int:
+    """
+    Writes the list, bitmap and ocr files of one volume and returns the number of files written
+    """
+    list_path = os.path.join(base_path, config.get('TOP_SUB_DIR', ''), type, journal)
+    image_path = os.path.join(base_path, config.get('BITMAP_SUB_DIR', ''), type, journal, volume, "600")
+    ocr_path = os.path.join(base_path, config.get('OCR_SUB_DIR', ''), type, journal, volume)
+    for path in [list_path, image_path, ocr_path]:
+        os.makedirs(path, exist_ok=True)
+    pages = generate_pages(rng, n_pages)
+    n_files = 2
+
+    top_rows = [row % (journal, volume) if "%s" in row else row for row in TOP_HEADER_ROWS]
+    with open(os.path.join(list_path, journal + volume + ".top"), "w") as file:
+        file.write("\n".join(top_rows + ["%s %s" % (name, label) for name, label in pages]) + "\n")
+    if map_file:
+        with open(os.path.join(list_path, journal + volume + ".top.map"), "w") as file:
+            for name, label in pages:
+                file.write("%s\t%s\t%s\n" % (name[:7] + "_" + name[8:], label, {".": "1", ",": "C", "P": "P"}[name[7]]))
+        n_files += 1
+
+    with open(os.path.join(list_path, journal + volume + ".dat"), "w") as file:
+        for start in range(0, len(pages), pages_per_article):
+            article_pages = [name for name, label in pages[start:start + pages_per_article]]
+            bibcode = "1900" + journal + volume.rjust(4, ".") + "%05d" % (start + 1) + "X"
+            file.write("%s\t%s/%s/%s/ %03d %s\n" % (bibcode, type, journal, volume, len(article_pages), " ".join(article_pages)))
+
+    for n, (name, label) in enumerate(pages):
+        write_tiff(os.path.join(image_path, name), 4320, 5312, 1, tiff_padding)
+        n_files += 1
+        #Plates are in color and every fourth page has a grayscale scan as well
+        if name[7] == "P" or n % 4 == 0:
+            write_tiff(os.path.join(image_path, name + ".tif"), 4304, 5312, 3 if name[7] == "P" else 1, tiff_padding)
+            n_files += 1
+        with open(os.path.join(ocr_path, name + ".txt"), "w") as file:
+            file.write(" ".join(rng.choice(WORDS) for _ in range(ocr_words)))
+        n_files += 1
+    return n_files
+
+def generate_archive(base_path: str, n_journals: int = 2, volumes_per_journal: int = 3, pages_per_volume: int = 100,
+        pages_per_article: int = 10, map_fraction: float = 0.2, tiff_padding: int = 0, ocr_words: int = 300, seed: int = 42) -> List[Tuple[str, str, str]]:
+    """
+    Writes an archive of n_journals journals with volumes_per_journal volumes each.
+    Returns the type, journal and volume of all generated volumes
+    """
+    rng = random.Random(seed)
+    volumes = []
+    for j in range(n_journals):
+        journal = "J%03d." % j
+        for v in range(volumes_per_journal):
+            volume = "%04d" % (v + 1)
+            generate_volume(base_path, rng, "seri", journal, volume, pages_per_volume, pages_per_article,
+                rng.random() < map_fraction, tiff_padding, ocr_words)
+            volumes.append(("seri", journal, volume))
+    return volumes
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+"""
+Compares identify_journals, which scans each directory once, against the previous
+listdir based walk that listed the journal directory again and stat'ed each file
+separately for every volume, on a generated tree of list, bitmap and ocr files.
+
+    python -m benchmarks.bench_identify_journals --files 100000
+"""
+import os
+import argparse
+import tempfile
+import time
+from ADSScanExplorerPipeline.models import JournalVolume
+from ADSScanExplorerPipeline.ingestor import identify_journals, parse_volume_from_top_file, hash_volume_manifest, config
+
+
+def generate_tree(base_path: str, n_files: int, n_journals: int, pages_per_volume: int):
+    """
+    Creates empty list, bitmap and ocr files, each volume has 3 list files, 2 bitmaps and 1 ocr file per page
+    """
+    files_per_volume = 3 + 3 * pages_per_volume
+    n_volumes = max(1, n_files // files_per_volume)
+    for n in range(n_volumes):
+        journal = "J%04d" % (n % n_journals)
+        volume = "%04d" % (n // n_journals + 1)
+        list_path = os.path.join(base_path, config.get('TOP_SUB_DIR', ''), "seri", journal)
+        image_path = os.path.join(base_path, config.get('BITMAP_SUB_DIR', ''), "seri", journal, volume, "600")
+        ocr_path = os.path.join(base_path, config.get('OCR_SUB_DIR', ''), "seri", journal, volume)
+        for path in [list_path, image_path, ocr_path]:
+            os.makedirs(path, exist_ok=True)
+        for extension in [".top", ".dat", ".top.map"]:
+            open(os.path.join(list_path, journal + volume + extension), "w").close()
+        for page in range(pages_per_volume):
+            name = "%07d.000" % (page + 1)
+            open(os.path.join(image_path, name), "w").close()
+            open(os.path.join(image_path, name + ".tif"), "w").close()
+            open(os.path.join(ocr_path, name + ".txt"), "w").close()
+    return n_volumes * files_per_volume
+
+def listdir_manifest(path: str, filenames):
+    manifest = {}
+    for file in sorted(filenames):
+        file_path = os.path.join(path, file)
+        manifest[file] = [os.path.getsize(file_path), os.path.getmtime(file_path)]
+    return manifest
+
+def legacy_identify_journals(input_folder_path: str):
+    """
+    The previous walk, one listdir of the journal list directory per volume and separate stat calls per file
+    """
+    list_path = os.path.join(input_folder_path, config.get('TOP_SUB_DIR', ''))
+    for type in os.listdir(list_path):
+        type_path = os.path.join(list_path, type)
+        if not os.path.isdir(type_path):
+            continue
+        for journal in os.listdir(type_path):
+            journal_path = os.path.join(type_path, journal)
+            if not os.path.isdir(journal_path):
+                continue
+            for file in os.listdir(journal_path):
+                if file.endswith(".top"):
+                    vol = JournalVolume(type, journal, parse_volume_from_top_file(file, journal))
+                    image_path = os.path.join(input_folder_path, config.get('BITMAP_SUB_DIR', ''), vol.type, vol.journal, vol.volume, "600")
+                    ocr_path = os.path.join(input_folder_path, config.get('OCR_SUB_DIR', ''), vol.type, vol.journal, vol.volume)
+                    vol.file_hash = hash_volume_manifest({
+                        'lists': listdir_manifest(journal_path, [f for f in os.listdir(journal_path) if str(vol.volume) in f]),
+                        'bitmaps': listdir_manifest(image_path, os.listdir(image_path)),
+                        'ocr': listdir_manifest(ocr_path, os.listdir(ocr_path)),
+                    })
+                    yield vol
+
+def run(base_path: str, repeat: int):
+    results = {}
+    hashes = {}
+    for name, scanner in [("scandir", identify_journals), ("listdir", legacy_identify_journals)]:
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            hashes[name] = {vol.id: vol.file_hash for vol in scanner(base_path)}
+            timings.append(time.perf_counter() - start)
+        results[name] = min(timings)
+        print("%s: %d volumes in %.3fs" % (name, len(hashes[name]), results[name]))
+    if hashes["scandir"] != hashes["listdir"]:
+        raise ValueError("Volume hashes differ between the scanners")
+    print("speedup: %.1fx" % (results["listdir"] / results["scandir"]))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--files", dest="files", type=int, default=100000, help="Approximate number of files in the generated tree")
+    parser.add_argument("--journals", dest="journals", type=int, default=5, help="Number of journals the volumes are spread over")
+    parser.add_argument("--pages", dest="pages", type=int, default=50, help="Number of pages per volume")
+    parser.add_argument("--repeat", dest="repeat", type=int, default=3, help="Number of timed runs, the fastest is reported")
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as base_path:
+        n_files = generate_tree(base_path, args.files, args.journals, args.pages)
+        print("Generated %d files" % n_files)
+        run(base_path, args.repeat)
@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+"""
+Times the ingestion hot paths on a generated archive, see benchmarks/archive.py: identifying and hashing
+the volumes, parsing the list and image files, building the volume metadata and indexing and uploading
+the files on SQLite with Open Search and S3 mocked. Each benchmark is repeated and the results are
+written as JSON, which can be compared against the results of an earlier run.
+
+    python -m benchmarks.bench_ingestion --journals 2 --volumes 5 --pages 500 --output results.json
+    python -m benchmarks.bench_ingestion --compare results.json --output results_new.json
+"""
+import os
+import sys
+import json
+import argparse
+import platform
+import statistics
+import tempfile
+import time
+from datetime import datetime
+from typing import Callable, Dict, List, Tuple
+from unittest.mock import patch
+import boto3
+import opensearchpy
+from opensearchpy.connection import Connection
+from moto import mock_s3
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from ADSScanExplorerPipeline.models import Base, JournalVolume
+from ADSScanExplorerPipeline.ingestor import identify_journals, hash_volume, parse_top_file, parse_dat_file, parse_image_files, load_volume
+from ADSScanExplorerPipeline.ingestor import generate_volume_json, index_ocr_files, upload_image_files, config
+from benchmarks.archive import generate_archive
+
+
+class AcceptingBulkConnection(Connection):
+    """ Open Search connection accepting all bulk documents locally"""
+
+    def perform_request(self, method, url, params=None, body=None, timeout=None, ignore=(), headers=None):
+        if not url.endswith("/_bulk"):
+            return 200, {}, json.dumps({"deleted": 0})
+        actions = [json.loads(line) for line in body.decode("utf-8").strip().split("\n")[0::2]]
+        items = [{"index": {"_index": action["index"]["_index"], "_id": action["index"]["_id"], "status": 201}} for action in actions]
+        return 200, {}, json.dumps({"took": 1, "errors": False, "items": items})
+
+class Archive:
+    """ Paths, volumes and database of the generated archive shared by the benchmarks"""
+
+    def __init__(self, base_path: str, volumes: List[Tuple[str, str, str]]):
+        self.base_path = base_path
+        self.volumes = [JournalVolume(type, journal, volume) for type, journal, volume in volumes]
+        self.engine = create_engine("sqlite:///" + os.path.join(base_path, "bench.db"))
+        Base.metadata.create_all(self.engine)
+        self.page_indexes = {}
+        session = self.session()
+        for vol in self.volumes:
+            session.add(JournalVolume(vol.type, vol.journal, vol.volume))
+            session.flush()
+            load_volume(self.top_file_path(vol), self.dat_file_path(vol), self.image_path(vol), vol, session)
+            self.page_indexes[vol.id] = {}
+            list(parse_top_file(self.top_file_path(vol), vol, session, self.page_indexes[vol.id]))
+        session.commit()
+        session.close()
+
+    def session(self):
+        return sessionmaker(bind=self.engine)()
+
+    def top_file_path(self, vol: JournalVolume) -> str:
+        return os.path.join(self.base_path, config.get('TOP_SUB_DIR', ''), vol.type, vol.journal, vol.journal + vol.volume + ".top")
+
+    def dat_file_path(self, vol: JournalVolume) -> str:
+        return self.top_file_path(vol).replace(".top", ".dat")
+
+    def image_path(self, vol: JournalVolume) -> str:
+        return os.path.join(self.base_path, config.get('BITMAP_SUB_DIR', ''), vol.type, vol.journal, vol.volume, "600")
+
+    def ocr_path(self, vol: JournalVolume) -> str:
+        return os.path.join(self.base_path, config.get('OCR_SUB_DIR', ''), vol.type, vol.journal, vol.volume)
+
+def bench_identify_journals(archive: Archive) -> int:
+    return sum(1 for _ in identify_journals(archive.base_path))
+
+def bench_hash_volume(archive: Archive) -> int:
+    for vol in archive.volumes:
+        hash_volume(archive.base_path, vol)
+    return len(archive.volumes)
+
+def bench_parse_top_file(archive: Archive) -> int:
+    return sum(len(list(parse_top_file(archive.top_file_path(vol), vol, None, {}))) for vol in archive.volumes)
+
+def bench_parse_dat_file(archive: Archive) -> int:
+    return sum(len(list(parse_dat_file(archive.dat_file_path(vol), vol, None, archive.page_indexes[vol.id], {}))) for vol in archive.volumes)
+
+def bench_parse_image_files(archive: Archive) -> int:
+    return sum(len(list(parse_image_files(archive.image_path(vol), vol, None, archive.page_indexes[vol.id]))) for vol in archive.volumes)
+
+def bench_to_dict(archive: Archive) -> int:
+    session = archive.session()
+    for vol in archive.volumes:
+        json.dumps(JournalVolume.get(vol.id, session).to_dict())
+    session.close()
+    return sum(len(page_index) for page_index in archive.page_indexes.values())
+
+def bench_generate_volume_json(archive: Archive) -> int:
+    session = archive.session()
+    for vol in archive.volumes:
+        for _ in generate_volume_json(JournalVolume.get(vol.id, session), session):
+            pass
+    session.close()
+    return sum(len(page_index) for page_index in archive.page_indexes.values())
+
+def bench_index_ocr_files(archive: Archive) -> int:
+    session = archive.session()
+    client = opensearchpy.OpenSearch(connection_class=AcceptingBulkConnection)
+    indexed = 0
+    with patch('opensearchpy.OpenSearch', return_value=client):
+        for vol in archive.volumes:
+            indexed += index_ocr_files(archive.ocr_path(vol), JournalVolume.get(vol.id, session), session)[0]
+    #Commits the cleared checkpoints like the task session scope does
+    session.commit()
+    session.close()
+    return indexed
+
+def clear_bucket(archive: Archive):
+    boto3.resource('s3').Bucket(config.get('S3_BUCKET', "")).objects.all().delete()
+
+def bench_upload_image_files(archive: Archive) -> int:
+    session = archive.session()
+    uploaded = 0
+    for vol in archive.volumes:
+        uploaded += upload_image_files(archive.image_path(vol), JournalVolume.get(vol.id, session), session)[0]
+    session.commit()
+    session.close()
+    return uploaded
+
+# Name, function returning the number of processed items and an untimed setup run before each repetition
+BENCHMARKS: List[Tuple[str, Callable[[Archive], int], Callable[[Archive], None]]] = [
+    ("identify_journals", bench_identify_journals, None),
+    ("hash_volume", bench_hash_volume, None),
+    ("parse_top_file", bench_parse_top_file, None),
+    ("parse_dat_file", bench_parse_dat_file, None),
+    ("parse_image_files", bench_parse_image_files, None),
+    ("to_dict", bench_to_dict, None),
+    ("generate_volume_json", bench_generate_volume_json, None),
+    ("index_ocr_files", bench_index_ocr_files, None),
+    ("upload_image_files", bench_upload_image_files, clear_bucket),
+]
+
+def run_benchmark(archive: Archive, function: Callable[[Archive], int], setup: Callable[[Archive], None], repeat: int) -> Dict[str, float]:
+    timings = []
+    for _ in range(repeat):
+        if setup:
+            setup(archive)
+        start = time.perf_counter()
+        items = function(archive)
+        timings.append(time.perf_counter() - start)
+    return {
+        'items': items,
+        'min': min(timings),
+        'median': statistics.median(timings),
+        'items_per_second': items / min(timings) if min(timings) > 0 else 0.0,
+        'timings': timings,
+    }
+
+def run(parameters: dict, repeat: int, selected: List[str]) -> dict:
+    results = {}
+    with tempfile.TemporaryDirectory() as base_path, mock_s3(), \
+            patch.dict('ADSScanExplorerPipeline.ingestor.config', {'OPEN_SEARCH_BULK_INITIAL_BACKOFF': 0}):
+        volumes = generate_archive(base_path, **parameters)
+        archive = Archive(base_path, volumes)
+        boto3.resource('s3').create_bucket(Bucket=config.get('S3_BUCKET', ""))
+        for name, function, setup in BENCHMARKS:
+            if selected and name not in selected:
+                continue
+            results[name] = run_benchmark(archive, function, setup, repeat)
+            print("%s: %d items in %.4fs (%.1f items/s)" % (name, results[name]['items'], results[name]['min'], results[name]['items_per_second']))
+    return {
+        'created': datetime.utcnow().isoformat(),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'parameters': dict(parameters, repeat=repeat),
+        'benchmarks': results,
+    }
+
+def compare(previous: dict, current: dict):
+    """
+    Prints the speedup of the fastest run of each benchmark against the previous results, below 1 is a regression
+    """
+    if previous['parameters'] != current['parameters']:
+        print("Warning: the runs used different parameters %s and %s" % (previous['parameters'], current['parameters']))
+    for name, result in current['benchmarks'].items():
+        if name in previous['benchmarks']:
+            print("%s: %.2fx" % (name, previous['benchmarks'][name]['min'] / result['min']))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--journals", dest="journals", type=int, default=2, help="Number of generated journals")
+    parser.add_argument("--volumes", dest="volumes", type=int, default=3, help="Number of volumes per journal")
+    parser.add_argument("--pages", dest="pages", type=int, default=200, help="Number of pages per volume")
+    parser.add_argument("--pages-per-article", dest="pages_per_article", type=int, default=10, help="Number of pages of each generated article")
+    parser.add_argument("--tiff-padding", dest="tiff_padding", type=int, default=0, help="Bytes added after each TIFF header to get realistic file sizes")
+    parser.add_argument("--seed", dest="seed", type=int, default=42, help="Seed of the generated archive")
+    parser.add_argument("--repeat", dest="repeat", type=int, default=3, help="Number of timed runs of each benchmark")
+    parser.add_argument("--only", dest="only", nargs="+", default=[], help="Names of the benchmarks to run, all if not set")
+    parser.add_argument("--output", dest="output", type=str, default=None, help="File to write the JSON results to")
+    parser.add_argument("--compare", dest="compare", type=str, default=None, help="JSON results of an earlier run to compare against")
+    args = parser.parse_args()
+    parameters = {'n_journals': args.journals, 'volumes_per_journal': args.volumes, 'pages_per_volume': args.pages,
+        'pages_per_article': args.pages_per_article, 'tiff_padding': args.tiff_padding, 'seed': args.seed}
+    results = run(parameters, args.repeat, args.only)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+    if args.compare:
+        with open(args.compare) as file:
+            compare(json.load(file), results)
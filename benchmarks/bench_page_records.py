@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+"""
+Compares the memory of parsing a volume into page and article records against the previous parsing into
+Page and Article objects, on a generated volume, see benchmarks/archive.py. Each variant runs in a fresh
+process which keeps the parsed index and rows alive like update_volume does while it diffs them, and the
+peak RSS above the process baseline and the peak traced allocations are reported per 10k pages.
+
+    python -m benchmarks.bench_page_records --pages 50000
+"""
+import os
+import gc
+import argparse
+import random
+import resource
+import tempfile
+import tracemalloc
+import multiprocessing
+from typing import Dict, Tuple
+from ADSScanExplorerPipeline.models import JournalVolume, Page
+from ADSScanExplorerPipeline.ingestor import parse_top_rows, parse_dat_file, parse_image_files, parse_volume_records, config
+from benchmarks.archive import generate_volume
+
+
+def volume_paths(base_path: str, vol: JournalVolume) -> Tuple[str, str, str]:
+    top_file_path = os.path.join(base_path, config.get('TOP_SUB_DIR', ''), vol.type, vol.journal, vol.journal + vol.volume + ".top")
+    image_path = os.path.join(base_path, config.get('BITMAP_SUB_DIR', ''), vol.type, vol.journal, vol.volume, "600")
+    return top_file_path, top_file_path.replace(".top", ".dat"), image_path
+
+def parse_objects(base_path: str, vol: JournalVolume):
+    """
+    The previous parsing, which created a Page object per .top row and an Article object per .dat row
+    """
+    top_file_path, dat_file_path, image_path = volume_paths(base_path, vol)
+    page_index = {}
+    for row in parse_top_rows(top_file_path):
+        page = Page(row.name, vol.id)
+        page.volume_running_page_num = row.running_page_num
+        if row.label:
+            page.label = row.label
+        page_index[row.name] = page
+    article_index = {article.bibcode: article.to_article(page_index) for article in parse_dat_file(dat_file_path, vol, None, page_index, {})}
+    list(parse_image_files(image_path, vol, None, page_index))
+    page_rows = {page.id: (page.id, page.name, page.label, page.format, page.color_type.name, page.page_type.name,
+        page.width, page.height, page.journal_volume_id, page.volume_running_page_num) for page in page_index.values()}
+    article_rows = {article.bibcode: (article.bibcode, article.journal_volume_id, article.start_page_number) for article in article_index.values()}
+    return page_index, article_index, page_rows, article_rows
+
+def parse_records(base_path: str, vol: JournalVolume):
+    page_index, article_index = parse_volume_records(*volume_paths(base_path, vol), vol, None)
+    page_rows = {page.id: page.to_row() for page in page_index.values()}
+    article_rows = {article.bibcode: article.to_row() for article in article_index.values()}
+    return page_index, article_index, page_rows, article_rows
+
+VARIANTS = {
+    "objects": parse_objects,
+    "records": parse_records,
+}
+
+def measure(variant: str, base_path: str, vol: JournalVolume, results: multiprocessing.Queue):
+    """
+    Runs in a spawned process, once for the peak RSS and once more with tracemalloc for the peak allocations
+    """
+    parse = VARIANTS[variant]
+    #The peak RSS never goes down, so the first run is measured against the RSS after the imports
+    gc.collect()
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    parsed = parse(base_path, vol)
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline
+    del parsed
+    gc.collect()
+    tracemalloc.start()
+    parsed = parse(base_path, vol)
+    _, peak_traced = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    #ru_maxrss is in kilobytes on Linux
+    results.put((variant, peak_rss * 1024, peak_traced, len(parsed[0])))
+
+def run(n_pages: int, pages_per_article: int) -> Dict[str, Tuple[int, int]]:
+    context = multiprocessing.get_context("spawn")
+    results = {}
+    with tempfile.TemporaryDirectory() as base_path:
+        vol = JournalVolume("seri", "J000.", "0001")
+        generate_volume(base_path, random.Random(42), vol.type, vol.journal, vol.volume, n_pages, pages_per_article, False, 0, 0)
+        for variant in VARIANTS:
+            queue = context.Queue()
+            process = context.Process(target=measure, args=(variant, base_path, vol, queue))
+            process.start()
+            variant, peak_rss, peak_traced, pages = queue.get()
+            process.join()
+            results[variant] = (peak_rss, peak_traced)
+            print("%s: %d pages, peak RSS %.1f MB (%.2f MB per 10k pages), peak allocations %.1f MB (%.2f MB per 10k pages)" % (variant, pages,
+                peak_rss / 2**20, peak_rss / 2**20 * 10000 / pages, peak_traced / 2**20, peak_traced / 2**20 * 10000 / pages))
+    print("records use %.1fx less RSS and %.1fx fewer allocations" % (results["objects"][0] / max(results["records"][0], 1),
+        results["objects"][1] / max(results["records"][1], 1)))
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pages", dest="pages", type=int, default=50000, help="Number of pages of the generated volume")
+    parser.add_argument("--pages-per-article", dest="pages_per_article", type=int, default=10, help="Number of pages of each generated article")
+    args = parser.parse_args()
+    run(args.pages, args.pages_per_article)
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+"""
+Compares reading width, height and samples per pixel from the TIFF header with the
+IFD reader against the PIL tag dict path on a folder of synthetic 600dpi scans.
+
+    python -m benchmarks.bench_tiff_header --files 500
+"""
+import os
+import argparse
+import tempfile
+import timeit
+from PIL import Image
+from ADSScanExplorerPipeline.ingestor import read_tiff_header, read_tiff_header_with_pil
+
+
+def generate_tiff_files(folder: str, n_files: int):
+    """
+    Writes n_files pages alternating between a group4 Black-and-White image without file ending
+    and a deflate compressed grayscale or color .tif
+    """
+    bw_image = Image.new("1", (4320, 5312), 1)
+    gray_image = Image.new("L", (4304, 5312), 255)
+    color_image = Image.new("RGB", (4304, 5312), (255, 255, 255))
+    for n in range(n_files):
+        name = "%07d.000" % (n + 1)
+        bw_image.save(os.path.join(folder, name), format="TIFF", compression="group4", dpi=(600, 600))
+        tif_image = color_image if n % 10 == 0 else gray_image
+        tif_image.save(os.path.join(folder, name + ".tif"), format="TIFF", compression="tiff_adobe_deflate", dpi=(600, 600))
+
+def run(folder: str, repeat: int):
+    file_paths = [os.path.join(folder, filename) for filename in sorted(os.listdir(folder))]
+    for file_path in file_paths:
+        if read_tiff_header(file_path) != read_tiff_header_with_pil(file_path):
+            raise ValueError("Header mismatch for " + file_path)
+    results = {}
+    for name, reader in [("ifd", read_tiff_header), ("pil", read_tiff_header_with_pil)]:
+        timings = timeit.repeat(lambda: [reader(file_path) for file_path in file_paths], number=1, repeat=repeat)
+        results[name] = min(timings)
+        print("%s: %d files in %.4fs (%.1f files/s)" % (name, len(file_paths), results[name], len(file_paths) / results[name]))
+    print("speedup: %.1fx" % (results["pil"] / results["ifd"]))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--files", dest="files", type=int, default=200, help="Number of synthetic pages to generate")
+    parser.add_argument("--repeat", dest="repeat", type=int, default=5, help="Number of timed runs, the fastest is reported")
+    parser.add_argument("--folder", dest="folder", type=str, default=None, help="Existing folder of TIFF files to use instead of synthetic ones")
+    args = parser.parse_args()
+    if args.folder:
+        run(args.folder, args.repeat)
+    else:
+        with tempfile.TemporaryDirectory() as folder:
+            generate_tiff_files(folder, args.files)
+            run(folder, args.repeat)
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+"""
+Compares parse_top_rows and page_label_from_name against the previous per line parsing, which validated
+names by catching the KeyError of the separator lookup, split .top.map rows with re.split and a chain of
+if/elif and built the labels with int(), on a synthetic .top and .top.map file.
+
+    python -m benchmarks.bench_top_parser --lines 100000
+"""
+import os
+import re
+import argparse
+import random
+import tempfile
+import timeit
+from ADSScanExplorerPipeline.models import PageType, page_label_from_name
+from ADSScanExplorerPipeline.ingestor import parse_top_rows
+
+
+def generate_top_file(file_path: str, n_lines: int, map_file: bool, seed: int = 42):
+    """
+    Writes header rows followed by n_lines page rows with a mix of separators, modifiers, sub page numbers and labels
+    """
+    rng = random.Random(seed)
+    rows = ["12", "001485", "J0001 0001", "<!--This file is sensitive.  Do not edit-->"]
+    map_types = {".": "1", ",": "C", ":": "B", "I": "I", "P": "P", "M": "M"}
+    for n in range(n_lines):
+        separator = rng.choice(".......,:IPM")
+        name = "%s%06d%s%03d" % (rng.choice("000000A"), n // 3 + 1, separator, rng.choice([0, 0, 0, 1, 12]))
+        label = rng.choice(["", "", str(n // 3 + 1), "ii", "A261/A262"])
+        if map_file:
+            rows.append("%s\t%s\t%s" % (name[:7] + "_" + name[8:], label, map_types[separator]))
+        else:
+            rows.append("%s%s" % (name, label))
+    with open(file_path, "w") as file:
+        file.write("\n".join(rows) + "\n")
+
+def legacy_page_type_from_separator(separator: str):
+    return {
+        '.': PageType.Normal,
+        ',': PageType.FrontMatter,
+        ':': PageType.BackMatter,
+        'I': PageType.Insert,
+        'P': PageType.Plate,
+        'M': PageType.Normal,
+    }[separator]
+
+def legacy_check_page_name_is_valid(page_name: str):
+    if len(page_name) == 11:
+        try:
+            legacy_page_type_from_separator(page_name[7])
+            return True
+        except:
+            return False
+    return False
+
+def legacy_split_top_map_row(line: str):
+    line_split = re.split(r"\s+", line)
+    name = line_split[0]
+    label = None
+    if len(line_split) > 1:
+        if not line_split[1].isspace() and len(line_split[1]) > 0:
+            label = line_split[1]
+    if len(line_split) > 2:
+        type_index = 7
+        type = line_split[2]
+        if type == "1":
+            name = name[:type_index] + "." + name[type_index + 1:]
+        elif type == "C":
+            name = name[:type_index] + "," + name[type_index + 1:]
+        elif type == "B":
+            name = name[:type_index] + ":" + name[type_index + 1:]
+        elif type == "I":
+            name = name[:type_index] + "I" + name[type_index + 1:]
+        elif type == "P":
+            name = name[:type_index] + "P" + name[type_index + 1:]
+        elif type == "M":
+            name = name[:type_index] + "M" + name[type_index + 1:]
+    return name, label
+
+def legacy_split_top_row(line: str):
+    name = line[0:11]
+    label = None
+    page_label = line[11:].strip()
+    if not page_label.isspace() and len(page_label) > 0:
+        label = page_label
+    return name, label
+
+def legacy_page_label(name: str):
+    first_num = int(name[1:7])
+    end_num = int(name[8:11])
+    if end_num > 0:
+        label = str(first_num) + "-" + str(end_num)
+    else:
+        label = str(first_num)
+    if name[0] != "0":
+        label = name[0] + "-" + label
+    return label
+
+def legacy_parse(file_path: str):
+    is_map_file = os.path.exists(file_path + ".map")
+    if is_map_file:
+        file_path = file_path + ".map"
+    rows = []
+    running_page_num = 0
+    with open(file_path) as file:
+        for line in file:
+            if is_map_file:
+                page_name, label = legacy_split_top_map_row(line)
+            else:
+                page_name, label = legacy_split_top_row(line)
+            if legacy_check_page_name_is_valid(page_name):
+                running_page_num += 1
+                rows.append((page_name, legacy_page_type_from_separator(page_name[7]), label, running_page_num, legacy_page_label(page_name)))
+    return rows
+
+def table_parse(file_path: str):
+    return [(*row, page_label_from_name(row.name)) for row in parse_top_rows(file_path)]
+
+def run(folder: str, n_lines: int, repeat: int):
+    for map_file in [False, True]:
+        file_path = os.path.join(folder, "J0001%s.top" % ("map" if map_file else ""))
+        generate_top_file(file_path, n_lines, False)
+        if map_file:
+            generate_top_file(file_path + ".map", n_lines, True)
+        if table_parse(file_path) != legacy_parse(file_path):
+            raise ValueError("Parsed rows differ from the previous parser")
+        results = {}
+        for name, parser in [("table", table_parse), ("legacy", legacy_parse)]:
+            results[name] = min(timeit.repeat(lambda: parser(file_path), number=1, repeat=repeat))
+            print("%s %s: %d lines in %.4fs (%.0f lines/s)" % (".top.map" if map_file else ".top", name, n_lines, results[name], n_lines / results[name]))
+        print("%s speedup: %.1fx" % (".top.map" if map_file else ".top", results["legacy"] / results["table"]))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--lines", dest="lines", type=int, default=100000, help="Number of page rows in the generated files")
+    parser.add_argument("--repeat", dest="repeat", type=int, default=5, help="Number of timed runs, the fastest is reported")
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as folder:
+        run(folder, args.lines, args.repeat)
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+"""
+Compares the peak memory, time and number of queries of building the volume metadata body
+from JournalVolume.to_dict() against streaming it with generate_volume_json, on a generated
+SQLite database with one large volume.
+
+    python -m benchmarks.bench_upload_db --pages 20000
+"""
+import os
+import argparse
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+import requests
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+from ADSScanExplorerPipeline.models import Base, JournalVolume, Page, Article, page_article_association_table
+from ADSScanExplorerPipeline.ingestor import generate_volume_json, bulk_insert, PAGE_COLUMNS, ARTICLE_COLUMNS, PAGE_ARTICLE_COLUMNS
+
+
+def generate_volume(session, n_pages: int, pages_per_article: int) -> JournalVolume:
+    """
+    Writes a volume of n_pages pages where every pages_per_article pages form an article
+    """
+    vol = JournalVolume("seri", "bench", "0001")
+    session.add(vol)
+    session.flush()
+    now = datetime.utcnow()
+    page_rows = []
+    article_rows = []
+    page_article_rows = []
+    for n in range(n_pages):
+        page_id = vol.id + "_%07d.000" % (n + 1)
+        page_rows.append((now, now, page_id, "%07d.000" % (n + 1), str(n + 1), 'image/tiff', 'Grayscale', 'Normal', 4304, 5312, vol.id, n + 1))
+        bibcode = "bench%014d" % (n // pages_per_article)
+        if n % pages_per_article == 0:
+            article_rows.append((now, now, bibcode, vol.id, n + 1))
+        page_article_rows.append((page_id, bibcode))
+    bulk_insert(session, Page.__table__, PAGE_COLUMNS, page_rows)
+    bulk_insert(session, Article.__table__, ARTICLE_COLUMNS, article_rows)
+    bulk_insert(session, page_article_association_table, PAGE_ARTICLE_COLUMNS, page_article_rows)
+    session.commit()
+    return vol
+
+def to_dict_body(vol: JournalVolume, session) -> int:
+    return len(requests.Request('PUT', 'http://localhost', json=vol.to_dict()).prepare().body)
+
+def streamed_body(vol: JournalVolume, session) -> int:
+    return sum(len(chunk) for chunk in generate_volume_json(vol, session))
+
+def measure(engine, builder):
+    session = sessionmaker(bind=engine)()
+    vol = JournalVolume.get("bench0001", session)
+    statements = []
+    def count_statement(conn, cursor, statement, *args):
+        statements.append(statement)
+    event.listen(engine, "before_cursor_execute", count_statement)
+    tracemalloc.start()
+    start = time.perf_counter()
+    size = builder(vol, session)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    event.remove(engine, "before_cursor_execute", count_statement)
+    session.close()
+    return size, elapsed, peak, len(statements)
+
+def run(n_pages: int, pages_per_article: int):
+    with tempfile.TemporaryDirectory() as folder:
+        engine = create_engine("sqlite:///" + os.path.join(folder, "bench.db"))
+        Base.metadata.create_all(engine)
+        session = sessionmaker(bind=engine)()
+        vol = generate_volume(session, n_pages, pages_per_article)
+        if b"".join(generate_volume_json(vol, session)) != requests.Request('PUT', 'http://localhost', json=vol.to_dict()).prepare().body:
+            raise ValueError("Streamed body differs from the to_dict body")
+        session.close()
+
+        results = {}
+        for name, builder in [("to_dict", to_dict_body), ("streamed", streamed_body)]:
+            size, elapsed, peak, queries = measure(engine, builder)
+            results[name] = peak
+            print("%s: %d bytes in %.3fs, peak memory %.1f MB, %d queries" % (name, size, elapsed, peak / 2**20, queries))
+        print("peak memory reduction: %.1fx" % (results["to_dict"] / results["streamed"]))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pages", dest="pages", type=int, default=5000, help="Number of pages in the generated volume")
+    parser.add_argument("--pages-per-article", dest="pages_per_article", type=int, default=10, help="Number of pages of each generated article")
+    args = parser.parse_args()
+    run(args.pages, args.pages_per_article)
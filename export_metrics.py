@@ -0,0 +1,40 @@
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from ADSScanExplorerPipeline.metrics import format_prometheus
+import argparse
+import os
+from adsputils import setup_logging, load_config
+
+# ============================= INITIALIZATION ==================================== #
+
+proj_home = os.path.realpath(os.path.dirname(__file__))
+config = load_config(proj_home=proj_home)
+logger = setup_logging('export_metrics.py', proj_home=proj_home,
+                        level=config.get('LOGGING_LEVEL', 'INFO'),
+                        attach_stdout=config.get('LOG_STDOUT', False))
+
+# =============================== FUNCTIONS ======================================= #
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--output",
+                    dest="output",
+                    required=False,
+                    default=None,
+                    type=str,
+                    help="File to write the metrics to, e.g. in the directory of the node exporter textfile collector. Printed to stdout if not set")
+    args = parser.parse_args()
+    engine = create_engine(config.get("SQLALCHEMY_URL", ""), echo=False)
+    DBSession = sessionmaker(bind=engine)
+    session = DBSession()
+
+    metrics = format_prometheus(session)
+    session.close()
+    if args.output:
+        #Written next to the target and renamed so a scrape never reads a partial file
+        with open(args.output + ".tmp", "w") as file:
+            file.write(metrics)
+        os.replace(args.output + ".tmp", args.output)
+    else:
+        print(metrics, end="")